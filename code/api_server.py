@@ -1,40 +1,128 @@
 # api_server.py
 # Minimal FastAPI server to expose RAG assistant via `/generate` and `/search` endpoints
 
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Optional
-from retrieval_script import generate_with_gpt, embed_query, load_faiss_and_metadata, retrieve_top_k
-import numpy as np
-import faiss
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, NamedTuple
+from retrieval_script import load_faiss_and_metadata, with_full_text, SEARCH_MODES
+from federated_search import SearchTarget, search_target, fuse
+from index_factory import describe_index
+from context_builder import pack_context
+from metadata_store import ChunkFilter, normalize_date
+from async_clients import aembed_query, aembed_queries, achat, achat_stream, aclose, set_executor
+from response_cache import ResponseCache
+from exporters import EXPORT_FORMATS, ExportCache, content_hash, render
+from snapshots import ReaderLease, read_manifest, current_paths, index_names
+import ingest_queue
+from openai import APITimeoutError
 import json
 import os
 from datetime import datetime
 
-from openai import OpenAI
 from dotenv import load_dotenv
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-app = FastAPI()
 
-# Load indexes at startup (to avoid reloading per request)
-TEXT_INDEX, TEXT_META = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata.json")
-IMG_INDEX, IMG_META = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images.json")
+MAX_BATCH_QUERIES = int(os.getenv("CAFB_MAX_BATCH_QUERIES", "256"))
+MAX_TOP_K = int(os.getenv("CAFB_MAX_TOP_K", "100"))                 # results per query (overfetch multiplies it)
+MAX_SEARCH_PARAM = int(os.getenv("CAFB_MAX_SEARCH_PARAM", "4096"))  # cap on per-request nprobe / ef_search
+SEARCH_MODE = os.getenv("CAFB_SEARCH_MODE", "dense")  # default when a request doesn't set `mode`
+
+# FAISS releases the GIL while searching, so a small dedicated pool keeps it off the event loop
+SEARCH_WORKERS = int(os.getenv("CAFB_SEARCH_WORKERS", "4"))
+SEARCH_POOL = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="faiss-search")
+set_executor(SEARCH_POOL)  # the embedding cache's SQLite reads/writes run there too, never on the event loop
+
+# Document rendering is pure-Python CPU work, so it runs in worker processes rather than on the
+# event loop; "spawn" keeps the workers from inheriting this process's threads and loaded indexes
+EXPORT_WORKERS = int(os.getenv("CAFB_EXPORT_WORKERS", "2"))
+EXPORT_POOL = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+EXPORT_CACHE = ExportCache()
+
+
+RELOAD_INTERVAL = float(os.getenv("CAFB_RELOAD_INTERVAL", "2"))  # seconds between manifest checks, 0 disables
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watcher = asyncio.create_task(watch_snapshots()) if RELOAD_INTERVAL > 0 else None
+    yield
+    if watcher:
+        watcher.cancel()
+    await aclose()
+    SEARCH_POOL.shutdown(wait=False)
+    EXPORT_POOL.shutdown(wait=False)
+    LOG_POOL.shutdown(wait=True)  # flush queued log lines
+
+app = FastAPI(lifespan=lifespan)
+
+# ----------------------------
+# Index snapshots: loaded at startup, swapped in when update_pipeline.py publishes a new one
+# ----------------------------
+OUTPUT_DIR = os.getenv("CAFB_OUTPUT_DIR", "/Users/sharvari/Downloads/CAFB_Challenge/outputs")
+
+class IndexSnapshot(NamedTuple):
+    version: str
+    indexes: Dict[str, SearchTarget]  # every index the manifest publishes, e.g. "text", "images"
+    lease: ReaderLease                # keeps its files from being pruned until the last request lets go
+
+def load_snapshot(output_dir: str) -> IndexSnapshot:
+    manifest = read_manifest(output_dir)  # read once so all indexes come from the same version
+    lease = ReaderLease(output_dir, manifest)  # taken before loading, so a concurrent prune can't race us
+    indexes = {}
+    for name in index_names(manifest):
+        index, metadata = load_faiss_and_metadata(*current_paths(output_dir, name, manifest))
+        indexes[name] = SearchTarget(name, index, metadata)
+    return IndexSnapshot(manifest.get("version", ""), indexes, lease)
+
+SNAPSHOT = load_snapshot(OUTPUT_DIR)
+RESPONSE_CACHE = ResponseCache(OUTPUT_DIR)
+
+async def watch_snapshots():
+    """Poll the manifest; load a new snapshot off the event loop, then swap the reference.
+    Requests hold the snapshot they started with, so in-flight work finishes on the old version."""
+    global SNAPSHOT
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        try:
+            if read_manifest(OUTPUT_DIR).get("version", "") != SNAPSHOT.version:
+                snapshot = await loop.run_in_executor(None, load_snapshot, OUTPUT_DIR)
+                previous, SNAPSHOT = SNAPSHOT.version, snapshot
+                print(f"🔄 Switched from index snapshot {previous or '(unversioned)'} to {snapshot.version}.")
+        except Exception as e:
+            print(f"⚠️ Index reload failed, still serving {SNAPSHOT.version or '(unversioned)'}: {e}")
 
 # ----------------------------
 # Request and Response Schemas
 # ----------------------------
+class SearchFilter(BaseModel):
+    sources: Optional[List[str]] = None   # e.g. ["blog", "grant"] or raw values like "blog_posts"
+    date_from: Optional[str] = None       # YYYY-MM-DD, inclusive
+    date_to: Optional[str] = None
+    doc_ids: Optional[List[str]] = None
+
 class GenerateRequest(BaseModel):
     query: str
-    top_k: Optional[int] = 5
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
     format: Optional[str] = None  # e.g., "grant", "tweet"
     tone: Optional[str] = None    # e.g., "formal", "casual"
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_SEARCH_PARAM)     # IVF indexes: lists to visit (more = better recall, slower)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_SEARCH_PARAM)  # HNSW indexes: candidate list size
+    mode: Optional[str] = None        # "dense", "lexical" (BM25) or "hybrid" (rank fusion of both)
+    filters: Optional[SearchFilter] = None
+    indexes: Optional[List[str]] = None  # search only these, e.g. ["text"] (default: every published index)
 
 class SourceChunk(BaseModel):
     score: float
     source: str
     title: str
     text: str
+    url: Optional[str] = None
 
 class GenerateResponse(BaseModel):
     answer: str
@@ -42,58 +130,169 @@ class GenerateResponse(BaseModel):
 
 class SearchRequest(BaseModel):
     query: str
-    top_k: Optional[int] = 5
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_SEARCH_PARAM)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_SEARCH_PARAM)
+    mode: Optional[str] = None
+    filters: Optional[SearchFilter] = None
+    indexes: Optional[List[str]] = None
 
 class SearchResponse(BaseModel):
     results: List[SourceChunk]
 
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_SEARCH_PARAM)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_SEARCH_PARAM)
+    mode: Optional[str] = None
+    filters: Optional[SearchFilter] = None
+    indexes: Optional[List[str]] = None
+
+class BatchSearchResponse(BaseModel):
+    results: List[SearchResponse]  # one entry per query, in request order
+
+class ExportRequest(BaseModel):
+    text: str
+    format: str  # "PDF", "DOCX", "TXT" or "PPTX"
+
+class IngestRequest(BaseModel):
+    files: List[str]  # paths of uploads already saved under data/ (registered JSONL sources or captions)
+
+class IngestJob(BaseModel):
+    id: int
+    status: str                   # "queued", "running", "done" or "failed"
+    files: List[str]
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    batch: Optional[int] = None   # jobs ingested by the same pipeline run share the first job's id
+    progress: str = ""            # latest line of pipeline output
+    log: str = ""
+    error: Optional[str] = None
+
 # ----------------------------
 # Log queries to a file
 # ----------------------------
+# One writer thread: handlers never wait on the file, and lines keep their request order
+LOG_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-log")
+
+def _append_log(entry: dict, logfile: str):
+    try:
+        with open(logfile, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"⚠️ Could not write the query log: {e}")
+
 def log_query(entry: dict, logfile: str = "query_log.jsonl"):
-    with open(logfile, "a") as f:
-        f.write(json.dumps(entry) + "\n")
+    LOG_POOL.submit(_append_log, entry, logfile)
 
 # ----------------------------
-# /generate endpoint (RAG + GPT-4)
+# Search every requested index on the search pool and fuse the results
 # ----------------------------
-@app.post("/generate", response_model=GenerateResponse)
-def generate_response(req: GenerateRequest):
-    if not req.query.strip():
-        raise HTTPException(status_code=400, detail="Query cannot be empty.")
+def resolve_mode(mode: Optional[str]) -> str:
+    mode = mode or SEARCH_MODE
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SEARCH_MODES)}.")
+    return mode
 
-    query_vec = embed_query(req.query)
+def resolve_filter(filters: Optional[SearchFilter]) -> Optional[ChunkFilter]:
+    if filters is None:
+        return None
+    dates = []
+    for value in (filters.date_from, filters.date_to):
+        if value and normalize_date(value) is None:
+            raise HTTPException(status_code=400, detail=f"Unrecognised date {value!r}; use YYYY-MM-DD.")
+        dates.append(normalize_date(value) if value else None)
+    chunk_filter = ChunkFilter(tuple(filters.sources or ()), dates[0], dates[1], tuple(filters.doc_ids or ()))
+    return None if chunk_filter.is_empty() else chunk_filter
 
-    # Retrieve chunks
-    text_results = retrieve_top_k(TEXT_INDEX, TEXT_META, query_vec, k=req.top_k)
-    image_results = retrieve_top_k(IMG_INDEX, IMG_META, query_vec, k=2)
-    all_chunks = text_results + image_results
+def resolve_targets(snap: IndexSnapshot, names: Optional[List[str]]) -> List[SearchTarget]:
+    unknown = sorted(set(names or ()) - set(snap.indexes))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown index {', '.join(unknown)}; "
+                                                    f"available: {', '.join(snap.indexes)}.")
+    return [snap.indexes[name] for name in (names or snap.indexes)]
+
+async def search_batch(targets: List[SearchTarget], query_vecs, queries: List[str], top_k: int,
+                       nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                       mode: str = "dense", chunk_filter: Optional[ChunkFilter] = None) -> List[List[dict]]:
+    """One fused top_k list per query across `targets`. Each result's `index` names the store its id
+    belongs to, for the full-text lookup in build_messages."""
+    loop = asyncio.get_running_loop()
+    per_target = await asyncio.gather(*(
+        loop.run_in_executor(SEARCH_POOL, lambda t=t: search_target(
+            t, query_vecs, queries, top_k, mode, nprobe, ef_search, chunk_filter))
+        for t in targets
+    ))
+    return fuse(per_target, top_k)
+
+async def search(targets: List[SearchTarget], query_vec, query: str, top_k: int, nprobe: Optional[int] = None,
+                 ef_search: Optional[int] = None, mode: str = "dense",
+                 chunk_filter: Optional[ChunkFilter] = None) -> List[dict]:
+    return (await search_batch(targets, [query_vec], [query], top_k, nprobe, ef_search, mode, chunk_filter))[0]
+
+# ----------------------------
+# Prompt construction shared by /generate and /generate/stream
+# ----------------------------
+GENERATION_PARAMS = {"temperature": 0.3, "max_tokens": 400}
 
+def build_messages(req: GenerateRequest, all_chunks: List[dict], snap: IndexSnapshot) -> List[dict]:
     extra_prompt = ""
     if req.format:
         extra_prompt += f" Format: {req.format}."
     if req.tone:
         extra_prompt += f" Tone: {req.tone}."
 
-    context = "\n\n".join([r["text"] for r in all_chunks])[:3000]
+    # Full chunk texts (not the 500-char previews), kept in fused rank order, deduplicated and
+    # packed into the context token budget
+    full = {}
+    for name in {r["index"] for r in all_chunks}:
+        for r in with_full_text([r for r in all_chunks if r["index"] == name], snap.indexes[name].metadata):
+            full[(name, r["id"])] = r
+    context, _ = pack_context([full[(r["index"], r["id"])] for r in all_chunks])
     prompt = (
         f"You are a helpful assistant for the Capital Area Food Bank.\n"
         f"Based on the following retrieved information, write a clear and concise answer to the user's query."
         f"{extra_prompt}\n"
         f"\n---\n{context}\n---\n\nUser question: {req.query}\n\nAnswer:"
     )
+    return [
+        {"role": "system", "content": "You are a nonprofit assistant who writes high-quality content."},
+        {"role": "user", "content": prompt}
+    ]
+
+async def abuild_messages(req: GenerateRequest, all_chunks: List[dict], snap: IndexSnapshot) -> List[dict]:
+    # Metadata lookups (SQLite) and tokenizing the context block, so they run in the search pool
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SEARCH_POOL, build_messages, req, all_chunks, snap)
+
+# ----------------------------
+# /generate endpoint (RAG + GPT-4)
+# ----------------------------
+@app.post("/generate", response_model=GenerateResponse)
+async def generate_response(req: GenerateRequest):
+    if not req.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty.")
+
+    mode = resolve_mode(req.mode)
+    chunk_filter = resolve_filter(req.filters)
+    query_vec = await aembed_query(req.query)
+
+    # Retrieve chunks
+    snap = SNAPSHOT
+    targets = resolve_targets(snap, req.indexes)
+    all_chunks = await search(targets, query_vec, req.query, req.top_k, req.nprobe, req.ef_search, mode,
+                              chunk_filter)
+    chunk_ids = [r["id"] for r in all_chunks]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            temperature=0.3,
-            max_tokens=400,
-            messages=[
-                {"role": "system", "content": "You are a nonprofit assistant who writes high-quality content."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        answer = response.choices[0].message.content.strip()
+        answer = RESPONSE_CACHE.lookup(query_vec, req.format, req.tone, chunk_ids, snap.version)
+        if answer is None:
+            answer = await achat(messages=await abuild_messages(req, all_chunks, snap), **GENERATION_PARAMS)
+            RESPONSE_CACHE.store(query_vec, req.format, req.tone, chunk_ids, answer, snap.version)
+    except APITimeoutError:
+        raise HTTPException(status_code=504, detail="GPT-4 generation timed out.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"GPT-4 generation failed: {e}")
 
@@ -114,26 +313,173 @@ def generate_response(req: GenerateRequest):
         ]
     )
 
+# ----------------------------
+# /generate/stream endpoint (Server-Sent Events)
+# Emits `sources` once, then `delta` events with text as it arrives, then `done` (or `error`).
+# ----------------------------
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/generate/stream")
+async def generate_stream(req: GenerateRequest):
+    if not req.query.strip():
+        raise HTTPException(status_code=400, detail="Query cannot be empty.")
+
+    mode = resolve_mode(req.mode)
+    chunk_filter = resolve_filter(req.filters)
+    query_vec = await aembed_query(req.query)
+    snap = SNAPSHOT
+    targets = resolve_targets(snap, req.indexes)
+    all_chunks = await search(targets, query_vec, req.query, req.top_k, req.nprobe, req.ef_search, mode,
+                              chunk_filter)
+
+    log_query({
+        "timestamp": datetime.utcnow().isoformat(),
+        "endpoint": "/generate/stream",
+        "query": req.query,
+        "format": req.format,
+        "tone": req.tone,
+        "top_k": req.top_k
+    })
+
+    chunk_ids = [r["id"] for r in all_chunks]
+
+    async def events():
+        yield sse_event("sources", all_chunks)
+        parts = []
+        try:
+            cached_answer = RESPONSE_CACHE.lookup(query_vec, req.format, req.tone, chunk_ids, snap.version)
+            if cached_answer is not None:
+                yield sse_event("delta", {"text": cached_answer})
+                yield sse_event("done", {"cached": True})
+                return
+            messages = await abuild_messages(req, all_chunks, snap)
+            async for delta in achat_stream(messages=messages, **GENERATION_PARAMS):
+                parts.append(delta)
+                yield sse_event("delta", {"text": delta})
+        except Exception as e:
+            yield sse_event("error", {"detail": f"GPT-4 generation failed: {e}"})
+            return
+        RESPONSE_CACHE.store(query_vec, req.format, req.tone, chunk_ids, "".join(parts).strip(), snap.version)
+        yield sse_event("done", {"cached": False})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# ----------------------------
+# /index endpoint (which snapshot this worker is serving)
+# ----------------------------
+@app.get("/index")
+async def index_info():
+    snap = SNAPSHOT
+    return {"version": snap.version,
+            "indexes": {name: {"vectors": t.index.ntotal, "kind": describe_index(t.index)}
+                        for name, t in snap.indexes.items()}}
+
+# ----------------------------
+# /cache/stats endpoint (semantic response cache counters)
+# ----------------------------
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**RESPONSE_CACHE.stats(), "exports": EXPORT_CACHE.stats()}
+
+# ----------------------------
+# /export endpoint (render edited output as a downloadable file)
+# ----------------------------
+@app.post("/export")
+async def export(req: ExportRequest):
+    fmt = req.format.upper()
+    export_format = EXPORT_FORMATS.get(fmt)
+    if export_format is None:
+        raise HTTPException(status_code=400, detail=f"Unknown export format '{req.format}'. "
+                                                    f"Use one of {list(EXPORT_FORMATS)}.")
+    digest = content_hash(req.text)
+    data = EXPORT_CACHE.get(digest, fmt)
+    if data is None:
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(EXPORT_POOL, render, req.text, fmt)
+        EXPORT_CACHE.put(digest, fmt, data)
+    return Response(content=data, media_type=export_format.mime_type,
+                    headers={"Content-Disposition": f'attachment; filename="cafbrain_output{export_format.extension}"',
+                             "ETag": f'"{digest[:32]}"'})
+
+# ----------------------------
+# /ingest endpoints (queue uploads for the ingestion worker, poll their progress)
+# ----------------------------
+@app.post("/ingest", response_model=IngestJob)
+async def ingest(req: IngestRequest):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, ingest_queue.enqueue, req.files)
+    except ValueError as e:  # not under data/, missing, or a type the pipeline can't chunk
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/ingest/jobs", response_model=List[IngestJob])
+async def ingest_jobs(limit: int = 20):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, ingest_queue.list_jobs, limit)
+
+@app.get("/ingest/jobs/{job_id}", response_model=IngestJob)
+async def ingest_job(job_id: int):
+    loop = asyncio.get_running_loop()
+    job = await loop.run_in_executor(None, ingest_queue.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown ingestion job {job_id}.")
+    return job
+
 # ----------------------------
 # /search endpoint (retrieval only)
 # ----------------------------
 @app.post("/search", response_model=SearchResponse)
-def search_chunks(req: SearchRequest):
+async def search_chunks(req: SearchRequest):
     if not req.query.strip():
         raise HTTPException(status_code=400, detail="Query cannot be empty.")
 
-    query_vec = embed_query(req.query)
+    mode = resolve_mode(req.mode)
+    chunk_filter = resolve_filter(req.filters)
+    query_vec = await aembed_query(req.query)
 
-    text_results = retrieve_top_k(TEXT_INDEX, TEXT_META, query_vec, k=req.top_k)
-    image_results = retrieve_top_k(IMG_INDEX, IMG_META, query_vec, k=2)
-    all_results = text_results + image_results
+    targets = resolve_targets(SNAPSHOT, req.indexes)
+    all_results = await search(targets, query_vec, req.query, req.top_k, req.nprobe, req.ef_search, mode,
+                               chunk_filter)
 
     # Log the query
     log_query({
         "timestamp": datetime.utcnow().isoformat(),
         "endpoint": "/search",
         "query": req.query,
-        "top_k": req.top_k
+        "top_k": req.top_k,
+        "mode": mode,
+        "filters": chunk_filter._asdict() if chunk_filter else None,
+        "indexes": [t.name for t in targets]
     })
 
     return SearchResponse(results=[SourceChunk(**r) for r in all_results])
+
+# ----------------------------
+# /search/batch endpoint (many queries, one embedding call, one index.search per index)
+# ----------------------------
+@app.post("/search/batch", response_model=BatchSearchResponse)
+async def search_chunks_batch(req: BatchSearchRequest):
+    if not req.queries or any(not q.strip() for q in req.queries):
+        raise HTTPException(status_code=400, detail="Queries cannot be empty.")
+    if len(req.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_QUERIES} queries per batch.")
+
+    mode = resolve_mode(req.mode)
+    chunk_filter = resolve_filter(req.filters)
+    targets = resolve_targets(SNAPSHOT, req.indexes)
+    query_vecs = await aembed_queries(req.queries)
+    per_query = await search_batch(targets, query_vecs, req.queries, req.top_k,
+                                   req.nprobe, req.ef_search, mode, chunk_filter)
+
+    log_query({
+        "timestamp": datetime.utcnow().isoformat(),
+        "endpoint": "/search/batch",
+        "queries": len(req.queries),
+        "top_k": req.top_k
+    })
+
+    return BatchSearchResponse(results=[
+        SearchResponse(results=[SourceChunk(**r) for r in results]) for results in per_query
+    ])
@@ -0,0 +1,129 @@
+# async_clients.py
+# Pooled, non-blocking OpenAI / Ollama clients for the API server
+
+import os
+import asyncio
+from concurrent.futures import Executor
+from typing import List, Dict, AsyncIterator, Optional
+
+import httpx
+import ollama
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+
+from embedding_cache import get_cache
+
+load_dotenv()
+
+EMBEDDING_DIM = 1536
+OPENAI_EMBED_MODEL = "text-embedding-3-small"
+CHAT_MODEL = os.getenv("CAFB_CHAT_MODEL", "gpt-4")
+
+MAX_CONNECTIONS = int(os.getenv("CAFB_HTTP_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("CAFB_HTTP_MAX_KEEPALIVE", "20"))
+LLM_CONCURRENCY = int(os.getenv("CAFB_LLM_CONCURRENCY", "16"))
+EMBED_CONCURRENCY = int(os.getenv("CAFB_EMBED_CONCURRENCY", "32"))
+LLM_TIMEOUT = float(os.getenv("CAFB_LLM_TIMEOUT", "60"))
+EMBED_TIMEOUT = float(os.getenv("CAFB_EMBED_TIMEOUT", "10"))
+
+# One connection pool per worker process, shared by every request
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE),
+    timeout=httpx.Timeout(LLM_TIMEOUT, connect=5.0),
+)
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=1)
+ollama_client = ollama.AsyncClient(timeout=EMBED_TIMEOUT)
+
+_llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+_embed_slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+# The embedding cache is SQLite (shared by every worker, so calls can wait on its lock); it runs here
+_executor: Optional[Executor] = None
+
+
+def set_executor(executor: Optional[Executor]):
+    """Run blocking embedding-cache calls on `executor` (None: the event loop's default pool)."""
+    global _executor
+    _executor = executor
+
+
+async def _offload(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+# ----------------------------
+# Embed a user query (OpenAI -> Ollama fallback), cache first
+# ----------------------------
+async def aembed_query(text: str, model_name: str = "nomic-embed-text") -> List[float]:
+    if not text.strip():
+        return [0.0] * EMBEDDING_DIM
+    cache = get_cache()
+    if cache is not None:
+        cached = (await _offload(cache.get_many, OPENAI_EMBED_MODEL, [text]))[0]
+        if cached is not None:
+            return cached
+
+    async with _embed_slots:
+        try:
+            response = await openai_client.embeddings.create(
+                input=text, model=OPENAI_EMBED_MODEL, timeout=EMBED_TIMEOUT)
+            embedding = response.data[0].embedding
+            if cache is not None:
+                await _offload(cache.put_many, OPENAI_EMBED_MODEL, [text], [embedding])
+            return embedding
+        except Exception as e:
+            print(f"OpenAI embedding failed: {e}. Trying Ollama...")
+        try:
+            response = await ollama_client.embeddings(model=model_name, prompt=text)
+            return response["embedding"]
+        except Exception as ollama_e:
+            print(f"Ollama embedding also failed: {ollama_e}. Returning zero vector.")
+            return [0.0] * EMBEDDING_DIM
+
+
+async def aembed_queries(texts: List[str], model_name: str = "nomic-embed-text") -> List[List[float]]:
+    """Embed many queries with one provider call (cache hits are skipped), in input order."""
+    cache = get_cache()
+    embeddings = await _offload(cache.get_many, OPENAI_EMBED_MODEL, texts) if cache is not None else [None] * len(texts)
+    pending = [i for i, e in enumerate(embeddings) if e is None and texts[i].strip()]
+    if pending:
+        pending_texts = [texts[i] for i in pending]
+        async with _embed_slots:
+            try:
+                response = await openai_client.embeddings.create(
+                    input=pending_texts, model=OPENAI_EMBED_MODEL, timeout=EMBED_TIMEOUT)
+                vectors = [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+                if cache is not None:
+                    await _offload(cache.put_many, OPENAI_EMBED_MODEL, pending_texts, vectors)
+            except Exception as e:
+                print(f"OpenAI batch embedding failed: {e}. Falling back to per-query embedding.")
+                vectors = None
+        if vectors is None:
+            vectors = await asyncio.gather(*(aembed_query(t, model_name) for t in pending_texts))
+        for i, vec in zip(pending, vectors):
+            embeddings[i] = vec
+    return [e if e is not None else [0.0] * EMBEDDING_DIM for e in embeddings]
+
+
+# ----------------------------
+# Chat completion with a bounded number of in-flight calls
+# ----------------------------
+async def achat(messages: List[Dict], **kwargs) -> str:
+    async with _llm_slots:
+        response = await openai_client.chat.completions.create(
+            model=CHAT_MODEL, messages=messages, timeout=LLM_TIMEOUT, **kwargs)
+    return response.choices[0].message.content.strip()
+
+
+async def achat_stream(messages: List[Dict], **kwargs) -> AsyncIterator[str]:
+    """Yield content deltas as they arrive; the concurrency slot is held until the stream ends."""
+    async with _llm_slots:
+        stream = await openai_client.chat.completions.create(
+            model=CHAT_MODEL, messages=messages, timeout=LLM_TIMEOUT, stream=True, **kwargs)
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+
+
+async def aclose():
+    await http_client.aclose()
@@ -0,0 +1,314 @@
+# benchmark.py
+# Offline retrieval benchmark: build, load and query each index kind over the real chunk corpus with a
+# deterministic hash embedder (no OpenAI/Ollama), scoring recall@k and MRR against golden_queries.jsonl
+#
+#   python benchmark.py --kinds flat sq8 hnsw --modes dense hybrid --compare old_results.json
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+# The modules below construct OpenAI clients at import time; the benchmark never calls them
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")
+
+from hash_embedder import hash_embed, HASH_EMBED_MODEL
+from embedder import load_chunks
+from index_factory import build_index, assign_ids, describe_index, index_bytes, INDEX_KINDS
+from metadata_store import write_store
+from retrieval_script import load_faiss_and_metadata, retrieve_top_k, retrieve_batch, SEARCH_MODES
+from snapshots import begin_snapshot, publish_snapshot
+
+CHUNKS_DIR = os.getenv("CAFB_OUTPUT_DIR", "/Users/sharvari/Downloads/CAFB_Challenge/outputs")
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden_queries.jsonl")
+RESULTS_PATH = os.path.join(CHUNKS_DIR, "benchmark_results.json")
+API_CONCURRENCY = 16
+
+
+# ----------------------------
+# Measurements
+# ----------------------------
+def rss_mb() -> float:
+    """Resident memory of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource  # no /proc (macOS): peak RSS, reported in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+
+
+def latency_summary(seconds: List[float]) -> Dict:
+    ms = np.array(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "qps": round(len(ms) / (ms.sum() / 1000), 1),
+    }
+
+
+def quality(golden: List[Dict], results: List[List[Dict]], k: int) -> Dict:
+    """recall@k: share of each query's relevant documents in its top k (by title), averaged.
+    MRR: mean of 1 / rank of the first relevant result (0 when none is in the top k)."""
+    recalls, reciprocal_ranks = [], []
+    for entry, rows in zip(golden, results):
+        relevant = set(entry["relevant_titles"])
+        titles = [r["title"] for r in rows[:k]]
+        recalls.append(len(relevant & set(titles)) / len(relevant))
+        rank = next((i for i, title in enumerate(titles, start=1) if title in relevant), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+    return {"recall_at_k": round(float(np.mean(recalls)), 4), "mrr": round(float(np.mean(reciprocal_ranks)), 4)}
+
+
+def load_golden(path: str = GOLDEN_PATH) -> List[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+# ----------------------------
+# retrieval_script: retrieve_top_k per query, retrieve_batch for the whole set
+# ----------------------------
+def bench_retrieval(index, metadata, golden: List[Dict], query_vectors: np.ndarray, mode: str, k: int,
+                    repeat: int) -> Dict:
+    queries = [g["query"] for g in golden]
+
+    def one(row: int) -> List[Dict]:
+        if mode == "dense":
+            return retrieve_top_k(index, metadata, query_vectors[row], k=k)
+        return retrieve_batch(index, metadata, query_vectors[row:row + 1], queries[row:row + 1], k=k, mode=mode)[0]
+
+    results = [one(row) for row in range(len(queries))]  # also warms caches and page-ins
+    timings = []
+    for _ in range(repeat):
+        for row in range(len(queries)):
+            start = time.perf_counter()
+            one(row)
+            timings.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        retrieve_batch(index, metadata, query_vectors, queries, k=k, mode=mode)
+    batch_qps = repeat * len(queries) / (time.perf_counter() - start)
+    return {**quality(golden, results, k), **latency_summary(timings), "batch_qps": round(batch_qps, 1)}
+
+
+# ----------------------------
+# api_server: the full /search request path (routing, validation, search, serialization, logging)
+# ----------------------------
+async def _aembed_hash(text: str, model_name: str = HASH_EMBED_MODEL) -> List[float]:
+    return hash_embed([text])[0].tolist()
+
+
+async def _aembed_hash_many(texts: List[str], model_name: str = HASH_EMBED_MODEL) -> List[List[float]]:
+    return hash_embed(texts).tolist()
+
+
+def load_api(output_dir: str):
+    """Import api_server serving `output_dir`, with query embedding swapped for the hash embedder."""
+    if "api_server" not in sys.modules:
+        os.environ["CAFB_OUTPUT_DIR"] = output_dir
+    import api_server
+    api_server.aembed_query = _aembed_hash
+    api_server.aembed_queries = _aembed_hash_many
+    api_server.SNAPSHOT = api_server.load_snapshot(output_dir)
+    return api_server
+
+
+async def _bench_api(api_server, golden: List[Dict], mode: str, k: int, repeat: int) -> Dict:
+    import httpx
+
+    transport = httpx.ASGITransport(app=api_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as http:
+        async def search(query: str) -> List[Dict]:
+            response = await http.post("/search", json={"query": query, "top_k": k, "mode": mode})
+            response.raise_for_status()
+            return response.json()["results"]
+
+        results = [await search(g["query"]) for g in golden]
+        timings = []
+        for _ in range(repeat):
+            for g in golden:
+                start = time.perf_counter()
+                await search(g["query"])
+                timings.append(time.perf_counter() - start)
+
+        slots = asyncio.Semaphore(API_CONCURRENCY)
+
+        async def limited(query: str):
+            async with slots:
+                await search(query)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(limited(g["query"]) for _ in range(repeat) for g in golden))
+        concurrent_qps = repeat * len(golden) / (time.perf_counter() - start)
+    return {**quality(golden, results, k), **latency_summary(timings),
+            f"concurrent_qps_{API_CONCURRENCY}": round(concurrent_qps, 1)}
+
+
+def bench_api(api_server, golden: List[Dict], mode: str, k: int, repeat: int) -> Dict:
+    return asyncio.run(_bench_api(api_server, golden, mode, k, repeat))
+
+
+# ----------------------------
+# One index kind: build, load, query
+# ----------------------------
+def bench_kind(kind: str, matrix: np.ndarray, ids: np.ndarray, store_path: str, workdir: str,
+               golden: List[Dict], query_vectors: np.ndarray, modes: List[str], k: int, repeat: int,
+               api: bool) -> Dict:
+    output_dir = os.path.join(workdir, kind)
+    version, snapshot_dir = begin_snapshot(output_dir)
+    index_path = os.path.join(snapshot_dir, "faiss_index.index")
+
+    start = time.perf_counter()
+    index = build_index(matrix, kind=kind, ids=ids)
+    build_s = time.perf_counter() - start
+    faiss.write_index(index, index_path)
+    size = index_bytes(index)
+    del index
+    publish_snapshot(output_dir, version, {"text": (index_path, store_path)})
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    index, metadata = load_faiss_and_metadata(index_path, store_path)
+    load_s = time.perf_counter() - start
+
+    row = {
+        "kind": kind,
+        "describe": describe_index(index),
+        "build_s": round(build_s, 3),
+        "index_bytes": size,
+        "bytes_per_vector": round(size / max(index.ntotal, 1)),
+        "load_s": round(load_s, 3),
+        "load_rss_mb": round(rss_mb() - rss_before, 1),
+        "retrieve": {},
+        "api_search": {},
+    }
+    for mode in modes:
+        print(f"⏱️ {kind} / {mode}: retrieval_script")
+        row["retrieve"][mode] = bench_retrieval(index, metadata, golden, query_vectors, mode, k, repeat)
+    row["search_rss_mb"] = round(rss_mb() - rss_before, 1)
+
+    if api:
+        api_server = load_api(output_dir)
+        for mode in modes:
+            print(f"⏱️ {kind} / {mode}: /search")
+            row["api_search"][mode] = bench_api(api_server, golden, mode, k, repeat)
+    return row
+
+
+def run_benchmark(chunks_dir: str = CHUNKS_DIR, kinds: List[str] = INDEX_KINDS, modes: List[str] = SEARCH_MODES,
+                  k: int = 5, repeat: int = 3, api: bool = True, golden_path: str = GOLDEN_PATH) -> Dict:
+    golden = load_golden(golden_path)
+    chunks = load_chunks(chunks_dir)
+    # A regression run must not "pass" on an empty corpus or golden set with recall 0 everywhere
+    if not chunks:
+        raise ValueError(f"No chunks_*.jsonl chunks found in {chunks_dir} (set --chunks-dir or CAFB_OUTPUT_DIR).")
+    if not golden:
+        raise ValueError(f"No golden queries in {golden_path}.")
+    titles = {c.get("title") for c in chunks}
+    if not any(title in titles for g in golden for title in g["relevant_titles"]):
+        raise ValueError(f"None of the golden relevant_titles occur in the {len(chunks)} chunks from {chunks_dir}.")
+    assign_ids(chunks)
+    ids = np.array([c["faiss_id"] for c in chunks], dtype="int64")
+
+    start = time.perf_counter()
+    matrix = hash_embed([c.get("text", "").strip() for c in chunks])
+    embed_s = time.perf_counter() - start
+    query_vectors = hash_embed([g["query"] for g in golden])
+
+    with tempfile.TemporaryDirectory(prefix="cafb_benchmark_") as workdir:
+        store_path = os.path.join(workdir, "faiss_metadata.sqlite")
+        start = time.perf_counter()
+        write_store(chunks, store_path).close()
+        store_s = time.perf_counter() - start
+
+        # api_server appends every request to query_log.jsonl in the working directory
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            rows = [bench_kind(kind, matrix, ids, store_path, workdir, golden, query_vectors, modes, k, repeat, api)
+                    for kind in kinds]
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "embedder": HASH_EMBED_MODEL,
+        "corpus": {"chunks_dir": chunks_dir, "chunks": len(chunks), "dim": int(matrix.shape[1]),
+                   "embed_s": round(embed_s, 3), "store_build_s": round(store_s, 3)},
+        "golden_queries": len(golden),
+        "k": k,
+        "repeat": repeat,
+        "results": rows,
+    }
+
+
+# ----------------------------
+# Report
+# ----------------------------
+def _flatten(report: Dict) -> Dict[tuple, Dict]:
+    return {(r["kind"], path, mode): stats for r in report["results"]
+            for path in ("retrieve", "api_search") for mode, stats in r[path].items()}
+
+
+def print_report(report: Dict, baseline: Optional[Dict] = None):
+    before = _flatten(baseline) if baseline else {}
+    print(f"\n{report['corpus']['chunks']} chunks, {report['golden_queries']} golden queries, k={report['k']}")
+    print(f"{'kind':<10} {'build s':>8} {'load s':>7} {'MB':>7} {'B/vector':>9}")
+    for r in report["results"]:
+        print(f"{r['kind']:<10} {r['build_s']:>8.2f} {r['load_s']:>7.3f} {r['search_rss_mb']:>7.1f} {r['bytes_per_vector']:>9}")
+
+    print(f"\n{'kind':<10} {'path':<11} {'mode':<8} {'recall':>7} {'MRR':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'qps':>8}")
+    for (kind, path, mode), s in _flatten(report).items():
+        line = (f"{kind:<10} {path:<11} {mode:<8} {s['recall_at_k']:>7.4f} {s['mrr']:>7.4f} "
+                f"{s['p50_ms']:>8.3f} {s['p95_ms']:>8.3f} {s['p99_ms']:>8.3f} {s['qps']:>8.1f}")
+        old = before.get((kind, path, mode))
+        if old:
+            line += (f"   Δrecall {s['recall_at_k'] - old['recall_at_k']:+.4f}"
+                     f"  Δp95 {100 * (s['p95_ms'] / old['p95_ms'] - 1):+.0f}%")
+        print(line)
+
+
+# ----------------------------
+# Main
+# ----------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline retrieval latency/quality benchmark over the chunk corpus.")
+    parser.add_argument("--chunks-dir", default=CHUNKS_DIR, help="Folder with chunks_*.jsonl")
+    parser.add_argument("--golden", default=GOLDEN_PATH)
+    parser.add_argument("--kinds", nargs="+", default=list(INDEX_KINDS), choices=INDEX_KINDS)
+    parser.add_argument("--modes", nargs="+", default=list(SEARCH_MODES), choices=SEARCH_MODES)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed passes over the golden queries")
+    parser.add_argument("--no-api", action="store_true", help="Skip the /search handler")
+    parser.add_argument("--out", default=RESULTS_PATH)
+    parser.add_argument("--compare", help="Earlier results file to show deltas against")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.chunks_dir, args.kinds, args.modes, args.k, args.repeat, not args.no_api, args.golden)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"\n📊 Results written to {args.out}")
@@ -1,46 +1,404 @@
-from pathlib import Path
-from typing import List, Dict
+# chunk_utils.py
+# Chunking engine for everything in data/: streamed JSONL parsing, generator output,
+# and a process pool that fans line-aligned shards of the input files out across cores
+
+import os
+import re
 import json
+import argparse
+from collections import deque
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
-def chunk_file(file_path: str) -> List[Dict]:
-    from chunk_utils import (
-        chunk_blog_post, chunk_grant_proposal, chunk_powerpoint,
-        chunk_collateral, chunk_video_captions,
-        chunk_powerpoint_images, chunk_collateral_images
-    )
-
-    file = Path(file_path)
-    doc_id = file.stem
-
-    if file_path.endswith(".jsonl") and "blog" in file.parts:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return [chunk for i, line in enumerate(f) if line.strip()
-                    for chunk in chunk_blog_post(json.loads(line), f"blog_{i:03d}")]
-    
-    elif file_path.endswith(".json") and "grants" in file.parts:
-        with open(file_path, "r") as f:
-            return chunk_grant_proposal(json.load(f), doc_id)
-
-    elif file_path.endswith(".json") and "collateral" in file.parts:
-        with open(file_path, "r") as f:
-            return chunk_collateral(json.load(f), doc_id)
-
-    elif file_path.endswith(".json") and "powerpoint" in file.parts:
-        with open(file_path, "r") as f:
-            return chunk_powerpoint(json.load(f), doc_id)
-
-    elif file_path.endswith(".txt") and "captions" in file.parts:
-        title = file.stem.replace("_", " ")
-        return chunk_video_captions(str(file), title, doc_id)
-
-    elif file_path.endswith(".json") and "ppt_images" in file.parts:
-        with open(file_path, "r") as f:
-            return chunk_powerpoint_images(json.load(f), doc_id)
-
-    elif file_path.endswith(".json") and "collateral_images" in file.parts:
-        with open(file_path, "r") as f:
-            return chunk_collateral_images(json.load(f), doc_id)
+import tiktoken
+
+CHUNK_SIZE = 300
+OVERLAP_SIZE = 150
+SHARD_BYTES = int(os.getenv("CAFB_CHUNK_SHARD_BYTES", str(256 * 1024)))  # input bytes per pool task
+CHUNK_WORKERS = int(os.getenv("CAFB_CHUNK_WORKERS", str(os.cpu_count() or 1)))
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    # Loaded on first use, so the API can import the source registry without tiktoken's download
+    return tiktoken.get_encoding("cl100k_base")
+
+
+# ----------------------------
+# Text helpers
+# ----------------------------
+def clean_text(text: str) -> str:
+    text = text.replace('\n', ' ').replace('\r', ' ')
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def split_into_token_chunks(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = OVERLAP_SIZE) -> List[str]:
+    tokenizer = get_tokenizer()
+    tokens = tokenizer.encode(text)
+    chunks = []
+    for i in range(0, len(tokens), chunk_size - overlap):
+        chunk_tokens = tokens[i:i + chunk_size]
+        chunks.append(tokenizer.decode(chunk_tokens))
+    return chunks
+
+
+def parse_pdf_date(pdf_date: str) -> str:
+    match = re.search(r"D:(\d{4})(\d{2})(\d{2})", pdf_date)
+    if match:
+        return f"{match.group(1)}-{match.group(2)}-{match.group(3)}"
+    return ""
+
+
+def _text_chunks(text: str, source: str, title: str, doc_id: str, date: str) -> List[Dict]:
+    return [{
+        "text": chunk,
+        "source": source,
+        "title": title,
+        "doc_id": doc_id,
+        "chunk_id": i,
+        "date": date
+    } for i, chunk in enumerate(split_into_token_chunks(text))]
+
+
+# ----------------------------
+# Per-document chunkers (one per source type)
+# ----------------------------
+def chunk_blog_post(doc: Dict, doc_id: str) -> List[Dict]:
+    text = clean_text(doc.get("content", ""))
+    return _text_chunks(text, "blog_posts", doc.get("title", f"blog_{doc_id}"), doc_id, doc.get("date", ""))
+
+
+def _pdf_text(doc: Dict) -> str:
+    return clean_text(" ".join(item.get("text", "") for item in doc.get("text_data", [])))
+
+
+def chunk_collateral(doc: Dict, doc_id: str) -> List[Dict]:
+    date = parse_pdf_date(doc.get("metadata", {}).get("CreationDate", ""))
+    return _text_chunks(_pdf_text(doc), "collateral", doc.get("file_name", f"collateral_{doc_id}"), doc_id, date)
+
+
+def chunk_grant_proposal(doc: Dict, doc_id: str) -> List[Dict]:
+    # Grants have always been stored with source "collateral"; their doc ids tell them apart
+    date = parse_pdf_date(doc.get("metadata", {}).get("CreationDate", ""))
+    return _text_chunks(_pdf_text(doc), "collateral", doc.get("file_name", f"grant_{doc_id}"), doc_id, date)
+
+
+def chunk_powerpoint(doc: Dict, doc_id: str) -> List[Dict]:
+    date = doc.get("metadata", {}).get("Created", "")
+    return _text_chunks(_pdf_text(doc), "powerpoints", doc.get("file_name", f"ppt_{doc_id}"), doc_id, date)
+
+
+def chunk_collateral_images(doc: Dict, doc_id: str) -> List[Dict]:
+    image_name = doc.get("image_name", "")
+    source_pdf = doc.get("source_pdf", "")
+    page_number = doc.get("page_number", None)
+    image_type = doc.get("type", "")
+    title = Path(source_pdf).stem.replace("_", " ")
+    text = f"{image_type.title()} from page {page_number} of {title}" if page_number else image_type.title()
+    return [{
+        "text": text,
+        "source": "collateral_image",
+        "title": title,
+        "doc_id": doc_id,
+        "chunk_id": 0,
+        "date": "",
+        "metadata": {
+            "image_name": image_name,
+            "source_pdf": source_pdf,
+            "page_number": page_number,
+            "type": image_type
+        }
+    }]
+
+
+def chunk_powerpoint_images(doc: Dict, doc_id: str) -> List[Dict]:
+    image_name = doc.get("image_name", "")
+    slide_number = doc.get("slide_number", None)
+    original_ppt = doc.get("original_ppt", "")
+    title = Path(original_ppt).stem.replace("_", " ")
+    text = f"Slide {slide_number} image from {title}" if slide_number else "PowerPoint Image"
+    return [{
+        "text": text,
+        "source": "powerpoint_image",
+        "title": title,
+        "doc_id": doc_id,
+        "chunk_id": 0,
+        "date": "",
+        "metadata": {
+            "image_name": image_name,
+            "original_ppt": original_ppt,
+            "slide_number": slide_number
+        }
+    }]
+
+
+# ----------------------------
+# WebVTT captions (YouTube auto-captions: rolling cues with inline <00:00:06.540><c> word timings)
+# ----------------------------
+VTT_TIMESTAMP = re.compile(r"<?(\d{1,2}:)?(\d{2}):(\d{2})[.,](\d{3})>?")
+VTT_CUE_TIMING = re.compile(r"^\s*(\S+)\s+-->\s+(\S+)")
+VTT_TAG = re.compile(r"<[^>]*>")
+VTT_HEADERS = ("WEBVTT", "Kind:", "Language:", "NOTE", "STYLE", "REGION")
+ROLLING_WINDOW = 3  # a rolled-up line reappears within this many emitted lines
+CAPTION_GROUP_SIZE = 5
+YOUTUBE_URL = "https://www.youtube.com/watch?v={video_id}&t={seconds}s"
+
+
+def _vtt_seconds(stamp: str) -> Optional[float]:
+    match = VTT_TIMESTAMP.fullmatch(stamp.strip())
+    if not match:
+        return None
+    hours = int(match.group(1)[:-1]) if match.group(1) else 0
+    return hours * 3600 + int(match.group(2)) * 60 + int(match.group(3)) + int(match.group(4)) / 1000
+
+
+def iter_vtt_segments(vtt_path: str) -> Iterator[Tuple[float, float, str]]:
+    """Stream (start, end, text) caption lines, once each.
+
+    Inline word timings are stripped (and give the line its times when there is no cue header),
+    and the rolled-up repeats of earlier lines are skipped.
+    """
+    cue_start = cue_end = None
+    last_end = 0.0
+    recent = deque(maxlen=ROLLING_WINDOW)
+    with open(vtt_path, "r", encoding="utf-8") as f:
+        for raw in f:
+            line = raw.strip()
+            if not line or line.startswith(VTT_HEADERS):
+                continue
+            timing = VTT_CUE_TIMING.match(line)
+            if timing:
+                cue_start, cue_end = _vtt_seconds(timing.group(1)), _vtt_seconds(timing.group(2))
+                continue
+            stamps = [t for t in (_vtt_seconds(m) for m in re.findall(r"<[\d:.,]+>", line)) if t is not None]
+            text = clean_text(VTT_TAG.sub("", line))
+            if not text or text in recent:
+                continue
+            recent.append(text)
+            start = cue_start if cue_start is not None else last_end if last_end else (stamps[0] if stamps else 0.0)
+            end = max([cue_end or 0.0, start] + stamps)
+            last_end = end
+            yield start, end, text
 
+
+def chunk_video_captions(txt_path: str, title: str, doc_id: str, group_size: int = CAPTION_GROUP_SIZE) -> List[Dict]:
+    chunks, group = [], []
+    for segment in iter_vtt_segments(txt_path):
+        group.append(segment)
+        if len(group) == group_size:
+            chunks.append(group)
+            group = []
+    if group:
+        chunks.append(group)
+
+    return [{
+        "text": " ".join(text for _, _, text in group),
+        "source": "transcript",
+        "title": title,
+        "doc_id": doc_id,
+        "chunk_id": i,
+        "date": "",
+        "metadata": {
+            "start": round(group[0][0], 3),
+            "end": round(group[-1][1], 3),
+            "url": YOUTUBE_URL.format(video_id=doc_id, seconds=int(group[0][0])),
+        }
+    } for i, group in enumerate(chunks)]
+
+
+# ----------------------------
+# Source registry: data file -> (doc id prefix, chunker, output file)
+# Doc ids are "<prefix>_<line number>", matching the ids already in outputs/ and the FAISS index.
+# ----------------------------
+JSONL_SOURCES: Dict[str, Tuple[str, Callable[[Dict, str], List[Dict]], str]] = {
+    "blog_posts.jsonl": ("blog_posts", chunk_blog_post, "chunks_blog.jsonl"),
+    "collateral.jsonl": ("collateral", chunk_collateral, "chunks_collateral.jsonl"),
+    "powerpoints.jsonl": ("powerpoints", chunk_powerpoint, "chunks_powerpoint.jsonl"),
+    "grant_proposals.jsonl": ("grant_proposals", chunk_grant_proposal, "chunks_grants.jsonl"),
+    "collateral-images.jsonl": ("collateral_images", chunk_collateral_images, "chunks_collateral_images.jsonl"),
+    "powerpoints-images.jsonl": ("powerpoint_images", chunk_powerpoint_images, "chunks_ppt_images.jsonl"),
+}
+# Image descriptions go to the images index (image_embedder.py); everything else to the text index
+IMAGE_SOURCES = frozenset({"collateral-images.jsonl", "powerpoints-images.jsonl"})
+CAPTION_DIR = "captions"
+CAPTION_SUFFIXES = (".txt", ".vtt")
+CAPTIONS_OUTPUT = "chunks_captions.jsonl"
+UPLOAD_DIR = "uploads"  # data/uploads: files added through the app's uploader
+
+
+def is_supported(file_path: str) -> bool:
+    """Whether iter_chunks knows how to chunk this file (a registered JSONL source or a caption file)."""
+    path = Path(file_path)
+    return path.name in JSONL_SOURCES or (path.parent.name == CAPTION_DIR and path.suffix in CAPTION_SUFFIXES)
+
+
+def target_index(file_path: str) -> str:
+    """Which published index a data file's chunks belong to: "images" or "text"."""
+    return "images" if Path(file_path).name in IMAGE_SOURCES else "text"
+
+
+def doc_file(chunk: Dict, data_folder: str) -> Optional[str]:
+    """The data file a chunk was cut from, worked out from its doc_id (the inverse of the ids
+    iter_chunks assigns). None when it can't be attributed."""
+    doc_id = chunk.get("doc_id") or ""
+    if chunk.get("source") == "transcript":  # captions: doc_id is the caption file's stem
+        for suffix in CAPTION_SUFFIXES:
+            path = os.path.join(data_folder, CAPTION_DIR, doc_id + suffix)
+            if os.path.exists(path):
+                return path
+        return None
+    prefix, folder = doc_id.rsplit("_", 1)[0], data_folder
+    if prefix.startswith(f"{UPLOAD_DIR}_"):
+        prefix, folder = prefix[len(UPLOAD_DIR) + 1:], os.path.join(data_folder, UPLOAD_DIR)
+    for name, (source_prefix, _, _) in JSONL_SOURCES.items():
+        if source_prefix == prefix:
+            return os.path.join(folder, name)
+    return None
+
+
+def jsonl_source(file_path: str) -> Tuple[str, Callable[[Dict, str], List[Dict]]]:
+    """(doc id prefix, chunker) for a registered JSONL file. An upload named like a corpus file
+    (data/uploads/blog_posts.jsonl) gets its own prefix, so its chunk ids can't overwrite the corpus's."""
+    path = Path(file_path)
+    prefix, chunk_fn, _ = JSONL_SOURCES[path.name]
+    if path.parent.name == UPLOAD_DIR:
+        prefix = f"{UPLOAD_DIR}_{prefix}"
+    return prefix, chunk_fn
+
+
+# ----------------------------
+# Streaming: one document (JSONL line / caption file) in memory at a time
+# ----------------------------
+def _iter_jsonl_range(file_path: str, start: int = 0, end: Optional[int] = None,
+                      first_index: int = 0) -> Iterator[Tuple[int, Dict]]:
+    """(document index, document) for the non-empty lines in bytes [start, end)."""
+    index = first_index
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield index, json.loads(line)
+                index += 1
+
+
+def _iter_shard_chunks(file_path: str, start: int = 0, end: Optional[int] = None,
+                       first_index: int = 0) -> Iterator[Dict]:
+    prefix, chunk_fn = jsonl_source(file_path)
+    for index, doc in _iter_jsonl_range(file_path, start, end, first_index):
+        yield from chunk_fn(doc, f"{prefix}_{index:03d}")
+
+
+def iter_chunks(file_path: str) -> Iterator[Dict]:
+    """Yield the chunks of one data file without loading the whole file."""
+    path = Path(file_path)
+    if path.name in JSONL_SOURCES:
+        yield from _iter_shard_chunks(file_path)
+    elif path.parent.name == CAPTION_DIR and path.suffix in CAPTION_SUFFIXES:
+        yield from chunk_video_captions(str(path), path.stem.replace("_", " "), path.stem)
     else:
         print(f"⚠️ Unsupported file for chunking: {file_path}")
-        return []
+
+
+def chunk_file(file_path: str) -> List[Dict]:
+    return list(iter_chunks(file_path))
+
+
+# ----------------------------
+# Parallel full rechunk
+# ----------------------------
+def _jsonl_shards(file_path: str, shard_bytes: int = SHARD_BYTES) -> Iterator[Tuple[int, int, int]]:
+    """Split a JSONL file at line boundaries into ~shard_bytes pieces: (start, end, first doc index).
+    Only newlines are scanned here; documents are parsed in the workers."""
+    start = offset = docs = 0
+    first_index = 0
+    with open(file_path, "rb") as f:
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                docs += 1
+            if offset - start >= shard_bytes:
+                yield start, offset, first_index
+                start, first_index = offset, docs
+    if offset > start:
+        yield start, offset, first_index
+
+
+def _run_task(task: Tuple) -> List[Dict]:
+    kind, file_path, *args = task
+    if kind == "jsonl":
+        return list(_iter_shard_chunks(file_path, *args))
+    return chunk_file(file_path)
+
+
+def _tasks(data_folder: str) -> Iterator[Tuple[str, Tuple]]:
+    """(output file, task) in output order; tasks for the same output are contiguous."""
+    data = Path(data_folder)
+    for name in JSONL_SOURCES:
+        if (data / name).exists():
+            for shard in _jsonl_shards(str(data / name)):
+                yield JSONL_SOURCES[name][2], ("jsonl", str(data / name), *shard)
+    captions = data / CAPTION_DIR
+    if captions.is_dir():
+        for path in sorted(p for p in captions.iterdir() if p.suffix in CAPTION_SUFFIXES):
+            yield CAPTIONS_OUTPUT, ("file", str(path))
+
+
+def chunk_all(data_folder: str, output_folder: str, workers: int = CHUNK_WORKERS) -> Dict[str, int]:
+    """Rechunk every source in `data_folder` into `output_folder`/chunks_*.jsonl.
+
+    Shards are chunked in a process pool and written in input order as they complete, with at most
+    2 x workers shards in flight, so memory stays bounded however large the inputs are. Each output
+    is written to a temp file and renamed when complete.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    out_dir = Path(output_folder)
+    counts: Dict[str, int] = {}
+    handles = {}
+    tasks = _tasks(data_folder)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for out_name, task in tasks:
+                pending.append((out_name, pool.submit(_run_task, task)))
+                if len(pending) >= 2 * workers:
+                    _write_result(*pending.popleft(), out_dir, handles, counts)
+            while pending:
+                _write_result(*pending.popleft(), out_dir, handles, counts)
+    except BaseException:
+        for out_name, handle in handles.items():
+            handle.close()
+            os.remove(out_dir / f"{out_name}.tmp")
+        raise
+    for out_name, handle in handles.items():
+        handle.close()
+        os.replace(out_dir / f"{out_name}.tmp", out_dir / out_name)
+        print(f"Saved {counts[out_name]} chunks to {out_dir / out_name}")
+    return counts
+
+
+def _write_result(out_name: str, future, out_dir: Path, handles: Dict, counts: Dict[str, int]):
+    if out_name not in handles:
+        handles[out_name] = open(out_dir / f"{out_name}.tmp", "w", encoding="utf-8")
+        counts[out_name] = 0
+    chunks = future.result()
+    for chunk in chunks:
+        handles[out_name].write(json.dumps(chunk) + "\n")
+    counts[out_name] += len(chunks)
+
+
+# ----------------------------
+# Main: full rechunk of data/ into outputs/
+# ----------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunk every source in the data folder.")
+    parser.add_argument("--data", default="/Users/sharvari/Downloads/CAFB_Challenge/data")
+    parser.add_argument("--outputs", default="/Users/sharvari/Downloads/CAFB_Challenge/outputs")
+    parser.add_argument("--workers", type=int, default=CHUNK_WORKERS)
+    args = parser.parse_args()
+
+    chunk_all(args.data, args.outputs, args.workers)
@@ -0,0 +1,111 @@
+# context_builder.py
+# Pack retrieved chunks into a token budget for the generation prompt
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import tiktoken
+
+CONTEXT_TOKENS = int(os.getenv("CAFB_CONTEXT_TOKENS", "2000"))       # prompt tokens spent on retrieved context
+MIN_PARTIAL_TOKENS = int(os.getenv("CAFB_CONTEXT_MIN_PARTIAL", "64"))  # don't add a truncated chunk shorter than this
+DUPLICATE_JACCARD = float(os.getenv("CAFB_CONTEXT_DUP_JACCARD", "0.8"))
+TOKEN_CACHE_SIZE = int(os.getenv("CAFB_CONTEXT_TOKEN_CACHE", "8192"))  # chunks whose tokenization is kept
+SEPARATOR = "\n\n"
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    # gpt-4 / gpt-4o-mini family; the count only has to match the chat model closely enough to budget.
+    # Loaded on first use, so importing retrieval code doesn't need tiktoken's download.
+    return tiktoken.get_encoding("cl100k_base")
+
+# Boilerplate that image_embedder.load_image_chunks wraps around every image's page/slide context
+IMAGE_BOILERPLATE = re.compile(
+    r"^This image was extracted from (?P<where>.+?), a file related to the Capital Area Food Bank\. "
+    r"The content of this visual may include themes like [^.]*\. Page/slide context: ",
+    re.DOTALL,
+)
+_SENTENCE_END = re.compile(r"[.!?][\"')\]]?\s")
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def chunk_tokens(text: str) -> Tuple[int, ...]:
+    """Token ids for a chunk's context text; chunks recur across requests, so this is cached."""
+    return tuple(get_tokenizer().encode(text, disallowed_special=()))
+
+
+def context_text(chunk: Dict) -> str:
+    text = (chunk.get("text") or "").strip()
+    match = IMAGE_BOILERPLATE.match(text)
+    if match:
+        text = f"Image from {match.group('where')}: {text[match.end():]}"
+    return text
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def _shingles(text: str, n: int = 3) -> frozenset:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < n:
+        return frozenset([" ".join(words)])
+    return frozenset(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+
+
+def _is_near_duplicate(shingles: frozenset, kept: List[frozenset], threshold: float) -> bool:
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= threshold:
+            return True
+    return False
+
+
+def _truncate(tokens: Tuple[int, ...], limit: int) -> str:
+    # Cut at the last sentence end that fits, so the prompt doesn't stop mid-sentence
+    text = get_tokenizer().decode(list(tokens[:limit]))
+    ends = list(_SENTENCE_END.finditer(text))
+    return text[:ends[-1].end()].strip() if ends else text.strip()
+
+
+def pack_context(chunks: List[Dict], budget: int = CONTEXT_TOKENS,
+                 duplicate_threshold: float = DUPLICATE_JACCARD) -> Tuple[str, List[Dict]]:
+    """Fill `budget` tokens with chunks in the order given (most relevant first).
+
+    Near-duplicates of an already chosen chunk (word 3-gram Jaccard >= threshold) are skipped, a chunk
+    that doesn't fit is skipped in favour of smaller later ones, and the space left at the end goes to the
+    most relevant skipped chunk, cut at a sentence boundary. Returns the context string and the chunks
+    it uses (a cut chunk always comes last).
+    """
+    separator_tokens = len(chunk_tokens(SEPARATOR))
+    parts, used, kept_shingles, oversized = [], [], [], []
+    remaining = budget
+    for chunk in chunks:
+        text = context_text(chunk)
+        if not text:
+            continue
+        shingles = _shingles(text)
+        if _is_near_duplicate(shingles, kept_shingles, duplicate_threshold):
+            continue
+        cost = separator_tokens if parts else 0
+        tokens = chunk_tokens(text)
+        if len(tokens) + cost > remaining:
+            oversized.append((chunk, shingles, tokens))  # may still fill the tail, cut short
+            continue
+        parts.append(text)
+        remaining -= len(tokens) + cost
+        used.append(chunk)
+        kept_shingles.append(shingles)
+        if remaining < MIN_PARTIAL_TOKENS:
+            break
+
+    # Whatever space is left goes to the most relevant chunk that didn't fit whole, cut at a sentence end
+    cost = separator_tokens if parts else 0
+    if remaining - cost >= MIN_PARTIAL_TOKENS:
+        for chunk, shingles, tokens in oversized:
+            if _is_near_duplicate(shingles, kept_shingles, duplicate_threshold):
+                continue
+            partial = _truncate(tokens, remaining - cost)
+            if partial:
+                parts.append(partial)
+                used.append(chunk)
+                break
+    return SEPARATOR.join(parts), used
@@ -4,18 +4,10 @@ import faiss
 import numpy as np
 from typing import List, Dict
 from pathlib import Path
-import ollama
-from openai import OpenAI
-from tqdm import tqdm
-from dotenv import load_dotenv
-
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-
-
-EMBEDDING_DIM = 1536
-BATCH_SIZE = 32
+from embedding_engine import embed_texts_tagged, usable_embeddings, write_retry_queue, EMBEDDING_DIM
+from index_factory import build_index, describe_index, assign_ids
+from metadata_store import write_store
+from snapshots import begin_snapshot, publish_snapshot, writer_lock
 
 
 
@@ -39,26 +31,15 @@ def load_chunks(folder_path: str, filter_source: str = None, include_images: boo
 
 
 # ----------------------------
-# Embed using OpenAI (batched) → Ollama fallback (per chunk)
+# Embed using OpenAI (token-sized batches, concurrent) → Ollama fallback (per chunk)
 # ----------------------------
-def embed_chunks(chunks: List[Dict], model_name: str = "nomic-embed-text") -> List[List[float]]:
-    embeddings = []
-    for i in tqdm(range(0, len(chunks), BATCH_SIZE), desc="Embedding text chunks"):
-        batch = chunks[i:i + BATCH_SIZE]
-        texts = [c.get("text", "").strip() for c in batch]
-        try:
-            response = client.embeddings.create(input=texts, model="text-embedding-3-small")
-            for j in range(len(batch)):
-                embeddings.append(response.data[j].embedding)
-        except Exception as e:
-            print(f"OpenAI batch failed: {e}. Falling back to Ollama per chunk.")
-            for text in texts:
-                try:
-                    response = ollama.embeddings(model=model_name, prompt=text)
-                    embeddings.append(response["embedding"])
-                except Exception as ollama_e:
-                    print(f"Ollama failed: {ollama_e}. Using zero vector.")
-                    embeddings.append([0.0] * EMBEDDING_DIM)
+def embed_chunks(chunks: List[Dict], model_name: str = "nomic-embed-text", use_cache: bool = True) -> np.ndarray:
+    """Embed chunks, tagging each with the model that produced its vector (None if embedding failed)."""
+    texts = [c.get("text", "").strip() for c in chunks]
+    embeddings, models = embed_texts_tagged(texts, model_name=model_name, desc="Embedding text chunks",
+                                            use_cache=use_cache)
+    for chunk, model in zip(chunks, models):
+        chunk["embedding_model"] = model
     return embeddings
 
 
@@ -67,14 +48,18 @@ def embed_chunks(chunks: List[Dict], model_name: str = "nomic-embed-text") -> Li
 # Save FAISS index + metadata
 # ----------------------------
 
-def save_index(embeddings: List[List[float]], chunks: List[Dict], index_path: str, metadata_path: str):
-    embedding_matrix = np.array(embeddings).astype("float32")
-    index = faiss.IndexFlatL2(EMBEDDING_DIM)
-    index.add(embedding_matrix)
+def save_index(embeddings: np.ndarray, chunks: List[Dict], index_path: str, metadata_path: str,
+               retry_path: str = None):
+    assign_ids(chunks)
+    # Only primary-model vectors are indexed; the other chunks stay in the metadata store
+    # (so lexical search still finds them) and are queued to be embedded again
+    embedding_matrix, kept, rejected = usable_embeddings(chunks, embeddings)
+    index = build_index(embedding_matrix, ids=np.array([c["faiss_id"] for c in kept], dtype="int64"))
     faiss.write_index(index, index_path)
-    with open(metadata_path, 'w') as f:
-        json.dump(chunks, f)
-    print(f"✅ Saved FAISS text index and metadata ({len(chunks)} chunks).")
+    write_store(chunks, metadata_path)
+    if retry_path:
+        write_retry_queue(retry_path, rejected)
+    print(f"✅ Saved FAISS text index [{describe_index(index)}] with {len(kept)} vectors and metadata ({len(chunks)} chunks).")
 
 
 
@@ -82,10 +67,18 @@ def save_index(embeddings: List[List[float]], chunks: List[Dict], index_path: st
 # Main
 # ----------------------------
 if __name__ == "__main__":
-    chunks = load_chunks("/Users/sharvari/Downloads/CAFB_Challenge/outputs")
+    output_dir = "/Users/sharvari/Downloads/CAFB_Challenge/outputs"
+    lock = writer_lock(output_dir)  # the ingestion worker's update_pipeline.py runs also rewrite the manifest
+    chunks = load_chunks(output_dir)
     embeddings = embed_chunks(chunks)
-    save_index(embeddings, chunks, "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index.index",
-                "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata.json")
+
+    # Write into a fresh snapshot folder; running API servers pick it up once the manifest is published
+    version, snapshot_dir = begin_snapshot(output_dir)
+    index_path = os.path.join(snapshot_dir, "faiss_index.index")
+    metadata_path = os.path.join(snapshot_dir, "faiss_metadata.sqlite")
+    save_index(embeddings, chunks, index_path, metadata_path,
+               retry_path=os.path.join(output_dir, "embedding_retry_text.jsonl"))
+    publish_snapshot(output_dir, version, {"text": (index_path, metadata_path)})
 
 
 
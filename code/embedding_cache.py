@@ -0,0 +1,128 @@
+# embedding_cache.py
+# Persistent on-disk embedding cache keyed by (model name, normalized text hash)
+
+import os
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from typing import List, Optional
+
+import numpy as np
+
+CACHE_PATH = os.getenv("CAFB_EMBED_CACHE",
+                       os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "outputs", "embedding_cache.sqlite"))
+CACHE_MAX_BYTES = int(os.getenv("CAFB_EMBED_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+CACHE_DTYPE = os.getenv("CAFB_EMBED_CACHE_DTYPE", "float16")  # "float16" or "float32"
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha1(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# ----------------------------
+# SQLite-backed cache with LRU eviction by total size
+# ----------------------------
+class EmbeddingCache:
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = CACHE_MAX_BYTES, dtype: str = CACHE_DTYPE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, model TEXT, dtype TEXT, vector BLOB, nbytes INTEGER, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        # Running byte total kept by triggers, so eviction checks are O(1) instead of a SUM over the
+        # table, and stay exact while several processes share the file. REPLACE only fires the delete
+        # trigger with recursive_triggers on.
+        self._conn.execute("PRAGMA recursive_triggers = ON")
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER)")
+        self._conn.execute("INSERT OR IGNORE INTO cache_size SELECT 0, COALESCE(SUM(nbytes), 0) FROM embeddings")
+        self._conn.execute("CREATE TRIGGER IF NOT EXISTS embeddings_added AFTER INSERT ON embeddings "
+                           "BEGIN UPDATE cache_size SET total = total + NEW.nbytes WHERE id = 0; END")
+        self._conn.execute("CREATE TRIGGER IF NOT EXISTS embeddings_removed AFTER DELETE ON embeddings "
+                           "BEGIN UPDATE cache_size SET total = total - OLD.nbytes WHERE id = 0; END")
+        self._conn.execute("COMMIT")
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Return cached float32 vectors in input order, None for misses."""
+        keys = [cache_key(model, t) for t in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = list(set(keys[i:i + 500]))
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, dtype, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=dtype).astype("float32")
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, k) for k in found])
+        return [found.get(k) for k in keys]
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        now = time.time()
+        rows = []
+        for text, vec in zip(texts, vectors):
+            blob = np.asarray(vec, dtype=self.dtype).tobytes()
+            rows.append((cache_key(model, text), model, self.dtype.name, blob, len(blob), now))
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+            self._evict()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until we are back under 90% of the budget
+        excess = total - int(self.max_bytes * 0.9)
+        cursor = self._conn.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used ASC")
+        stale = []
+        for key, nbytes in cursor:
+            stale.append((key,))
+            excess -= nbytes
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", stale)
+        print(f"🧹 Evicted {len(stale)} cached embeddings (cache limit {self.max_bytes} bytes).")
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self._conn.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+        return {"entries": count, "bytes": total, "max_bytes": self.max_bytes, "dtype": self.dtype.name}
+
+
+_default_cache: Optional[EmbeddingCache] = None
+_default_lock = threading.Lock()
+
+
+def get_cache() -> Optional[EmbeddingCache]:
+    """Process-wide cache, or None when disabled with CAFB_EMBED_CACHE=off."""
+    global _default_cache
+    if CACHE_PATH.lower() in ("", "off", "none"):
+        return None
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+    return _default_cache
@@ -0,0 +1,279 @@
+# embedding_engine.py
+# Shared embedding engine: token-sized batches, several requests in flight, 429 backoff
+
+import os
+import re
+import json
+import time
+import random
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple, Optional
+
+import numpy as np
+import ollama
+import tiktoken
+from openai import OpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from tqdm import tqdm
+from dotenv import load_dotenv
+from embedding_cache import get_cache
+
+load_dotenv()
+# Retries are handled below so every worker backs off together.
+# OPENAI_BASE_URL / OLLAMA_HOST can point both clients at a local stub server.
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+EMBEDDING_DIM = 1536
+OPENAI_EMBED_MODEL = "text-embedding-3-small"
+MAX_TOKENS_PER_BATCH = int(os.getenv("CAFB_EMBED_BATCH_TOKENS", "16000"))
+MAX_TEXTS_PER_BATCH = int(os.getenv("CAFB_EMBED_BATCH_TEXTS", "256"))
+MAX_IN_FLIGHT = int(os.getenv("CAFB_EMBED_WORKERS", "4"))
+MAX_RETRIES = int(os.getenv("CAFB_EMBED_RETRIES", "5"))
+MAX_EMBED_ATTEMPTS = int(os.getenv("CAFB_EMBED_MAX_ATTEMPTS", "3"))  # pipeline runs before a chunk stays lexical-only
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    # Loaded on first use rather than at import: tiktoken fetches the encoding over the network the
+    # first time, and importing this module (benchmarks, the API) shouldn't need that
+    return tiktoken.get_encoding("cl100k_base")
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+# ----------------------------
+# Token-aware batching
+# ----------------------------
+def is_embeddable(text: str) -> bool:
+    # Empty or punctuation-only texts carry nothing to embed (and come back as zero vectors)
+    return bool(re.search(r"\w", text or ""))
+
+
+def is_usable_vector(vec) -> bool:
+    """A primary-model-sized vector that is finite and non-zero (anything else must not be indexed or cached)."""
+    if vec is None or len(vec) != EMBEDDING_DIM:
+        return False
+    vec = np.asarray(vec, dtype="float32")
+    squared_norm = float(np.dot(vec, vec))
+    return np.isfinite(squared_norm) and squared_norm > 0
+
+
+def count_tokens(text: str) -> int:
+    return len(get_tokenizer().encode(text, disallowed_special=()))
+
+
+def make_batches(texts: List[str],
+                 max_tokens: int = MAX_TOKENS_PER_BATCH,
+                 max_texts: int = MAX_TEXTS_PER_BATCH) -> List[Tuple[int, int]]:
+    """Split texts into contiguous (start, end) ranges that stay under the token budget."""
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        n = count_tokens(text)
+        if i > start and (tokens + n > max_tokens or i - start >= max_texts):
+            batches.append((start, i))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+# ----------------------------
+# Shared rate-limit gate
+# ----------------------------
+class RateLimitGate:
+    """When any worker hits a 429, every worker waits out the same cooldown."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def backoff(self, delay: float):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            pass
+    return min(BACKOFF_BASE * (2 ** attempt), BACKOFF_MAX) * (1 + random.random() * 0.25)
+
+
+# ----------------------------
+# Embed one batch (OpenAI with backoff -> Ollama per text -> None)
+# ----------------------------
+def _embed_with_ollama(texts: List[str], model_name: str) -> List[Optional[List[float]]]:
+    embeddings = []
+    for text in texts:
+        try:
+            response = ollama.embeddings(model=model_name, prompt=text)
+            embeddings.append(response["embedding"])
+        except Exception as ollama_e:
+            # No zero-vector placeholder: it would be indexed and match every query equally
+            print(f"Ollama failed: {ollama_e}. Leaving the chunk unembedded.")
+            embeddings.append(None)
+    return embeddings
+
+
+def embed_batch(texts: List[str], model_name: str = "nomic-embed-text",
+                gate: Optional[RateLimitGate] = None) -> Tuple[List[Optional[List[float]]], str]:
+    """Return (vectors, model that produced them). A vector is None when every provider failed."""
+    gate = gate or RateLimitGate()
+    for attempt in range(MAX_RETRIES + 1):
+        gate.wait()
+        try:
+            response = client.embeddings.create(input=texts, model=OPENAI_EMBED_MODEL)
+            return [d.embedding for d in sorted(response.data, key=lambda d: d.index)], OPENAI_EMBED_MODEL
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                print(f"OpenAI batch failed after {MAX_RETRIES} retries: {e}. Falling back to Ollama per chunk.")
+                break
+            delay = _retry_delay(e, attempt)
+            if isinstance(e, RateLimitError):
+                gate.backoff(delay)
+            else:
+                time.sleep(delay)
+        except Exception as e:
+            print(f"OpenAI batch failed: {e}. Falling back to Ollama per chunk.")
+            break
+    return _embed_with_ollama(texts, model_name), model_name
+
+
+# ----------------------------
+# Embed many texts concurrently, preserving input order
+# ----------------------------
+def embed_texts_tagged(texts: List[str], model_name: str = "nomic-embed-text",
+                       max_workers: int = MAX_IN_FLIGHT, desc: str = "Embedding chunks",
+                       use_cache: bool = True) -> Tuple[np.ndarray, List[Optional[str]]]:
+    """Return (float32 matrix with one row per text, model that produced each row).
+
+    Vectors are written into the preallocated matrix as batches complete instead of being kept as
+    Python float lists and converted afterwards (which held every embedding twice, ~6x the memory).
+    Rows whose embedding failed, or came back in another dimension (Ollama), stay zero, and so do
+    empty or punctuation-only texts, which are never sent. Only usable vectors are written to the
+    cache, so a bad result is asked for again instead of being replayed; pass use_cache=False to
+    skip the cache entirely (retries).
+    """
+    embeddings = np.zeros((len(texts), EMBEDDING_DIM), dtype="float32")
+    models: List[Optional[str]] = [None] * len(texts)
+    if not texts:
+        return embeddings, models
+
+    def store(row: int, vec, producer: Optional[str]):
+        models[row] = producer if vec is not None else None
+        if vec is not None and len(vec) == EMBEDDING_DIM:
+            embeddings[row] = vec
+
+    # Only texts missing from the cache are sent to the provider
+    cache = get_cache() if use_cache else None
+    pending = [i for i, text in enumerate(texts) if is_embeddable(text)]
+    if len(pending) < len(texts):
+        print(f"🚫 Skipping {len(texts) - len(pending)} empty or punctuation-only texts.")
+    if cache is not None and pending:
+        cached = cache.get_many(OPENAI_EMBED_MODEL, [texts[i] for i in pending])
+        for row, vec in zip(pending, cached):
+            if is_usable_vector(vec):  # entries written before bad vectors were filtered count as misses
+                store(row, vec, OPENAI_EMBED_MODEL)
+        reused = sum(1 for i in pending if models[i] is not None)
+        pending = [i for i in pending if models[i] is None]
+        if reused:
+            print(f"♻️ Reused {reused} cached embeddings, embedding {len(pending)} new texts.")
+    if not pending:
+        return embeddings, models
+
+    pending_texts = [texts[i] for i in pending]
+    batches = make_batches(pending_texts)
+    gate = RateLimitGate()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(embed_batch, pending_texts[start:end], model_name, gate): (start, end)
+                   for start, end in batches}
+        for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            start, end = futures[future]
+            vectors, producer = future.result()
+            for offset, vec in enumerate(vectors):
+                store(pending[start + offset], vec, producer)
+            if cache is not None and producer == OPENAI_EMBED_MODEL:
+                good = [(text, vec) for text, vec in zip(pending_texts[start:end], vectors) if is_usable_vector(vec)]
+                if good:
+                    cache.put_many(producer, [text for text, _ in good], [vec for _, vec in good])
+    return embeddings, models
+
+
+def embed_texts(texts: List[str], model_name: str = "nomic-embed-text",
+                max_workers: int = MAX_IN_FLIGHT, desc: str = "Embedding chunks",
+                use_cache: bool = True) -> np.ndarray:
+    return embed_texts_tagged(texts, model_name, max_workers, desc, use_cache)[0]
+
+
+# ----------------------------
+# Embedding hygiene: only primary-model vectors go into an index, the rest wait for a (capped) retry
+# ----------------------------
+def usable_embeddings(chunks: List[Dict], embeddings: np.ndarray) -> Tuple[np.ndarray, List[Dict], List[Dict]]:
+    """Split chunks (tagged with "embedding_model") into (matrix, kept chunks, rejected chunks).
+
+    Ollama vectors live in a different space (and dimension) than OpenAI's, and zero vectors
+    would match every query equally, so both are kept out of the index. When every chunk is
+    usable the engine's buffer is returned as is, without a copy.
+    """
+    matrix = np.asarray(embeddings, dtype="float32").reshape(-1, EMBEDDING_DIM)
+    squared_norms = np.einsum("ij,ij->i", matrix, matrix)  # NaN/inf propagate, zero rows give 0
+    usable = np.isfinite(squared_norms) & (squared_norms > 0)
+    usable &= np.array([c.get("embedding_model") == OPENAI_EMBED_MODEL for c in chunks], dtype=bool)
+    kept = [c for c, ok in zip(chunks, usable) if ok]
+    rejected = [c for c, ok in zip(chunks, usable) if not ok]
+    if rejected:
+        matrix = matrix[usable]
+        print(f"⚠️ {len(rejected)} chunks have no usable {OPENAI_EMBED_MODEL} embedding.")
+    return matrix, kept, rejected
+
+
+def load_retry_queue(path: str) -> List[Dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_retry_queue(path: str, chunks: List[Dict], max_attempts: int = MAX_EMBED_ATTEMPTS) -> List[Dict]:
+    """Replace the queue with the `chunks` still worth retrying; returns what was queued.
+
+    Each queued chunk counts its failed attempts ("embed_attempts"). Chunks with nothing to embed,
+    or that have failed `max_attempts` times, are dropped: they stay in the metadata store, so
+    lexical search still finds them, but stop forcing a re-embed and a new snapshot on every run.
+    An empty queue removes the file.
+    """
+    queued, given_up = [], 0
+    for chunk in chunks:
+        attempts = chunk.get("embed_attempts", 0) + 1
+        if not is_embeddable(chunk.get("text", "")) or attempts >= max_attempts:
+            given_up += 1
+        else:
+            queued.append({**chunk, "embed_attempts": attempts})
+    if given_up:
+        print(f"🔤 {given_up} chunks left lexical-only (nothing to embed, or failed {max_attempts} times).")
+    if queued:
+        print(f"🔁 {len(queued)} chunks queued for an embedding retry.")
+    if not queued:
+        if os.path.exists(path):
+            os.remove(path)
+        return queued
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for chunk in queued:
+            f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    return queued
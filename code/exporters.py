@@ -0,0 +1,134 @@
+# exporters.py
+# Render generated text as downloadable PDF / DOCX / TXT / PPTX files, memoized by content hash and format
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from fpdf import FPDF
+from docx import Document
+from pptx import Presentation
+
+EXPORT_CACHE_BYTES = int(os.getenv("CAFB_EXPORT_CACHE_BYTES", str(64 * 1024 * 1024)))  # 0 disables
+
+
+# ----------------------------
+# Renderers (module-level so a process pool can run them)
+# ----------------------------
+def render_pdf(text: str) -> bytes:
+    # Replace Unicode "smart" characters with ASCII equivalents; FPDF's core fonts are latin-1 only
+    replacements = {
+        "\u2018": "'",  # Left single quotation mark
+        "\u2019": "'",  # Right single quotation mark
+        "\u201c": '"',  # Left double quotation mark
+        "\u201d": '"',  # Right double quotation mark
+        "\u2013": "-",  # En dash
+        "\u2014": "-",  # Em dash
+    }
+    for old, new in replacements.items():
+        text = text.replace(old, new)
+
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.set_font("Arial", size=12)
+    for line in text.split("\n"):
+        pdf.multi_cell(0, 10, line)
+    # Drop any remaining characters latin-1 can't encode
+    return pdf.output(dest='S').encode('latin-1', errors='ignore')
+
+
+def render_txt(text: str) -> bytes:
+    return text.encode('utf-8')
+
+
+def render_docx(text: str) -> bytes:
+    doc = Document()
+    for line in text.split("\n"):
+        doc.add_paragraph(line)
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def render_pptx(text: str) -> bytes:
+    prs = Presentation()
+    blocks = text.strip().split("\n\n")
+    for i, block in enumerate(blocks):
+        lines = [line.strip() for line in block.split("\n") if line.strip()]
+        if not lines:
+            continue
+        slide = prs.slides.add_slide(prs.slide_layouts[1])
+        # Use title from line 1 or generate default if no colon is found
+        title = lines[0] if ":" in lines[0] else f"Slide {i+1}"
+        slide.shapes.title.text = title.replace("Slide Title:", "").strip()
+        # Use remaining lines as slide content
+        bullets = "\n".join(line.strip("-• ") for line in lines[1:] or lines)
+        slide.placeholders[1].text = bullets
+    buffer = BytesIO()
+    prs.save(buffer)
+    return buffer.getvalue()
+
+
+class ExportFormat(NamedTuple):
+    extension: str
+    mime_type: str
+    render: Callable[[str], bytes]
+
+
+EXPORT_FORMATS: Dict[str, ExportFormat] = {
+    "PDF": ExportFormat(".pdf", "application/pdf", render_pdf),
+    "DOCX": ExportFormat(".docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", render_docx),
+    "TXT": ExportFormat(".txt", "text/plain", render_txt),
+    "PPTX": ExportFormat(".pptx", "application/vnd.openxmlformats-officedocument.presentationml.presentation", render_pptx),
+}
+
+
+def render(text: str, fmt: str) -> bytes:
+    return EXPORT_FORMATS[fmt].render(text)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# ----------------------------
+# Rendered files, LRU by total size
+# ----------------------------
+class ExportCache:
+    """Unchanged text exported again (another click, another format round trip) is served from memory."""
+
+    def __init__(self, max_bytes: int = EXPORT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._bytes = 0
+        self.hits = self.misses = 0
+
+    def get(self, digest: str, fmt: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get((digest, fmt))
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end((digest, fmt))
+            return data
+
+    def put(self, digest: str, fmt: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop((digest, fmt), None)
+            self._bytes -= len(old) if old is not None else 0
+            self._entries[(digest, fmt)] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)  # least recently used
+                self._bytes -= len(evicted)
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self._bytes}
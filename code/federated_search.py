@@ -0,0 +1,80 @@
+# federated_search.py
+# One ranked list from any number of named indexes: parallel search, comparable scores, no duplicates
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from metadata_store import ChunkFilter
+from retrieval_script import rank_batch, to_results, RRF_K
+
+OVERFETCH = int(os.getenv("CAFB_FEDERATED_OVERFETCH", "2"))  # each index returns k * this, so dropped duplicates don't leave the list short
+
+
+class SearchTarget(NamedTuple):
+    name: str       # e.g. "text", "images"; copied onto each result as "index"
+    index: Any
+    metadata: Any
+
+
+# (results per query, scorer per query) for one target, scores not yet normalized
+TargetResults = Tuple[List[List[Dict]], List[str]]
+
+
+def search_target(target: SearchTarget, query_vectors, queries: List[str], k: int = 5, mode: str = "dense",
+                  nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                  chunk_filter: Optional[ChunkFilter] = None) -> TargetResults:
+    ranked, scorers = rank_batch(target.index, target.metadata, query_vectors, queries, k * OVERFETCH,
+                                 mode, nprobe, ef_search, chunk_filter)
+    results = to_results(target.metadata, ranked, digits=None)
+    return [[{**r, "index": target.name} for r in row] for row in results], scorers
+
+
+def normalized_score(score: float, scorer: str, lexical_max: float) -> float:
+    if scorer == "lexical":
+        # BM25 has no fixed range; scale by the query's best match across all indexes
+        return score / lexical_max
+    if scorer == "hybrid":
+        # Ranked first by both dense and BM25 = 1.0
+        return score * (RRF_K + 1) / 2.0
+    # Cosine similarity: already comparable between indexes built with the same embedding model
+    return score
+
+
+def fuse(per_target: List[TargetResults], k: int) -> List[List[Dict]]:
+    """Merge each query's results from every target into one top-k list, best first.
+
+    A chunk found twice (same id in the same index, or same title and opening text, e.g. an image
+    extracted from several decks) is kept once, at its best score. Ids are only unique within one
+    index (legacy stores use positions), so equal ids from different indexes are different chunks."""
+    if not per_target:
+        return []
+    fused = []
+    for row in range(len(per_target[0][0])):
+        candidates = [(r, scorers[row]) for results, scorers in per_target for r in results[row]]
+        lexical_max = max((r["score"] for r, scorer in candidates if scorer == "lexical"), default=0.0) or 1.0
+        scored = sorted(((normalized_score(r["score"], scorer, lexical_max), r) for r, scorer in candidates),
+                        key=lambda item: item[0], reverse=True)
+        merged, seen = [], set()
+        for score, r in scored:
+            keys = {("id", r["index"], r["id"])}
+            if r["text"].strip():
+                keys.add(("content", r["title"], r["text"][:100]))
+            if keys & seen:
+                continue
+            seen |= keys
+            merged.append({**r, "score": round(score, 4)})
+            if len(merged) == k:
+                break
+        fused.append(merged)
+    return fused
+
+
+def federated_search(targets: List[SearchTarget], query_vectors, queries: List[str], k: int = 5,
+                     mode: str = "dense", nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                     chunk_filter: Optional[ChunkFilter] = None) -> List[List[Dict]]:
+    """Search every target in parallel and return one ranked top-k list per query."""
+    with ThreadPoolExecutor(max_workers=max(1, len(targets))) as pool:
+        per_target = list(pool.map(
+            lambda t: search_target(t, query_vectors, queries, k, mode, nprobe, ef_search, chunk_filter), targets))
+    return fuse(per_target, k)
@@ -0,0 +1,46 @@
+# hash_embedder.py
+# Deterministic local stand-in for the embedding API (benchmarks, offline runs): hashed word and bigram features
+
+import re
+import hashlib
+from functools import lru_cache
+from typing import List, Tuple
+
+import numpy as np
+
+EMBEDDING_DIM = 1536  # same shape as text-embedding-3-small, so the vectors fit every index kind unchanged
+HASH_EMBED_MODEL = "hash-embedding"
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the their this to was "
+    "were what when where which who why will with our we you your they them".split()
+)
+BIGRAM_WEIGHT = 0.5
+
+
+@lru_cache(maxsize=1 << 18)
+def _feature(term: str, dim: int) -> Tuple[int, float]:
+    # blake2b rather than hash(): Python salts str hashes per process, these must be stable across runs
+    h = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+    return h % dim, 1.0 if h >> 63 else -1.0
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def hash_embed(texts: List[str], dim: int = EMBEDDING_DIM) -> np.ndarray:
+    """(len(texts), dim) float32 unit vectors; texts sharing words have high cosine similarity.
+    An empty text gives a zero row, like a failed embedding."""
+    matrix = np.zeros((len(texts), dim), dtype="float32")
+    for row, text in enumerate(texts):
+        tokens = tokenize(text)
+        for term, weight in [(t, 1.0) for t in tokens] + [(f"{a} {b}", BIGRAM_WEIGHT) for a, b in zip(tokens, tokens[1:])]:
+            col, sign = _feature(term, dim)
+            matrix[row, col] += sign * weight
+    # Sublinear term frequency, so one repeated word can't dominate a long chunk
+    np.copyto(matrix, np.sign(matrix) * np.log1p(np.abs(matrix)))
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
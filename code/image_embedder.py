@@ -4,18 +4,11 @@ import faiss
 import numpy as np
 from typing import List, Dict
 from pathlib import Path
-from tqdm import tqdm
-from openai import OpenAI
-import ollama
 from embedder import load_chunks
-from dotenv import load_dotenv
-import shutil
-
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-EMBEDDING_DIM = 1536  # or 1536 if you're using text-embedding-3-small
-BATCH_SIZE = 32
+from embedding_engine import embed_texts_tagged, usable_embeddings, write_retry_queue, EMBEDDING_DIM
+from index_factory import build_index, describe_index, assign_ids
+from metadata_store import write_store
+from snapshots import begin_snapshot, publish_snapshot, writer_lock
 
 
 # ----------------------------
@@ -79,28 +72,17 @@ def load_image_chunks(folder_path: str,
                 
 
 
-#----------------------------
-# Load image chunks (collateral + ppt)
+# ----------------------------
+# Embed image chunks via the shared embedding engine
 # ----------------------------
 
-def embed_chunks(chunks: List[Dict], model_name: str = "nomic-embed-text") -> List[List[float]]:
-    embeddings = []
-    for i in tqdm(range(0, len(chunks), BATCH_SIZE), desc="Embedding chunks"):
-        batch = chunks[i:i + BATCH_SIZE]
-        texts = [c.get("text", "").strip() for c in batch]
-        try:
-            response = client.embeddings.create(input=texts, model="text-embedding-3-small")
-            for j in range(len(batch)):
-                embeddings.append(response.data[j].embedding)
-        except Exception as e:
-            print(f"OpenAI batch failed: {e}. Falling back to Ollama per chunk.")
-            for text in texts:
-                try:
-                    response = ollama.embeddings(model=model_name, prompt=text)
-                    embeddings.append(response["embedding"])
-                except Exception as ollama_e:
-                    print(f"Ollama failed: {ollama_e}. Using zero vector.")
-                    embeddings.append([0.0] * EMBEDDING_DIM)
+def embed_chunks(chunks: List[Dict], model_name: str = "nomic-embed-text", use_cache: bool = True) -> np.ndarray:
+    """Embed chunks, tagging each with the model that produced its vector (None if embedding failed)."""
+    texts = [c.get("text", "").strip() for c in chunks]
+    embeddings, models = embed_texts_tagged(texts, model_name=model_name, desc="Embedding chunks",
+                                            use_cache=use_cache)
+    for chunk, model in zip(chunks, models):
+        chunk["embedding_model"] = model
     return embeddings
 
 
@@ -108,34 +90,36 @@ def embed_chunks(chunks: List[Dict], model_name: str = "nomic-embed-text") -> Li
 # Save FAISS index + metadata
 # ----------------------------
 
-def save_index(embeddings: List[List[float]], chunks: List[Dict], index_path: str, metadata_path: str):
-    embedding_matrix = np.array(embeddings).astype("float32")
-    index = faiss.IndexFlatL2(EMBEDDING_DIM)
-    index.add(embedding_matrix)
+def save_index(embeddings: np.ndarray, chunks: List[Dict], index_path: str, metadata_path: str,
+               retry_path: str = None):
+    assign_ids(chunks)
+    # Only primary-model vectors are indexed; the other chunks stay in the metadata store
+    # (so lexical search still finds them) and are queued to be embedded again
+    embedding_matrix, kept, rejected = usable_embeddings(chunks, embeddings)
+    index = build_index(embedding_matrix, ids=np.array([c["faiss_id"] for c in kept], dtype="int64"))
     faiss.write_index(index, index_path)
-    with open(metadata_path, 'w') as f:
-        json.dump(chunks, f)
-    print(f"✅ Saved FAISS image index and metadata ({len(chunks)} chunks).")
+    write_store(chunks, metadata_path)
+    if retry_path:
+        write_retry_queue(retry_path, rejected)
+    print(f"✅ Saved FAISS image index [{describe_index(index)}] with {len(kept)} vectors and metadata ({len(chunks)} chunks).")
 
 # ----------------------------
 # Main
 # ----------------------------
 if __name__ == "__main__":
+    output_dir = "/Users/sharvari/Downloads/CAFB_Challenge/outputs"
+    lock = writer_lock(output_dir)  # the ingestion worker's update_pipeline.py runs also rewrite the manifest
     collateral_map = load_text_context_map("/Users/sharvari/Downloads/CAFB_Challenge/data/collateral.jsonl", mode="collateral")
     ppt_map = load_text_context_map("/Users/sharvari/Downloads/CAFB_Challenge/data/powerpoints.jsonl", mode="ppt")
 
     enriched_chunks = load_image_chunks("outputs", collateral_map, ppt_map)
     embeddings = embed_chunks(enriched_chunks)
 
-    old_index_path = "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images.index"
-    old_metadata_path = "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images.json"
-
-    if os.path.exists(old_index_path):
-        shutil.copyfile(old_index_path, "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images_backup.index")
-        print("🗂️ Backed up previous FAISS index as faiss_index_images_backup.index")
-
-    if os.path.exists(old_metadata_path):
-        shutil.copyfile(old_metadata_path, "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images_backup.json")
-        print("🗂️ Backed up previous metadata as faiss_metadata_images_backup.json")
-
-    save_index(embeddings, enriched_chunks, "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images.json")
+    # Previous snapshots are kept (CAFB_KEEP_SNAPSHOTS), so they double as backups of the old index
+    version, snapshot_dir = begin_snapshot(output_dir)
+    index_path = os.path.join(snapshot_dir, "faiss_index_images.index")
+    metadata_path = os.path.join(snapshot_dir, "faiss_metadata_images.sqlite")
+    # A full rebuild re-embeds every image chunk, so the queue only records what is still missing
+    save_index(embeddings, enriched_chunks, index_path, metadata_path,
+               retry_path=os.path.join(output_dir, "embedding_retry_images.jsonl"))
+    publish_snapshot(output_dir, version, {"images": (index_path, metadata_path)})
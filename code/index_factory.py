@@ -0,0 +1,367 @@
+# index_factory.py
+# Configurable FAISS index construction (flat / float16 / int8 / IVF-Flat / IVF-PQ / HNSW) and recall@k reporting
+
+import os
+import time
+import hashlib
+import argparse
+from typing import List, Dict, Optional, Iterable, Tuple
+
+import faiss
+import numpy as np
+
+INDEX_KINDS = ("flat", "fp16", "sq8", "ivf_flat", "ivf_pq", "hnsw")
+INDEX_KIND = os.getenv("CAFB_INDEX_KIND", "flat")
+METRICS = ("ip", "l2")
+INDEX_METRIC = os.getenv("CAFB_INDEX_METRIC", "ip")  # ip = cosine on L2-normalized vectors
+IVF_NLIST = int(os.getenv("CAFB_IVF_NLIST", "0"))        # 0 = pick from corpus size
+PQ_M = int(os.getenv("CAFB_PQ_M", "96"))                  # sub-quantizers, must divide the dimension
+RERANK_KINDS = ("none", "fp16", "sq8", "flat")
+PQ_RERANK = os.getenv("CAFB_PQ_RERANK", "sq8")            # vectors the ivf_pq shortlist is re-scored against
+RERANK_K_FACTOR = int(os.getenv("CAFB_RERANK_K_FACTOR", "4"))  # shortlist = k * this
+HNSW_M = int(os.getenv("CAFB_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("CAFB_HNSW_EF_CONSTRUCTION", "200"))
+NPROBE = int(os.getenv("CAFB_NPROBE", "16"))
+EF_SEARCH = int(os.getenv("CAFB_EF_SEARCH", "64"))
+FILTER_MAX_WIDEN = float(os.getenv("CAFB_FILTER_MAX_WIDEN", "8"))  # cap on nprobe / efSearch growth for filtered search
+MMAP_INDEX = os.getenv("CAFB_MMAP_INDEX", "1") == "1"  # search indexes straight from the file's pages
+
+
+# ----------------------------
+# Build an index of the requested kind, trained on the vectors it will hold
+# ----------------------------
+def pick_nlist(n: int, nlist: int = 0) -> int:
+    """IVF list count for `n` training vectors: `nlist` if given, else 4*sqrt(n), capped by the training size."""
+    nlist = nlist or int(4 * np.sqrt(n))
+    # FAISS wants ~39 training points per centroid
+    return max(1, min(nlist, n // 39))
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale every non-zero row to unit length. A float32 C-contiguous matrix is normalized in
+    place (no second copy of a large embedding buffer); anything else is converted first."""
+    matrix = np.ascontiguousarray(matrix, dtype="float32")
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    if len(matrix):
+        faiss.normalize_L2(matrix)
+    return matrix
+
+
+_SQ_TYPES = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+
+def _vector_store(kind: str, d: int, metric: int) -> faiss.Index:
+    # Exhaustive index holding full (flat), float16 (2x smaller) or int8 (4x smaller) vectors
+    if kind == "flat":
+        return faiss.IndexFlat(d, metric)
+    return faiss.IndexScalarQuantizer(d, _SQ_TYPES[kind], metric)
+
+
+def build_index(matrix: np.ndarray, kind: str = INDEX_KIND, ids: Optional[np.ndarray] = None,
+                nlist: int = IVF_NLIST, pq_m: int = PQ_M, hnsw_m: int = HNSW_M,
+                metric: str = INDEX_METRIC) -> faiss.Index:
+    """Create, train and fill an index. Falls back to flat when there is too little data to train.
+
+    With metric "ip" the vectors are L2-normalized (in place, see normalize_rows) and searched by
+    inner product (cosine), so scores are comparable across queries and IVF/PQ/HNSW partition the
+    data far more evenly. "fp16" / "sq8" store each dimension in 2 / 1 bytes instead of 4. "ivf_pq"
+    stores ~pq_m bytes per vector and, unless CAFB_PQ_RERANK=none, re-scores a k * RERANK_K_FACTOR
+    shortlist against a second copy of the vectors held as fp16 / sq8 / flat.
+    When `ids` is given the index is wrapped in an IndexIDMap2 so search returns those ids.
+    """
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown index kind '{kind}'. Expected one of {INDEX_KINDS}.")
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}'. Expected one of {METRICS}.")
+    matrix = normalize_rows(matrix) if metric == "ip" else np.ascontiguousarray(matrix, dtype="float32")
+    n, d = matrix.shape
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "ip" else faiss.METRIC_L2
+    flat = faiss.IndexFlatIP if metric == "ip" else faiss.IndexFlatL2
+
+    if kind == "flat" or (kind.startswith("ivf") and n < 39) or (kind == "sq8" and not n):
+        index = flat(d)
+    elif kind in _SQ_TYPES:
+        index = _vector_store(kind, d, faiss_metric)
+        index.train(matrix)
+    elif kind == "ivf_flat":
+        index = faiss.IndexIVFFlat(flat(d), d, pick_nlist(n, nlist), faiss_metric)
+        index.train(matrix)
+    elif kind == "ivf_pq":
+        if d % pq_m:
+            raise ValueError(f"CAFB_PQ_M={pq_m} must divide the embedding dimension {d}.")
+        nbits = 8 if n >= 256 * 39 else max(1, min(8, int(np.log2(max(2, n // 39)))))
+        index = faiss.IndexIVFPQ(flat(d), d, pick_nlist(n, nlist), pq_m, nbits, faiss_metric)
+        if PQ_RERANK != "none":
+            if PQ_RERANK not in RERANK_KINDS:
+                raise ValueError(f"Unknown CAFB_PQ_RERANK '{PQ_RERANK}'. Expected one of {RERANK_KINDS}.")
+            index = faiss.IndexRefine(index, _vector_store(PQ_RERANK, d, faiss_metric))
+            index.k_factor = RERANK_K_FACTOR
+        index.train(matrix)
+    else:
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss_metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+
+    if ids is None:
+        index.add(matrix)
+        return index
+    index = faiss.IndexIDMap2(index)
+    index.add_with_ids(matrix, np.asarray(ids, dtype="int64"))
+    return index
+
+
+def is_inner_product(index: faiss.Index) -> bool:
+    return index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+
+def add_vectors(index: faiss.Index, matrix: np.ndarray, ids: np.ndarray):
+    """add_with_ids, normalizing first when the index compares by inner product."""
+    matrix = normalize_rows(matrix) if is_inner_product(index) else np.ascontiguousarray(matrix, dtype="float32")
+    index.add_with_ids(matrix, np.asarray(ids, dtype="int64"))
+
+
+def prepare_queries(index: faiss.Index, vectors) -> Tuple[np.ndarray, np.ndarray]:
+    """(query matrix, usable mask). A query is unusable when it has the wrong dimension (e.g. an
+    Ollama fallback embedding against an OpenAI index) or is a zero / non-finite vector; its row is
+    left at zero and should not be searched. Usable rows are normalized for inner-product indexes."""
+    matrix = np.zeros((len(vectors), index.d), dtype="float32")
+    usable = np.zeros(len(vectors), dtype=bool)
+    for row, vec in enumerate(vectors):
+        vec = np.asarray(vec, dtype="float32").ravel()
+        if vec.shape[0] == index.d and np.isfinite(vec).all() and np.any(vec):
+            matrix[row] = vec
+            usable[row] = True
+    if is_inner_product(index) and usable.any():
+        matrix[usable] = normalize_rows(matrix[usable])
+    return matrix, usable
+
+
+# ----------------------------
+# Stable chunk ids (doc_id + chunk_id) for ID-mapped indexes
+# ----------------------------
+def chunk_key(chunk: Dict) -> str:
+    return f"{chunk.get('doc_id', '')}:{chunk.get('chunk_id', 0)}"
+
+
+def chunk_faiss_id(chunk: Dict) -> int:
+    digest = hashlib.blake2b(chunk_key(chunk).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") & 0x7FFF_FFFF_FFFF_FFFF  # FAISS ids are signed int64
+
+
+def assign_ids(chunks: List[Dict]) -> np.ndarray:
+    """Stamp each chunk with its `faiss_id` and return the ids in chunk order."""
+    for chunk in chunks:
+        chunk["faiss_id"] = chunk_faiss_id(chunk)
+    return np.array([c["faiss_id"] for c in chunks], dtype="int64")
+
+
+def is_id_mapped(index: faiss.Index) -> bool:
+    return isinstance(faiss.downcast_index(index), (faiss.IndexIDMap, faiss.IndexIDMap2))
+
+
+def remove_ids(index: faiss.Index, ids: Iterable[int]) -> faiss.Index:
+    """Remove ids from an ID-mapped index. HNSW and re-ranking IVF-PQ can't delete in place, so
+    they are rebuilt without them (the re-ranked one keeps its trained quantizers)."""
+    ids = np.fromiter(ids, dtype="int64")
+    if not len(ids):
+        return index
+    try:
+        index.remove_ids(faiss.IDSelectorBatch(ids))
+        return index
+    except RuntimeError:
+        pass
+    kept_ids = faiss.vector_to_array(index.id_map)
+    mask = ~np.isin(kept_ids, ids)
+    inner = _unwrap(index)
+    vectors = inner.reconstruct_n(0, index.ntotal)[mask]
+    if isinstance(inner, faiss.IndexHNSW):
+        fresh = faiss.IndexHNSWFlat(inner.d, inner.hnsw.nb_neighbors(1), inner.metric_type)
+        fresh.hnsw.efConstruction = inner.hnsw.efConstruction
+    else:
+        fresh = faiss.clone_index(inner)
+        fresh.reset()
+    rebuilt = faiss.IndexIDMap2(fresh)
+    rebuilt.add_with_ids(vectors, kept_ids[mask])
+    return rebuilt
+
+
+# ----------------------------
+# Loading for search: memory-mapped, so worker processes share one page-cache copy
+# ----------------------------
+def read_index(path: str, mmap: bool = MMAP_INDEX) -> faiss.Index:
+    """Open an index for searching. With mmap the vectors / codes are read in place from the file
+    (IO_FLAG_MMAP_IFC; older faiss maps only IVF lists), so every uvicorn worker serving the same
+    snapshot shares the OS page cache and a new worker is ready in milliseconds. The index is
+    read-only: never rewrite a mapped file in place; publish a new snapshot instead."""
+    if not mmap:
+        return faiss.read_index(path)
+    flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    return faiss.read_index(path, flags)
+
+
+# ----------------------------
+# Query-time tuning (nprobe for IVF, efSearch for HNSW)
+# ----------------------------
+def _unwrap(index: faiss.Index) -> faiss.Index:
+    index = faiss.downcast_index(index)
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def _search_core(index: faiss.Index) -> faiss.Index:
+    """The index that does the candidate search (the IVF-PQ under a re-ranking IndexRefine)."""
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexRefine):
+        return faiss.downcast_index(inner.base_index)
+    return inner
+
+
+def _internal_positions(index: faiss.Index, ids: np.ndarray) -> np.ndarray:
+    # An IndexRefine's base index knows rows by position, not by the IDMap's ids
+    if not is_id_mapped(index):
+        return np.asarray(ids, dtype="int64")
+    return np.flatnonzero(np.isin(faiss.vector_to_array(index.id_map), ids)).astype("int64")
+
+
+def search_params(index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                  ids: Optional[np.ndarray] = None) -> Optional[faiss.SearchParameters]:
+    """Per-call search parameters, so concurrent requests can use different settings.
+
+    `ids` restricts the search to those ids: non-matching vectors are skipped during the scan rather
+    than filtered out of the top-k afterwards. Because most of each probed list / visited neighbourhood
+    is then rejected, nprobe and efSearch grow with the filter's selectivity (up to FILTER_MAX_WIDEN x)
+    so a filtered query still fills k.
+    """
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexRefine):
+        positions = _internal_positions(index, ids) if ids is not None else None
+        base = search_params(inner.base_index, nprobe, ef_search, positions)
+        return faiss.IndexRefineSearchParameters(k_factor=inner.k_factor, **({"base_index_params": base} if base else {}))
+    extra, widen = {}, 1.0
+    if ids is not None:
+        extra["sel"] = faiss.IDSelectorBatch(np.asarray(ids, dtype="int64"))
+        widen = min(FILTER_MAX_WIDEN, max(1.0, index.ntotal / max(len(ids), 1)))
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=min(inner.nlist, int((nprobe or NPROBE) * widen)), **extra)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=int((ef_search or EF_SEARCH) * widen), **extra)
+    return faiss.SearchParameters(**extra) if extra else None
+
+
+def set_default_search_params(index: faiss.Index, nprobe: int = NPROBE, ef_search: int = EF_SEARCH):
+    inner = _unwrap(index)
+    if isinstance(inner, faiss.IndexRefine):
+        inner.k_factor = RERANK_K_FACTOR
+    inner = _search_core(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search
+
+
+def _store_name(index: faiss.Index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return {v: k for k, v in _SQ_TYPES.items()}.get(index.sq.qtype, "sq")
+    return "flat"
+
+
+def describe_index(index: faiss.Index) -> str:
+    outer = _unwrap(index)
+    inner = _search_core(index)
+    metric = "ip" if is_inner_product(inner) else "l2"
+    if isinstance(outer, faiss.IndexRefine):
+        metric += f", rerank={_store_name(outer.refine_index)} x{outer.k_factor}"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return f"ivf_pq(nlist={inner.nlist}, nprobe={inner.nprobe}, m={inner.pq.M}, {metric})"
+    if isinstance(inner, faiss.IndexIVF):
+        return f"ivf_flat(nlist={inner.nlist}, nprobe={inner.nprobe}, {metric})"
+    if isinstance(inner, faiss.IndexHNSW):
+        return f"hnsw(efSearch={inner.hnsw.efSearch}, {metric})"
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return f"{_store_name(inner)}({metric})"
+    return type(inner).__name__
+
+
+def index_bytes(index: faiss.Index) -> int:
+    """Serialized size, i.e. roughly the file size and what each worker holds in RAM."""
+    return int(faiss.serialize_index(index).nbytes)
+
+
+# ----------------------------
+# Recall@k against the exact flat index
+# ----------------------------
+def recall_at_k(ground_truth: np.ndarray, found: np.ndarray, k: int) -> float:
+    hits = sum(len(set(gt[:k]) & set(f[:k]) - {-1}) for gt, f in zip(ground_truth, found))
+    return hits / float(len(ground_truth) * k)
+
+
+def recall_report(matrix: np.ndarray, kinds: List[str] = INDEX_KINDS, k: int = 10, n_queries: int = 200,
+                  nprobes: List[int] = (1, 4, 16, 64), ef_searches: List[int] = (16, 64, 256),
+                  seed: int = 0, metric: str = INDEX_METRIC) -> List[Dict]:
+    matrix = normalize_rows(matrix) if metric == "ip" else np.ascontiguousarray(matrix, dtype="float32")
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.choice(len(matrix), size=min(n_queries, len(matrix)), replace=False)]
+
+    flat = build_index(matrix, kind="flat", metric=metric)
+    _, ground_truth = flat.search(queries, k)
+
+    rows = []
+    for kind in kinds:
+        start = time.perf_counter()
+        index = build_index(matrix, kind=kind, metric=metric)
+        build_s = time.perf_counter() - start
+        size = index_bytes(index)
+
+        inner = _search_core(index)
+        if isinstance(inner, faiss.IndexIVF):
+            settings = [("nprobe", p) for p in nprobes if p <= inner.nlist]
+        elif isinstance(inner, faiss.IndexHNSW):
+            settings = [("efSearch", ef) for ef in ef_searches]
+        else:
+            settings = [("-", None)]
+
+        for name, value in settings:
+            params = search_params(index, nprobe=value, ef_search=value) if value else None
+            start = time.perf_counter()
+            _, found = index.search(queries, k, params=params)
+            elapsed = time.perf_counter() - start
+            rows.append({
+                "kind": kind,
+                "param": f"{name}={value}" if value else "-",
+                "recall_at_k": round(recall_at_k(ground_truth, found, k), 4),
+                "ms_per_query": round(1000 * elapsed / len(queries), 3),
+                "build_s": round(build_s, 2),
+                "bytes_per_vector": round(size / max(index.ntotal, 1)),
+            })
+    return rows
+
+
+def vectors_from_index(index_path: str) -> np.ndarray:
+    index = faiss.read_index(index_path)
+    return _unwrap(index).reconstruct_n(0, index.ntotal)
+
+
+# ----------------------------
+# Main: print a recall/latency table for an existing flat index
+# ----------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare FAISS index kinds by recall@k and latency.")
+    parser.add_argument("index_path", help="Existing flat index whose vectors are used as the corpus")
+    parser.add_argument("--kinds", nargs="+", default=list(INDEX_KINDS), choices=INDEX_KINDS)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--metric", default=INDEX_METRIC, choices=METRICS)
+    args = parser.parse_args()
+
+    vectors = vectors_from_index(args.index_path)
+    print(f"Loaded {len(vectors)} vectors of dimension {vectors.shape[1]} from {args.index_path}")
+    rows = recall_report(vectors, args.kinds, args.k, args.queries, args.nprobe, args.ef_search, metric=args.metric)
+
+    print(f"\n{'kind':<10} {'param':<14} {'recall@' + str(args.k):>10} {'ms/query':>10} {'build s':>9} {'B/vector':>9}")
+    for r in rows:
+        print(f"{r['kind']:<10} {r['param']:<14} {r['recall_at_k']:>10.4f} {r['ms_per_query']:>10.3f} "
+              f"{r['build_s']:>9.2f} {r['bytes_per_vector']:>9}")
@@ -0,0 +1,214 @@
+# ingest_queue.py
+# Ingestion job queue: uploads are enqueued, one worker process runs update_pipeline.py for whole batches
+#
+#   python ingest_queue.py     # start the worker (the only process that should write the indexes)
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import subprocess
+from collections import deque
+from typing import Dict, List, Optional
+
+from chunk_utils import is_supported, target_index
+from snapshots import acquire_lock
+
+PROJECT_DIR = os.getenv("CAFB_PROJECT_DIR", "/Users/sharvari/Downloads/CAFB_Challenge")
+QUEUE_PATH = os.getenv("CAFB_INGEST_QUEUE", os.path.join(PROJECT_DIR, "outputs", "ingest_jobs.sqlite"))
+DATA_DIR = os.path.join(PROJECT_DIR, "data")  # update_pipeline.py only scans this folder
+FILE_IDS_PATH = os.path.join(PROJECT_DIR, "outputs", "file_chunk_ids.json")  # written by update_pipeline.py
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_pipeline.py")
+POLL_SECONDS = float(os.getenv("CAFB_INGEST_POLL", "1"))
+SETTLE_SECONDS = float(os.getenv("CAFB_INGEST_SETTLE", "3"))  # wait this long after the last upload, so a burst is one run
+LOG_LINES = 50
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+
+# ----------------------------
+# Job store (SQLite, shared by the API and the worker)
+# ----------------------------
+def _connect(path: str = QUEUE_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, status TEXT NOT NULL, files TEXT NOT NULL,"
+        " created_at REAL, started_at REAL, finished_at REAL, batch INTEGER,"
+        " progress TEXT DEFAULT '', log TEXT DEFAULT '', error TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+    return conn
+
+
+def _job(row: sqlite3.Row) -> Dict:
+    job = dict(row)
+    job["files"] = json.loads(job["files"])
+    return job
+
+
+def validate_files(files: List[str], data_dir: str = DATA_DIR) -> List[str]:
+    """Absolute paths for `files`; raises ValueError unless each exists under data/ and can be chunked."""
+    if not files:
+        raise ValueError("No files to ingest.")
+    data_dir = os.path.realpath(data_dir)
+    paths, problems = [], []
+    for file in files:
+        file_path = os.path.realpath(os.path.join(PROJECT_DIR, file))  # relative paths are project-relative
+        if os.path.commonpath([file_path, data_dir]) != data_dir:
+            problems.append(f"{file}: not under {data_dir}")
+        elif not os.path.isfile(file_path):
+            problems.append(f"{file}: no such file")
+        elif not is_supported(file_path):
+            problems.append(f"{file}: unsupported file type")
+        elif target_index(file_path) != "text":
+            problems.append(f"{file}: image descriptions are indexed by image_embedder.py, not uploads")
+        else:
+            paths.append(file_path)
+    if problems:
+        raise ValueError("Cannot ingest " + "; ".join(problems))
+    return paths
+
+
+def enqueue(files: List[str], path: str = QUEUE_PATH) -> Dict:
+    """Record uploaded files (already saved under data/) as a queued job and return it.
+    Raises ValueError for files the pipeline would not index (see validate_files)."""
+    files = validate_files(files)
+    conn = _connect(path)
+    try:
+        cursor = conn.execute("INSERT INTO jobs (status, files, created_at) VALUES ('queued', ?, ?)",
+                              (json.dumps(files), time.time()))
+        return get_job(cursor.lastrowid, path)
+    finally:
+        conn.close()
+
+
+def get_job(job_id: int, path: str = QUEUE_PATH) -> Optional[Dict]:
+    conn = _connect(path)
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+    finally:
+        conn.close()
+
+
+def list_jobs(limit: int = 20, path: str = QUEUE_PATH) -> List[Dict]:
+    """Most recent jobs first."""
+    conn = _connect(path)
+    try:
+        return [_job(r) for r in conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))]
+    finally:
+        conn.close()
+
+
+# ----------------------------
+# Worker: claim every queued job as one batch, run the pipeline once for all of them
+# ----------------------------
+def claim_batch(conn: sqlite3.Connection, settle: float = SETTLE_SECONDS) -> List[int]:
+    """Mark all queued jobs running and return their ids, once the newest has been queued for
+    `settle` seconds (uploads still arriving join the same batch instead of starting a new run)."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        newest = conn.execute("SELECT MAX(created_at) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        if newest is None or time.time() - newest < settle:
+            conn.execute("COMMIT")
+            return []
+        ids = [r[0] for r in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY id")]
+        conn.execute(f"UPDATE jobs SET status = 'running', started_at = ?, batch = ? "
+                     f"WHERE id IN ({','.join('?' * len(ids))})", [time.time(), ids[0], *ids])
+        conn.execute("COMMIT")
+        return ids
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _update(conn: sqlite3.Connection, ids: List[int], **fields):
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn.execute(f"UPDATE jobs SET {columns} WHERE id IN ({','.join('?' * len(ids))})",
+                 [*fields.values(), *ids])
+
+
+def files_without_chunks(files: List[str], file_ids_path: str = FILE_IDS_PATH) -> List[str]:
+    """The files update_pipeline.py produced no chunks for (per its file -> chunk ids record)."""
+    try:
+        with open(file_ids_path, "r") as f:
+            file_ids = json.load(f)
+    except FileNotFoundError:
+        file_ids = {}
+    # The pipeline runs in PROJECT_DIR and records paths relative to it ("data/uploads/...")
+    produced = {os.path.realpath(os.path.join(PROJECT_DIR, p)) for p, ids in file_ids.items() if ids}
+    return [f for f in files if os.path.realpath(f) not in produced]
+
+
+def finish_jobs(conn: sqlite3.Connection, ids: List[int], log: str):
+    """After a successful run, fail the jobs none of whose files produced a chunk."""
+    for job_id in ids:
+        files = json.loads(conn.execute("SELECT files FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+        missing = files_without_chunks(files)
+        if len(missing) == len(files):
+            error = "No chunks were produced from " + ", ".join(os.path.basename(f) for f in files)
+            _update(conn, [job_id], status="failed", finished_at=time.time(), error=error, log=log)
+            print(f"❌ Job {job_id}: {error}")
+        else:
+            if missing:
+                log += "\n⚠️ No chunks were produced from " + ", ".join(os.path.basename(f) for f in missing)
+            _update(conn, [job_id], status="done", finished_at=time.time(), error=None, log=log)
+
+
+def run_batch(conn: sqlite3.Connection, ids: List[int]):
+    """Run update_pipeline.py once, streaming its output into every job of the batch."""
+    print(f"🚚 Ingesting batch of {len(ids)} upload job(s): {ids}")
+    tail = deque(maxlen=LOG_LINES)
+    try:
+        process = subprocess.Popen([sys.executable, "-u", PIPELINE], cwd=PROJECT_DIR,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        for line in process.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            tail.append(line)
+            _update(conn, ids, progress=line[-500:], log="\n".join(tail))
+        returncode = process.wait()
+        error = None if returncode == 0 else f"update_pipeline.py exited with code {returncode}"
+    except Exception as e:
+        error = f"Could not run update_pipeline.py: {e}"
+    if error:
+        _update(conn, ids, status="failed", finished_at=time.time(), error=error, log="\n".join(tail))
+        print(f"❌ Batch {ids[0]} failed: {error}")
+        return
+    # Exit code 0 only means the pipeline ran; a job is done once its files actually produced chunks
+    finish_jobs(conn, ids, "\n".join(tail))
+    print(f"✅ Batch {ids[0]} finished.")
+
+
+def recover_interrupted(conn: sqlite3.Connection):
+    # Jobs left "running" by a worker that died: the pipeline is incremental, so simply run them again
+    count = conn.execute("UPDATE jobs SET status = 'queued', started_at = NULL, batch = NULL "
+                         "WHERE status = 'running'").rowcount
+    if count:
+        print(f"🔁 Re-queued {count} job(s) interrupted by a previous worker.")
+
+
+def run_worker(path: str = QUEUE_PATH, poll: float = POLL_SECONDS):
+    conn = _connect(path)
+    lock = acquire_lock(f"{path}.lock", wait=False)
+    if lock is None:
+        print("⚠️ Another ingestion worker is already running.")
+        return
+    recover_interrupted(conn)
+    print(f"👷 Ingestion worker watching {path}")
+    while True:
+        ids = claim_batch(conn)
+        if ids:
+            run_batch(conn, ids)
+        else:
+            time.sleep(poll)
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -0,0 +1,123 @@
+# lexical_index.py
+# In-memory BM25 over the postings persisted in the metadata store
+
+import os
+import re
+import json
+import shutil
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+BM25_K1 = float(os.getenv("CAFB_BM25_K1", "1.2"))
+BM25_B = float(os.getenv("CAFB_BM25_B", "0.75"))
+TITLE_WEIGHT = 2  # title terms count this many times toward a chunk's term frequency
+MAX_QUERY_TERMS = 32
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    # No stemming or stopword list: exact terms (SNAP, ZIP codes, program names) are what dense search misses
+    return _TOKEN.findall((text or "").lower())
+
+
+def chunk_term_counts(chunk: Dict) -> Counter:
+    counts = Counter(tokenize(chunk.get("text", "")))
+    for term in tokenize(chunk.get("title", "")):
+        counts[term] += TITLE_WEIGHT
+    return counts
+
+
+class BM25Index:
+    """Postings are flattened into numpy arrays grouped by term, and each posting's full BM25
+    weight is precomputed, so a query is one scatter-add per term plus an argpartition."""
+
+    ARRAYS = ("ids", "doc_index", "weights")
+
+    def __init__(self, postings: Iterable[Tuple[str, int, int]], k1: float = BM25_K1, b: float = BM25_B):
+        # postings: (term, faiss_id, tf) rows sorted by term
+        terms, ids, tfs = [], [], []
+        for term, faiss_id, tf in postings:
+            terms.append(term)
+            ids.append(faiss_id)
+            tfs.append(tf)
+
+        self.ids, doc_index = np.unique(np.asarray(ids, dtype="int64"), return_inverse=True)
+        tf = np.asarray(tfs, dtype="float32")
+        doc_len = np.bincount(doc_index, weights=tf, minlength=len(self.ids)).astype("float32")
+        avg_len = float(doc_len.mean()) if len(doc_len) else 1.0
+
+        self.doc_index = doc_index.astype("int32")
+        self.spans: Dict[str, Tuple[int, int]] = {}
+        start = 0
+        for i in range(1, len(terms) + 1):
+            if i == len(terms) or terms[i] != terms[start]:
+                self.spans[terms[start]] = (start, i)
+                start = i
+
+        df = np.zeros(len(terms), dtype="float32")
+        for s, e in self.spans.values():
+            df[s:e] = e - s
+        n = len(self.ids)
+        idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+        norm = k1 * (1.0 - b + b * doc_len[self.doc_index] / avg_len)
+        self.weights = (idf * tf * (k1 + 1.0) / (tf + norm)).astype("float32")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def save(self, folder: str, stamp: Dict):
+        """Write the arrays as .npy files (plus the term list) so readers can memory-map them.
+        `stamp` identifies the store contents they were built from; see load()."""
+        tmp = f"{folder}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(getattr(self, name)))
+        terms = list(self.spans)  # insertion order = posting order
+        starts = [self.spans[t][0] for t in terms] + [len(self.weights)]
+        np.save(os.path.join(tmp, "starts.npy"), np.asarray(starts, dtype="int64"))
+        with open(os.path.join(tmp, "terms.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(terms))
+        with open(os.path.join(tmp, "stamp.json"), "w") as f:
+            json.dump(stamp, f)
+        shutil.rmtree(folder, ignore_errors=True)  # processes that mapped the old files keep them until unmapped
+        os.replace(tmp, folder)
+
+    @classmethod
+    def load(cls, folder: str, stamp: Dict) -> Optional["BM25Index"]:
+        """Memory-map an index written by save(): every process reading it shares one page-cache
+        copy of the postings. Returns None if it is missing or was built from other contents."""
+        try:
+            with open(os.path.join(folder, "stamp.json"), "r") as f:
+                if json.load(f) != stamp:
+                    return None
+            index = cls.__new__(cls)
+            for name in cls.ARRAYS:
+                setattr(index, name, np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r"))
+            starts = np.load(os.path.join(folder, "starts.npy")).tolist()
+            with open(os.path.join(folder, "terms.txt"), "r", encoding="utf-8") as f:
+                terms = f.read().split("\n") if len(starts) > 1 else []
+        except (OSError, ValueError):
+            return None
+        index.spans = {t: (starts[i], starts[i + 1]) for i, t in enumerate(terms)}
+        return index
+
+    def search(self, query: str, k: int, ids: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Top-k (faiss_id, score), best first. `ids` (sorted) restricts the candidates before ranking."""
+        spans = [self.spans[t] for t in dict.fromkeys(tokenize(query[:2000])) if t in self.spans]
+        spans = spans[:MAX_QUERY_TERMS]
+        if not spans or k <= 0:
+            return []
+        scores = np.zeros(len(self.ids), dtype="float32")
+        for s, e in spans:
+            scores[self.doc_index[s:e]] += self.weights[s:e]  # a term lists each chunk once
+        hits = np.flatnonzero(scores)
+        if ids is not None:
+            hits = hits[np.isin(self.ids[hits], ids, assume_unique=True)]
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(self.ids[i]), float(scores[i])) for i in hits]
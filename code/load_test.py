@@ -0,0 +1,298 @@
+# load_test.py
+# HTTP load test for api_server: a concurrency sweep per endpoint reporting throughput, tail latency and errors
+#
+#   python load_test.py --spawn --workers 4 --endpoints search generate_stream --concurrency 1 4 16 64
+#
+# --spawn starts mock_openai.py and `uvicorn api_server:app` pointed at it (set CAFB_MOCK_* to shape the
+# mock's latency and error rates, CAFB_LLM_CONCURRENCY / CAFB_SEARCH_WORKERS etc. to tune the server).
+# The API serves --index-dir, or else a flat index of the repo's chunk files embedded with the same hash
+# embedder the mock uses, built into a scratch folder. Without --spawn, --url is load-tested as is.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import shutil
+import tempfile
+import subprocess
+from collections import Counter
+from itertools import count
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_PATH = os.path.join(CODE_DIR, "golden_queries.jsonl")
+CHUNKS_DIR = os.getenv("CAFB_OUTPUT_DIR", os.path.join(CODE_DIR, "..", "outputs"))
+RESULTS_PATH = os.path.join(CHUNKS_DIR, "load_test.json")
+ENDPOINTS = ("search", "search_batch", "generate", "generate_stream")
+REQUEST_TIMEOUT = 120.0
+
+
+# ----------------------------
+# Requests: one call per endpoint, returning (status, time to first byte of answer)
+# ----------------------------
+class RequestError(Exception):
+    def __init__(self, kind: str):
+        super().__init__(kind)
+        self.kind = kind  # e.g. "http_500", "stream_error", "ReadTimeout"
+
+
+async def call(http: httpx.AsyncClient, endpoint: str, query: str) -> Optional[float]:
+    """Run one request; returns seconds to the first streamed token (streams only). Raises RequestError."""
+    if endpoint == "search":
+        response = await http.post("/search", json={"query": query, "top_k": 5})
+    elif endpoint == "search_batch":
+        response = await http.post("/search/batch", json={"queries": [f"{query} {i}" for i in range(8)], "top_k": 5})
+    elif endpoint == "generate":
+        response = await http.post("/generate", json={"query": query, "top_k": 5, "format": "blog_post"})
+    else:
+        start = time.perf_counter()
+        first_token = None
+        async with http.stream("POST", "/generate/stream", json={"query": query, "top_k": 5}) as response:
+            if response.status_code != 200:
+                raise RequestError(f"http_{response.status_code}")
+            event = None
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                    if event == "error":
+                        raise RequestError("stream_error")
+                    if event == "delta" and first_token is None:
+                        first_token = time.perf_counter() - start
+        return first_token
+    if response.status_code != 200:
+        raise RequestError(f"http_{response.status_code}")
+    return None
+
+
+# ----------------------------
+# One concurrency level: `concurrency` clients sending back-to-back requests for `duration` seconds
+# ----------------------------
+async def run_level(url: str, endpoint: str, concurrency: int, duration: float, queries: List[str],
+                    unique: bool) -> Dict:
+    numbers = count()
+    latencies, first_tokens, errors = [], [], Counter()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=REQUEST_TIMEOUT) as http:
+        deadline = time.perf_counter() + duration
+
+        async def client():
+            while time.perf_counter() < deadline:
+                n = next(numbers)
+                query = queries[n % len(queries)]
+                if unique:
+                    query = f"{query} (request {n})"  # defeats the embedding and response caches
+                start = time.perf_counter()
+                try:
+                    first_token = await call(http, endpoint, query)
+                except RequestError as e:
+                    errors[e.kind] += 1
+                    continue
+                except httpx.HTTPError as e:
+                    errors[type(e).__name__] += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    total = len(latencies) + sum(errors.values())
+    row = {"endpoint": endpoint, "concurrency": concurrency, "requests": total,
+           "rps": round(len(latencies) / elapsed, 2),
+           "error_rate": round(sum(errors.values()) / total, 4) if total else 0.0,
+           "errors": dict(errors)}
+    if latencies:
+        ms = np.array(latencies) * 1000
+        row.update({f"p{p}_ms": round(float(np.percentile(ms, p)), 1) for p in (50, 95, 99)})
+    if first_tokens:
+        ms = np.array(first_tokens) * 1000
+        row.update({"ttft_p50_ms": round(float(np.percentile(ms, 50)), 1),
+                    "ttft_p95_ms": round(float(np.percentile(ms, 95)), 1)})
+    return row
+
+
+def write_report(report: Dict, path: str):
+    # Temp file + rename, so an interrupted write never leaves a truncated report behind
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def sweep(url: str, endpoints: List[str], levels: List[int], duration: float, queries: List[str],
+          unique: bool = True, mock_url: Optional[str] = None, report: Optional[Dict] = None,
+          out: Optional[str] = None) -> List[Dict]:
+    """Run every (endpoint, concurrency) level. With `out`, `report` is rewritten with the rows so far
+    after each level, so an aborted sweep keeps what it measured."""
+    rows = report["results"] if report is not None else []
+    for endpoint in endpoints:
+        for concurrency in levels:
+            before = upstream_stats(mock_url)
+            row = asyncio.run(run_level(url, endpoint, concurrency, duration, queries, unique))
+            after = upstream_stats(mock_url)
+            if before and after:
+                row["upstream_calls"] = {k: after[k] - before[k] for k in after if after[k] != before[k]}
+            print(f"⏱️ {endpoint} x{concurrency}: {row['rps']} req/s, p95 {row.get('p95_ms', '-')} ms, "
+                  f"errors {row['error_rate']:.1%}")
+            rows.append(row)
+            if out and report is not None:
+                write_report(report, out)
+    return rows
+
+
+def upstream_stats(mock_url: Optional[str]) -> Optional[Dict]:
+    # Calls the mock received, to see how the server's concurrency limits shape upstream traffic
+    if not mock_url:
+        return None
+    try:
+        return httpx.get(f"{mock_url}/stats", timeout=5).json()
+    except httpx.HTTPError:
+        return None
+
+
+# ----------------------------
+# --spawn: mock upstream plus api_server workers, torn down afterwards
+# ----------------------------
+def wait_until_up(url: str, path: str, process: subprocess.Popen, timeout: float = 120.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode} while starting")
+        try:
+            if httpx.get(f"{url}{path}", timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def build_hash_index(chunks_dir: str, output_dir: str):
+    """Publish a flat text index of the chunks in `chunks_dir` into `output_dir`, embedded with the
+    hash embedder mock_openai.py answers with, so the spawned API has something to serve."""
+    import benchmark  # sets an offline OPENAI_API_KEY before the modules below build their clients
+    import faiss
+    from embedder import load_chunks
+    from hash_embedder import hash_embed
+    from index_factory import build_index, assign_ids
+    from metadata_store import write_store
+    from snapshots import begin_snapshot, publish_snapshot
+
+    chunks = load_chunks(chunks_dir)
+    if not chunks:
+        raise ValueError(f"No chunks_*.jsonl chunks found in {chunks_dir}; pass --index-dir or --chunks-dir.")
+    ids = assign_ids(chunks)
+    version, snapshot_dir = begin_snapshot(output_dir)
+    index_path = os.path.join(snapshot_dir, "faiss_index.index")
+    metadata_path = os.path.join(snapshot_dir, "faiss_metadata.sqlite")
+    faiss.write_index(build_index(hash_embed([c.get("text", "").strip() for c in chunks]), kind="flat", ids=ids),
+                      index_path)
+    write_store(chunks, metadata_path).close()
+    publish_snapshot(output_dir, version, {"text": (index_path, metadata_path)})
+
+
+def spawn_servers(api_port: int, mock_port: int, workers: int, index_dir: str, workdir: str) -> List[subprocess.Popen]:
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    env = {**os.environ,
+           "CAFB_OUTPUT_DIR": os.path.abspath(index_dir),
+           "OPENAI_BASE_URL": f"{mock_url}/v1",
+           "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "load-test"),
+           "OLLAMA_HOST": mock_url,
+           "CAFB_EMBED_CACHE": os.getenv("CAFB_EMBED_CACHE", "off")}
+    mock = subprocess.Popen([sys.executable, os.path.join(CODE_DIR, "mock_openai.py"), "--port", str(mock_port)],
+                            cwd=CODE_DIR, env=env)
+    # Run from the scratch directory so the load test's requests don't land in code/query_log.jsonl
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "api_server:app", "--app-dir", CODE_DIR,
+                            "--port", str(api_port), "--workers", str(workers), "--log-level", "warning"],
+                           cwd=workdir, env=env)
+    processes = [mock, api]
+    try:
+        wait_until_up(mock_url, "/stats", mock)
+        wait_until_up(f"http://127.0.0.1:{api_port}", "/index", api)
+    except Exception:
+        stop_servers(processes)
+        raise
+    return processes
+
+
+def stop_servers(processes: List[subprocess.Popen]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# ----------------------------
+# Report
+# ----------------------------
+def print_report(rows: List[Dict]):
+    print(f"\n{'endpoint':<16} {'conc':>5} {'reqs':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'TTFT p95':>9} {'errors':>7}")
+    for r in rows:
+        print(f"{r['endpoint']:<16} {r['concurrency']:>5} {r['requests']:>6} {r['rps']:>8.2f} "
+              f"{r.get('p50_ms', '-'):>8} {r.get('p95_ms', '-'):>8} {r.get('p99_ms', '-'):>8} "
+              f"{r.get('ttft_p95_ms', '-'):>9} {r['error_rate']:>7.1%}")
+
+
+# ----------------------------
+# Main
+# ----------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrency sweep against api_server.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server to test (ignored with --spawn)")
+    parser.add_argument("--endpoints", nargs="+", default=["search", "generate_stream"], choices=ENDPOINTS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per concurrency level")
+    parser.add_argument("--reuse-queries", action="store_true",
+                        help="Repeat the golden queries verbatim (lets the caches answer) instead of making each unique")
+    parser.add_argument("--spawn", action="store_true", help="Start mock_openai.py and api_server here")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers with --spawn")
+    parser.add_argument("--api-port", type=int, default=8100)
+    parser.add_argument("--mock-port", type=int, default=8765)
+    parser.add_argument("--index-dir", help="Outputs folder with a published index for --spawn "
+                                            "(default: build a hash-embedded one from --chunks-dir)")
+    parser.add_argument("--chunks-dir", default=CHUNKS_DIR, help="chunks_*.jsonl to index when --index-dir is unset")
+    parser.add_argument("--mock-url", help="Mock server to read upstream call counts from (set by --spawn)")
+    parser.add_argument("--out", default=RESULTS_PATH, help="Rewritten after every concurrency level")
+    args = parser.parse_args()
+
+    with open(GOLDEN_PATH, "r", encoding="utf-8") as f:
+        queries = [json.loads(line)["query"] for line in f if line.strip()]
+
+    processes, url, mock_url, workdir = [], args.url, args.mock_url, None
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix="cafb_load_test_")
+        index_dir = args.index_dir
+        if not index_dir:
+            index_dir = os.path.join(workdir, "outputs")
+            print(f"🧱 Building a hash-embedded index of {args.chunks_dir} in {index_dir}")
+            build_hash_index(args.chunks_dir, index_dir)
+        print(f"🚀 Starting mock upstream on :{args.mock_port} and api_server ({args.workers} workers) on :{args.api_port}")
+        try:
+            processes = spawn_servers(args.api_port, args.mock_port, args.workers, index_dir, workdir)
+        except Exception:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        url, mock_url = f"http://127.0.0.1:{args.api_port}", f"http://127.0.0.1:{args.mock_port}"
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "url": url, "workers": args.workers if args.spawn else None,
+              "duration_s": args.duration, "unique_queries": not args.reuse_queries, "results": []}
+    try:
+        rows = sweep(url, args.endpoints, args.concurrency, args.duration, queries, not args.reuse_queries, mock_url,
+                     report, args.out)
+    finally:
+        stop_servers(processes)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(rows)
+    print(f"\n📊 Results written to {args.out}")
@@ -0,0 +1,318 @@
+# metadata_store.py
+# Chunk metadata keyed by FAISS id, in a memory-mapped SQLite file instead of one big JSON list
+
+import os
+import json
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from lexical_index import BM25Index, chunk_term_counts
+
+MMAP_BYTES = int(os.getenv("CAFB_METADATA_MMAP_BYTES", str(1 << 30)))
+FILTER_CACHE_SIZE = 256
+
+# ----------------------------
+# Search filters: source / category, date range, document
+# ----------------------------
+# Short names accepted alongside the raw `source` values written by the chunkers
+SOURCE_CATEGORIES = {
+    "blog_posts": "blog",
+    "transcript": "transcript",
+    "collateral": "collateral",
+    "collateral_image": "collateral",
+    "powerpoints": "powerpoint",
+    "powerpoint_image": "powerpoint",
+}
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%B %d, %Y", "%b %d, %Y", "%m/%d/%Y")
+
+
+def source_category(chunk: Dict) -> str:
+    # Grant proposals are chunked with source "collateral"; their doc ids tell them apart
+    if str(chunk.get("doc_id", "")).startswith("grant_proposals"):
+        return "grant"
+    source = chunk.get("source", "")
+    return SOURCE_CATEGORIES.get(source, source)
+
+
+def normalize_date(value: Optional[str]) -> Optional[str]:
+    """ISO YYYY-MM-DD for the date formats found in the chunk files, else None."""
+    value = (value or "").strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+class ChunkFilter(NamedTuple):
+    sources: Tuple[str, ...] = ()    # raw source values or categories (blog, grant, transcript, ...)
+    date_from: Optional[str] = None  # inclusive; chunks without a date never match a date range
+    date_to: Optional[str] = None
+    doc_ids: Tuple[str, ...] = ()
+
+    def is_empty(self) -> bool:
+        return not (self.sources or self.date_from or self.date_to or self.doc_ids)
+
+    def matches(self, chunk: Dict) -> bool:
+        if self.sources and chunk.get("source") not in self.sources and source_category(chunk) not in self.sources:
+            return False
+        if self.doc_ids and chunk.get("doc_id") not in self.doc_ids:
+            return False
+        if self.date_from or self.date_to:
+            date = normalize_date(chunk.get("date"))
+            if date is None or (self.date_from and date < self.date_from) or (self.date_to and date > self.date_to):
+                return False
+        return True
+
+
+class MetadataStore:
+    """Read path: O(log n) primary-key lookups served from the OS page cache via mmap.
+    Write path: inserts/deletes touch only the affected rows, never the whole file.
+    The `postings` table is the BM25 inverted index (term, chunk id, term frequency);
+    `category` / `date` are indexed columns used to build search filters."""
+
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()
+        self._bm25 = None
+        self._lock = threading.Lock()
+        self._filter_cache: "OrderedDict[ChunkFilter, np.ndarray]" = OrderedDict()
+        if not readonly:
+            conn = self._conn()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " id INTEGER PRIMARY KEY, source TEXT, doc_id TEXT, data TEXT NOT NULL,"
+                " category TEXT, date TEXT)"
+            )
+            if "category" not in self._columns("chunks"):
+                # Stores written before filtering existed get the columns and are backfilled once
+                conn.execute("ALTER TABLE chunks ADD COLUMN category TEXT")
+                conn.execute("ALTER TABLE chunks ADD COLUMN date TEXT")
+                conn.executemany(
+                    "UPDATE chunks SET category = ?, date = ? WHERE id = ?",
+                    [(source_category(c), normalize_date(c.get("date")), c["faiss_id"]) for c in self.iter_chunks()]
+                )
+            for column in ("source", "category", "date", "doc_id"):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS chunks_by_{column} ON chunks ({column})")
+            if not self._has_table("postings"):
+                conn.execute(
+                    "CREATE TABLE postings (term TEXT NOT NULL, id INTEGER NOT NULL, tf INTEGER NOT NULL,"
+                    " PRIMARY KEY (term, id)) WITHOUT ROWID"
+                )
+                conn.execute("CREATE INDEX postings_by_id ON postings (id)")
+                # Stores written before the lexical index existed are backfilled once
+                self._add_postings(list(self.iter_chunks()))
+            conn.commit()
+        self.has_lexical = self._has_table("postings")
+        self.has_filter_columns = "category" in self._columns("chunks")
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(f"file:{os.path.abspath(self.path)}?mode=ro", uri=True)
+            else:
+                conn = sqlite3.connect(self.path)
+            conn.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+            self._local.conn = conn
+        return conn
+
+    def _has_table(self, name: str) -> bool:
+        return self._conn().execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+    def _columns(self, table: str) -> List[str]:
+        return [row[1] for row in self._conn().execute(f"PRAGMA table_info({table})")]
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get(self, faiss_id: int) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM chunks WHERE id = ?", (int(faiss_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, ids: Iterable[int]) -> Dict[int, Dict]:
+        ids = [int(i) for i in ids if i >= 0]
+        found = {}
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            rows = self._conn().execute(
+                f"SELECT id, data FROM chunks WHERE id IN ({','.join('?' * len(part))})", part
+            ).fetchall()
+            found.update((i, json.loads(data)) for i, data in rows)
+        return found
+
+    @property
+    def lexical_path(self) -> str:
+        return f"{self.path}.bm25"
+
+    def _stamp(self) -> Dict:
+        # Any write changes the file's size or mtime, which invalidates a saved BM25 index
+        stat = os.stat(self.path)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def _build_lexical_index(self) -> BM25Index:
+        return BM25Index(self._conn().execute("SELECT term, id, tf FROM postings ORDER BY term"))
+
+    def lexical_index(self) -> Optional[BM25Index]:
+        """The BM25 index, loaded once and reused until the store is written to. Readers map the
+        arrays saved by save_lexical_index() when they are current, and build them otherwise."""
+        if not self.has_lexical:
+            return None
+        bm25 = self._bm25
+        if bm25 is None:
+            with self._lock:
+                if self._bm25 is None:
+                    saved = BM25Index.load(self.lexical_path, self._stamp()) if self.readonly else None
+                    self._bm25 = saved or self._build_lexical_index()
+                bm25 = self._bm25
+        return bm25
+
+    def save_lexical_index(self):
+        """Persist the BM25 arrays next to the store so every API worker can memory-map one shared
+        copy instead of building its own. Call after the last write to the store."""
+        if self.has_lexical:
+            stamp = self._stamp()
+            self._build_lexical_index().save(self.lexical_path, stamp)
+
+    def lexical_search(self, query: str, k: int, ids: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """BM25 top-k as (faiss_id, score), best first, optionally restricted to `ids`."""
+        bm25 = self.lexical_index()
+        return bm25.search(query, k, ids) if bm25 is not None else []
+
+    def filter_ids(self, chunk_filter: ChunkFilter) -> np.ndarray:
+        """Ids of the chunks matching `chunk_filter` (sorted int64), cached (LRU) until the store is written to."""
+        with self._lock:
+            cached = self._filter_cache.get(chunk_filter)
+            if cached is not None:
+                self._filter_cache.move_to_end(chunk_filter)
+                return cached
+        if self.has_filter_columns:
+            clauses, args = [], []
+            if chunk_filter.sources:
+                marks = ",".join("?" * len(chunk_filter.sources))
+                clauses.append(f"(source IN ({marks}) OR category IN ({marks}))")
+                args += list(chunk_filter.sources) * 2
+            if chunk_filter.doc_ids:
+                clauses.append(f"doc_id IN ({','.join('?' * len(chunk_filter.doc_ids))})")
+                args += list(chunk_filter.doc_ids)
+            if chunk_filter.date_from:
+                clauses.append("date >= ?")
+                args.append(chunk_filter.date_from)
+            if chunk_filter.date_to:
+                clauses.append("date <= ?")
+                args.append(chunk_filter.date_to)
+            where = " AND ".join(clauses) or "1"
+            rows = self._conn().execute(f"SELECT id FROM chunks WHERE {where} ORDER BY id", args).fetchall()
+            ids = np.fromiter((r[0] for r in rows), dtype="int64", count=len(rows))
+        else:
+            ids = np.sort(np.fromiter((c["faiss_id"] for c in self.iter_chunks() if chunk_filter.matches(c)),
+                                      dtype="int64"))
+        with self._lock:
+            self._filter_cache[chunk_filter] = ids
+            while len(self._filter_cache) > FILTER_CACHE_SIZE:
+                self._filter_cache.popitem(last=False)
+        return ids
+
+    def iter_chunks(self) -> Iterator[Dict]:
+        for (data,) in self._conn().execute("SELECT data FROM chunks ORDER BY rowid"):
+            yield json.loads(data)
+
+    def append(self, chunks: List[Dict]):
+        """Insert (or replace) chunks by their `faiss_id`, keeping their postings in step."""
+        conn = self._conn()
+        conn.executemany(
+            "INSERT OR REPLACE INTO chunks (id, source, doc_id, data, category, date) VALUES (?, ?, ?, ?, ?, ?)",
+            [(c["faiss_id"], c.get("source", ""), c.get("doc_id", ""),
+              json.dumps(c, ensure_ascii=False, separators=(",", ":")),
+              source_category(c), normalize_date(c.get("date"))) for c in chunks]
+        )
+        conn.executemany("DELETE FROM postings WHERE id = ?", [(c["faiss_id"],) for c in chunks])
+        self._add_postings(chunks)
+        conn.commit()
+
+    def _add_postings(self, chunks: List[Dict]):
+        self._conn().executemany(
+            "INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+            ((term, c["faiss_id"], tf) for c in chunks for term, tf in chunk_term_counts(c).items())
+        )
+        self._bm25 = None
+        with self._lock:
+            self._filter_cache.clear()
+
+    def delete(self, ids: Iterable[int]) -> int:
+        conn = self._conn()
+        ids = [(int(i),) for i in ids]
+        deleted = conn.executemany("DELETE FROM chunks WHERE id = ?", ids).rowcount
+        conn.executemany("DELETE FROM postings WHERE id = ?", ids)
+        conn.commit()
+        self._bm25 = None
+        with self._lock:
+            self._filter_cache.clear()
+        return deleted
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# ----------------------------
+# Full (re)write, published atomically so readers never see a half-written store
+# ----------------------------
+def write_store(chunks: List[Dict], path: str) -> MetadataStore:
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    store = MetadataStore(tmp_path)
+    store.append(chunks)
+    store.close()
+    os.replace(tmp_path, path)
+    store = MetadataStore(path)
+    store.save_lexical_index()
+    return store
+
+
+def open_metadata(path: str):
+    """Open chunk metadata for search: a MetadataStore, or a legacy faiss_metadata*.json file."""
+    if path.endswith(".json"):
+        with open(path, "r") as f:
+            metadata = json.load(f)
+        # ID-mapped indexes return stable chunk ids rather than row positions
+        if metadata and "faiss_id" in metadata[0]:
+            metadata = {chunk["faiss_id"]: chunk for chunk in metadata}
+        return metadata
+    return MetadataStore(path, readonly=True)
+
+
+# ----------------------------
+# Main: migrate a legacy JSON metadata file (and its positional index) to the store
+# ----------------------------
+if __name__ == "__main__":
+    import faiss
+    from index_factory import assign_ids, build_index, is_id_mapped, vectors_from_index
+
+    parser = argparse.ArgumentParser(description="Convert faiss_metadata*.json into a MetadataStore.")
+    parser.add_argument("json_path")
+    parser.add_argument("store_path")
+    parser.add_argument("--index", help="Positional FAISS index built from json_path; rewritten as ID-mapped")
+    args = parser.parse_args()
+
+    with open(args.json_path, "r") as f:
+        chunks = json.load(f)
+    ids = assign_ids(chunks)
+    if args.index and not is_id_mapped(faiss.read_index(args.index)):
+        faiss.write_index(build_index(vectors_from_index(args.index), ids=ids), args.index)
+        print(f"📦 Rewrote {args.index} with stable chunk ids.")
+    store = write_store(chunks, args.store_path)
+    print(f"✅ Wrote {len(store)} chunks to {args.store_path}")
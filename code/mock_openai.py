@@ -0,0 +1,166 @@
+# mock_openai.py
+# Local stand-in for the OpenAI embeddings / chat-completions API (and Ollama embeddings) for load tests:
+# deterministic hash embeddings, streamed completions, configurable latency and error rates
+#
+#   python mock_openai.py --port 8765 --chat-ttft-ms 400 --token-ms 20 --error-rate 0.01
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OLLAMA_HOST=http://127.0.0.1:8765 uvicorn api_server:app --workers 4
+
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from hash_embedder import hash_embed, tokenize, EMBEDDING_DIM
+
+OLLAMA_EMBEDDING_DIM = 768  # nomic-embed-text: a fallback vector the OpenAI-sized index can't use, as in production
+
+EMBED_LATENCY_MS = float(os.getenv("CAFB_MOCK_EMBED_LATENCY_MS", "60"))     # per embeddings request
+CHAT_TTFT_MS = float(os.getenv("CAFB_MOCK_CHAT_TTFT_MS", "500"))            # before the first token
+TOKEN_MS = float(os.getenv("CAFB_MOCK_TOKEN_MS", "25"))                     # between tokens
+COMPLETION_TOKENS = int(os.getenv("CAFB_MOCK_COMPLETION_TOKENS", "150"))   # unless max_tokens is lower
+JITTER = float(os.getenv("CAFB_MOCK_JITTER", "0.2"))                        # +/- fraction applied to every delay
+ERROR_RATE = float(os.getenv("CAFB_MOCK_ERROR_RATE", "0"))                  # share of requests answered 500
+RATE_LIMIT_RATE = float(os.getenv("CAFB_MOCK_RATE_LIMIT_RATE", "0"))        # share answered 429 + retry-after
+RETRY_AFTER_S = float(os.getenv("CAFB_MOCK_RETRY_AFTER_S", "1"))
+
+app = FastAPI()
+STATS = {"embeddings": 0, "chat": 0, "chat_stream": 0, "ollama": 0, "errors": 0, "rate_limited": 0}
+
+
+# ----------------------------
+# Latency and failure injection
+# ----------------------------
+async def delay(ms: float):
+    if ms > 0:
+        await asyncio.sleep(ms / 1000 * random.uniform(1 - JITTER, 1 + JITTER))
+
+
+def injected_failure() -> Optional[JSONResponse]:
+    roll = random.random()
+    if roll < ERROR_RATE:
+        STATS["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "Injected server error", "type": "server_error"}})
+    if roll < ERROR_RATE + RATE_LIMIT_RATE:
+        STATS["rate_limited"] += 1
+        return JSONResponse(status_code=429, headers={"retry-after": str(RETRY_AFTER_S)},
+                            content={"error": {"message": "Injected rate limit", "type": "rate_limit_exceeded"}})
+    return None
+
+
+# ----------------------------
+# OpenAI: /v1/embeddings
+# ----------------------------
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    STATS["embeddings"] += 1
+    await delay(EMBED_LATENCY_MS)
+    failure = injected_failure()
+    if failure:
+        return failure
+    texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+    vectors = hash_embed(texts, body.get("dimensions") or EMBEDDING_DIM)
+    as_base64 = body.get("encoding_format") == "base64"  # the Python SDK asks for base64 by default
+    data = [{"object": "embedding", "index": i,
+             "embedding": base64.b64encode(vec.astype("<f4").tobytes()).decode() if as_base64 else vec.tolist()}
+            for i, vec in enumerate(vectors)]
+    tokens = sum(len(tokenize(t)) for t in texts)
+    return {"object": "list", "data": data, "model": body.get("model", ""),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+# ----------------------------
+# OpenAI: /v1/chat/completions (plain and stream=True)
+# ----------------------------
+def completion_words(messages: List[Dict], max_tokens: Optional[int]) -> List[str]:
+    # Deterministic filler that echoes the question, so answers are recognisable in logs
+    question = messages[-1]["content"].rsplit("User question:", 1)[-1].split("Answer:", 1)[0].split() if messages else []
+    words = ["Mock", "answer", "about"] + question[:20]
+    count = min(COMPLETION_TOKENS, max_tokens or COMPLETION_TOKENS)
+    return [words[i % len(words)] for i in range(count)]
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stream = bool(body.get("stream"))
+    STATS["chat_stream" if stream else "chat"] += 1
+    await delay(CHAT_TTFT_MS)
+    failure = injected_failure()
+    if failure:
+        return failure
+    words = completion_words(body.get("messages", []), body.get("max_tokens"))
+    model, created, completion_id = body.get("model", "gpt-4"), int(time.time()), f"chatcmpl-mock-{random.getrandbits(48):x}"
+
+    if not stream:
+        await delay(TOKEN_MS * len(words))
+        return {"id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)}}
+
+    def chunk(delta: Dict, finish_reason: Optional[str] = None) -> str:
+        event = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(event)}\n\n"
+
+    async def events():
+        yield chunk({"role": "assistant", "content": ""})
+        for i, word in enumerate(words):
+            if i:
+                await delay(TOKEN_MS)
+            yield chunk({"content": word if i == 0 else " " + word})
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# ----------------------------
+# Ollama: /api/embeddings (the fallback path)
+# ----------------------------
+@app.post("/api/embeddings")
+async def ollama_embeddings(request: Request):
+    body = await request.json()
+    STATS["ollama"] += 1
+    await delay(EMBED_LATENCY_MS)
+    failure = injected_failure()
+    if failure:
+        return failure
+    return {"embedding": hash_embed([body.get("prompt", "")], OLLAMA_EMBEDDING_DIM)[0].tolist()}
+
+
+@app.get("/stats")
+async def stats():
+    return STATS
+
+
+# ----------------------------
+# Main
+# ----------------------------
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock OpenAI / Ollama server for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--embed-latency-ms", type=float, default=EMBED_LATENCY_MS)
+    parser.add_argument("--chat-ttft-ms", type=float, default=CHAT_TTFT_MS)
+    parser.add_argument("--token-ms", type=float, default=TOKEN_MS)
+    parser.add_argument("--completion-tokens", type=int, default=COMPLETION_TOKENS)
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    parser.add_argument("--rate-limit-rate", type=float, default=RATE_LIMIT_RATE)
+    args = parser.parse_args()
+
+    EMBED_LATENCY_MS, CHAT_TTFT_MS, TOKEN_MS = args.embed_latency_ms, args.chat_ttft_ms, args.token_ms
+    COMPLETION_TOKENS, JITTER = args.completion_tokens, args.jitter
+    ERROR_RATE, RATE_LIMIT_RATE = args.error_rate, args.rate_limit_rate
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,126 @@
+# response_cache.py
+# Semantic cache for /generate: reuse an answer when a near-identical query retrieved the same chunks
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from snapshots import read_index_version
+
+CACHE_THRESHOLD = float(os.getenv("CAFB_RESPONSE_CACHE_THRESHOLD", "0.97"))  # cosine similarity
+CACHE_TTL = float(os.getenv("CAFB_RESPONSE_CACHE_TTL", "3600"))              # seconds
+CACHE_SIZE = int(os.getenv("CAFB_RESPONSE_CACHE_SIZE", "1000"))              # entries, 0 disables
+VERSION_CHECK_INTERVAL = 1.0
+
+
+def _unit(vec) -> np.ndarray:
+    vec = np.asarray(vec, dtype="float32")
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class ResponseCache:
+    """Entries are bucketed by (index version, format, tone, retrieved chunk ids); within a bucket the query
+    embedding must be within `threshold` cosine similarity of a cached query to count as a hit."""
+
+    def __init__(self, output_dir: str, threshold: float = CACHE_THRESHOLD,
+                 ttl: float = CACHE_TTL, max_entries: int = CACHE_SIZE):
+        self.output_dir = output_dir
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Tuple[tuple, np.ndarray, str, float]]" = OrderedDict()
+        self._buckets: Dict[tuple, List[int]] = {}
+        self._next_id = 0
+        self._index_version = read_index_version(output_dir)
+        self._version_checked_at = time.monotonic()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @staticmethod
+    def bucket_key(fmt: Optional[str], tone: Optional[str], chunk_ids: List[int], index_version: str) -> tuple:
+        return (index_version, fmt or "", tone or "", tuple(sorted(chunk_ids)))
+
+    def _check_index_version(self):
+        # update_pipeline.py / the embedders publish a new manifest version whenever an index changes
+        now = time.monotonic()
+        if now - self._version_checked_at < VERSION_CHECK_INTERVAL:
+            return
+        self._version_checked_at = now
+        version = read_index_version(self.output_dir)
+        if version != self._index_version:
+            self._index_version = version
+            self.clear()
+
+    def _drop(self, entry_id: int):
+        bucket, _, _, _ = self._entries.pop(entry_id)
+        ids = self._buckets.get(bucket, [])
+        if entry_id in ids:
+            ids.remove(entry_id)
+        if not ids:
+            self._buckets.pop(bucket, None)
+
+    def lookup(self, query_vec, fmt: Optional[str], tone: Optional[str], chunk_ids: List[int],
+               index_version: str = "") -> Optional[str]:
+        if self.max_entries <= 0:
+            return None
+        with self._lock:
+            self._check_index_version()
+            bucket = self.bucket_key(fmt, tone, chunk_ids, index_version)
+            query = _unit(query_vec)
+            now = time.time()
+            best_id, best_sim = None, self.threshold
+            for entry_id in list(self._buckets.get(bucket, [])):
+                _, vec, _, created = self._entries[entry_id]
+                if now - created > self.ttl:
+                    self._drop(entry_id)
+                    self.evictions += 1
+                    continue
+                if vec.shape != query.shape:
+                    continue  # e.g. a 768-d Ollama fallback embedding against 1536-d entries: not comparable
+                sim = float(np.dot(query, vec))
+                if sim >= best_sim:
+                    best_id, best_sim = entry_id, sim
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def store(self, query_vec, fmt: Optional[str], tone: Optional[str], chunk_ids: List[int], answer: str,
+              index_version: str = ""):
+        """`index_version` is the snapshot the answer was retrieved from, so a request that
+        started before a reload can't plant an answer that later matches the new index."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            bucket = self.bucket_key(fmt, tone, chunk_ids, index_version)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (bucket, _unit(query_vec), answer, time.time())
+            self._buckets.setdefault(bucket, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))  # least recently used
+                self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._buckets.clear()
+        self.invalidations += 1
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entries": len(self._entries),
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "index_version": self._index_version,
+        }
@@ -2,27 +2,38 @@ import json
 import os
 import faiss
 import numpy as np
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 import ollama
 from openai import OpenAI
 from tqdm import tqdm
 
 from dotenv import load_dotenv
+from embedding_cache import get_cache
+from index_factory import search_params, set_default_search_params, describe_index, prepare_queries, read_index, is_inner_product
+from metadata_store import open_metadata, ChunkFilter
+from context_builder import pack_context
 
 load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 EMBEDDING_DIM = 1536
+OPENAI_EMBED_MODEL = "text-embedding-3-small"
+
+SEARCH_MODES = ("dense", "lexical", "hybrid")
+RRF_K = int(os.getenv("CAFB_RRF_K", "60"))                       # reciprocal-rank-fusion damping constant
+HYBRID_CANDIDATES = int(os.getenv("CAFB_HYBRID_CANDIDATES", "4"))  # each ranker returns k * this before fusion
 
 # ----------------------------
 # Load FAISS index and metadata
 # ----------------------------
 def load_faiss_and_metadata(index_path: str, metadata_path:str):
-    index = faiss.read_index(index_path)
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
-    print(f"Loaded FAISS index with {index.ntotal} vectors and {len(metadata)} metadata entries.")
+    index = read_index(index_path)  # memory-mapped unless CAFB_MMAP_INDEX=0
+    set_default_search_params(index)
+    metadata = open_metadata(metadata_path)
+    if hasattr(metadata, "lexical_index"):
+        metadata.lexical_index()  # map (or build) BM25 postings now rather than on the first hybrid query
+    print(f"Loaded FAISS index [{describe_index(index)}] with {index.ntotal} vectors and {len(metadata)} metadata entries.")
     return index, metadata
 
 # ----------------------------
@@ -31,8 +42,15 @@ def load_faiss_and_metadata(index_path: str, metadata_path:str):
 def embed_query(text: str, model_name: str = "nomic-embed-text") -> List[Dict]:
 
     if text.strip():
+        cache = get_cache()
+        if cache is not None:
+            cached = cache.get_many(OPENAI_EMBED_MODEL, [text])[0]
+            if cached is not None:
+                return cached
         try:
-            response = client.embeddings.create(input=text,model="text-embedding-3-small")
+            response = client.embeddings.create(input=text,model=OPENAI_EMBED_MODEL)
+            if cache is not None:
+                cache.put_many(OPENAI_EMBED_MODEL, [text], [response.data[0].embedding])
             return response.data[0].embedding
         except Exception as e:
             print(f"OpenAI embedding failed: {e}. Trying Ollama...")
@@ -46,58 +64,179 @@ def embed_query(text: str, model_name: str = "nomic-embed-text") -> List[Dict]:
     return [0.0] * EMBEDDING_DIM
 
 
+def lookup_chunk(metadata, faiss_id: int) -> Optional[Dict]:
+    # MetadataStore / id-keyed dict, or a legacy positional list
+    if hasattr(metadata, "get"):
+        return metadata.get(int(faiss_id))
+    return metadata[faiss_id] if 0 <= faiss_id < len(metadata) else None
+
+
+def lookup_chunks(metadata, faiss_ids) -> Dict[int, Dict]:
+    """Fetch many ids at once (a single query against a MetadataStore)."""
+    if hasattr(metadata, "get_many"):
+        return metadata.get_many(faiss_ids)
+    found = {}
+    for i in faiss_ids:
+        chunk = lookup_chunk(metadata, i)
+        if chunk is not None:
+            found[int(i)] = chunk
+    return found
+
+
+def with_full_text(results: List[Dict], metadata) -> List[Dict]:
+    """Results carry a 500-character preview; return copies with each chunk's full text for prompting."""
+    chunks = lookup_chunks(metadata, {r["id"] for r in results})
+    return [{**r, "text": chunks[r["id"]].get("text", r["text"])} if r["id"] in chunks else r for r in results]
+
+
 #----------------------------
 # Retrieve top-k similar chunks
 # ----------------------------
 
-def retrieve_top_k(index, metadata, query_vector, k=5):
-    D, I = index.search(np.array([query_vector], dtype="float32"), k)
-    results = []
-    for i, score in zip(I[0], D[0]):
-        if i < len(metadata):
-            chunk = metadata[i]
-            results.append({
-                "score": round(float(score), 2),
-                "source": chunk.get("source", ""),
-                "title": chunk.get("title", ""),
-                "text": chunk.get("text", "")[:500]  # limit preview
-            })
-    return results
+def retrieve_top_k(index, metadata, query_vector, k=5, nprobe=None, ef_search=None):
+    return retrieve_top_k_batch(index, metadata, [query_vector], k=k, nprobe=nprobe, ef_search=ef_search)[0]
+
+
+def filter_ids(metadata, chunk_filter: Optional[ChunkFilter]) -> Optional[np.ndarray]:
+    """Ids allowed by `chunk_filter` (None = no filter). Legacy JSON metadata is scanned in Python;
+    a positional list yields row positions, which is what a non-ID-mapped index returns."""
+    if chunk_filter is None or chunk_filter.is_empty():
+        return None
+    if hasattr(metadata, "filter_ids"):
+        return metadata.filter_ids(chunk_filter)
+    items = metadata.items() if isinstance(metadata, dict) else enumerate(metadata)
+    return np.array(sorted(i for i, chunk in items if chunk_filter.matches(chunk)), dtype="int64")
+
+
+def _ranked_ids_dense(index, query_vectors, k, nprobe=None, ef_search=None, allowed=None) -> List[Optional[List[tuple]]]:
+    """Ranked (id, cosine similarity) per query; None for a query vector the index can't use (failed
+    embedding, or an Ollama fallback vector whose dimension doesn't match)."""
+    matrix, usable = prepare_queries(index, query_vectors)
+    ranked: List[Optional[List[tuple]]] = [None] * len(matrix)
+    if not usable.any():
+        return ranked
+    params = search_params(index, nprobe=nprobe, ef_search=ef_search, ids=allowed)
+    D, I = index.search(matrix[usable], k, params=params)
+    if not is_inner_product(index):
+        # Squared L2 between unit vectors (OpenAI embeddings are unit length) is 2 - 2 * cosine
+        D = 1.0 - D / 2.0
+    for row, ids, scores in zip(np.flatnonzero(usable), I, D):
+        ranked[row] = [(int(i), float(d)) for i, d in zip(ids, scores) if i >= 0]
+    return ranked
+
+
+def _ranked_ids_lexical(metadata, queries: List[str], k, allowed=None) -> List[List[tuple]]:
+    # Legacy JSON metadata has no inverted index; lexical search then finds nothing
+    if not hasattr(metadata, "lexical_search"):
+        return [[] for _ in queries]
+    return [metadata.lexical_search(q, k, allowed) for q in queries]
+
 
+def reciprocal_rank_fusion(rankings: List[List[tuple]], k: int, rrf_k: int = RRF_K) -> List[tuple]:
+    """Merge ranked (id, score) lists: each id scores sum(1 / (rrf_k + rank)). Raw scores are ignored,
+    so vector similarities and BM25 scores never need to be put on the same scale."""
+    fused = {}
+    for ranking in rankings:
+        for rank, (i, _) in enumerate(ranking, start=1):
+            fused[i] = fused.get(i, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
 
-    # filtered_results = results
-    # if filter_sources:
-    #     filtered_results = [r for r in results if r.get("source") in filter_sources]
-    #     if not filtered_results:
-    #         print("⚠️ No results after filtering by source — falling back to unfiltered results.")
-    #         filtered_results = results
 
-    # Sort and return top-k overall
-    # sorted_results = sorted(filtered_results, key=lambda x: x["score"])
-    # return sorted_results[:k]
+def to_results(metadata, ranked: List[List[tuple]], digits: Optional[int] = 4) -> List[List[Dict]]:
+    chunks = lookup_chunks(metadata, {i for ranking in ranked for i, _ in ranking})
+    all_results = []
+    for ranking in ranked:
+        results = []
+        for i, score in ranking:
+            chunk = chunks.get(i)
+            if chunk is not None:
+                results.append({
+                    "id": i,
+                    "score": round(score, digits) if digits is not None else score,
+                    "source": chunk.get("source", ""),
+                    "title": chunk.get("title", ""),
+                    "text": chunk.get("text", "")[:500],  # limit preview
+                    "url": (chunk.get("metadata") or {}).get("url"),  # e.g. caption deep link to the moment in the video
+                })
+        all_results.append(results)
+    return all_results
 
-    # return {"text": text_results, "image": img_results}
 
+def retrieve_top_k_batch(index, metadata, query_vectors, k=5, nprobe=None, ef_search=None,
+                         chunk_filter: Optional[ChunkFilter] = None) -> List[List[Dict]]:
+    """One index.search over the whole query matrix; returns a result list per query."""
+    allowed = filter_ids(metadata, chunk_filter)
+    if allowed is not None and not len(allowed):
+        return [[] for _ in query_vectors]
+    ranked = _ranked_ids_dense(index, query_vectors, k, nprobe, ef_search, allowed)
+    return to_results(metadata, [r or [] for r in ranked])
+
+
+def rank_batch(index, metadata, query_vectors, queries: List[str], k=5, mode="dense",
+               nprobe=None, ef_search=None, chunk_filter: Optional[ChunkFilter] = None
+               ) -> Tuple[List[List[tuple]], List[str]]:
+    """Ranked (id, score) lists per query, plus the scorer behind each list: "dense" (cosine
+    similarity), "lexical" (BM25) or "hybrid" (reciprocal-rank fusion of both). Higher is always
+    better. A dense query whose embedding failed is answered lexically, and reported as such.
+    `chunk_filter` is applied inside each search, so up to k matching chunks come back."""
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode!r}; expected one of {SEARCH_MODES}")
+    scorers = [mode] * len(queries)
+    allowed = filter_ids(metadata, chunk_filter)
+    if allowed is not None and not len(allowed):
+        return [[] for _ in queries], scorers
+    if mode == "lexical":
+        return _ranked_ids_lexical(metadata, queries, k, allowed), scorers
+
+    candidates = k if mode == "dense" else k * HYBRID_CANDIDATES
+    dense = _ranked_ids_dense(index, query_vectors, candidates, nprobe, ef_search, allowed)
+    unusable = [row for row, ranking in enumerate(dense) if ranking is None]
+    if unusable:
+        fallback = _ranked_ids_lexical(metadata, [queries[row] for row in unusable], candidates, allowed)
+        for row, ranking in zip(unusable, fallback):
+            dense[row] = ranking if mode == "dense" else []
+            if mode == "dense":
+                scorers[row] = "lexical"
+    if mode == "dense":
+        return dense, scorers
+
+    lexical = _ranked_ids_lexical(metadata, queries, candidates, allowed)
+    return [reciprocal_rank_fusion([d, l], k) for d, l in zip(dense, lexical)], scorers
+
+
+def retrieve_batch(index, metadata, query_vectors, queries: List[str], k=5, mode="dense",
+                   nprobe=None, ef_search=None, chunk_filter: Optional[ChunkFilter] = None) -> List[List[Dict]]:
+    """Top-k results per query from one index; see rank_batch for modes and scores."""
+    ranked, _ = rank_batch(index, metadata, query_vectors, queries, k, mode, nprobe, ef_search, chunk_filter)
+    return to_results(metadata, ranked)
 
 
 # ----------------------------
 # Generate output with GPT-4 based on retrieved context
 # ----------------------------
+def load_targets():
+    from federated_search import SearchTarget  # imports this module, so not at the top
+    text_index, text_meta = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata.sqlite")
+    image_index, image_meta = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images.sqlite")
+    return [SearchTarget("text", text_index, text_meta), SearchTarget("images", image_index, image_meta)]
+
+
 def generate_with_gpt(query: str, top_k: int = 5) -> str:
+    from federated_search import federated_search
+
     # Load indexes
-    text_index, text_meta = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata.json")
-    image_index, image_meta = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images.json")
+    targets = load_targets()
 
     # Embed query
     query_vec = embed_query(query)
 
-    # Retrieve top-k chunks
-    text_results = retrieve_top_k(text_index, text_meta, query_vec, k=top_k)
-    image_results = retrieve_top_k(image_index, image_meta, query_vec, k=2)
+    # Retrieve top-k chunks across text and images as one ranked list
+    results = federated_search(targets, [query_vec], [query], k=top_k)[0]
 
-    # Combine text and image context
-    combined_texts = [r["text"] for r in text_results + image_results]
-    combined_context = "\n\n".join(combined_texts)[:3000]  # Limit token length for prompt
+    # Full texts, in rank order, within the prompt token budget
+    metadata = {t.name: t.metadata for t in targets}
+    full = [with_full_text([r], metadata[r["index"]])[0] for r in results]
+    combined_context, _ = pack_context(full)
 
     # Create GPT prompt
     prompt = (
@@ -123,34 +262,16 @@ def generate_with_gpt(query: str, top_k: int = 5) -> str:
 # Main: Search text + image indexes
 # ----------------------------
 if __name__ == "__main__":
+    from federated_search import federated_search
+
     query = input("Enter your query: ")
     query_vec = embed_query(query)
 
-    # Load text index and search
-    text_index, text_meta = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata.json")
-    text_results = retrieve_top_k(text_index, text_meta, query_vec, k=5)
-
-    # Load image index and search
-    image_index, image_meta = load_faiss_and_metadata("/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_index_images.index", "/Users/sharvari/Downloads/CAFB_Challenge/outputs/faiss_metadata_images.json")
-    #image_results = retrieve_top_k(image_index, image_meta, query_vec, k=3)
-    raw_image_results = retrieve_top_k(image_index, image_meta, query_vec, k=10)
-
-    seen = set()
-    image_results = []
-    for r in raw_image_results:
-        key = (r['title'], r['text'][:100])  # or use image_name if available
-        if key not in seen:
-            seen.add(key)
-            image_results.append(r)
-        if len(image_results) >= 3:  # limit final results
-            break
-
+    # Search both indexes; duplicates (e.g. the same image in several decks) are merged
+    results = federated_search(load_targets(), [query_vec], [query], k=8)[0]
 
     # Show results
-    print("\n\U0001F4C4 Top Text Results:")
-    for r in text_results:
-        print(f"\nText ({r['score']}): {r['title']}\n{r['text']}")
-
-    print("\n\U0001F5BC️ Top Image Results:")
-    for r in image_results:
-        print(f"\nImage ({r['score']}): {r['title']}\n{r['text']}")
+    print("\n\U0001F50E Top Results:")
+    for r in results:
+        label = "\U0001F5BC️ Image" if r["index"] == "images" else "\U0001F4C4 Text"
+        print(f"\n{label} ({r['score']}): {r['title']}\n{r['text']}")
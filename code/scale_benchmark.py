@@ -0,0 +1,286 @@
+# scale_benchmark.py
+# Synthetic-scale benchmark: how build time, size, load time, memory and latency grow from 10k to 10M vectors
+#
+#   python scale_benchmark.py --sizes 10000 100000 1000000 --kinds flat sq8 ivf_pq hnsw --slo-ms 50
+
+import os
+import gc
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+# benchmark is imported first: it lets the modules that build OpenAI clients at import time load offline
+from benchmark import rss_mb, latency_summary, git_commit
+from index_factory import (build_index, add_vectors, read_index, set_default_search_params, describe_index,
+                           recall_at_k, normalize_rows, pick_nlist, INDEX_KINDS, PQ_M, HNSW_M, PQ_RERANK)
+from metadata_store import MetadataStore, open_metadata
+from retrieval_script import retrieve_top_k
+
+EMBEDDING_DIM = 1536
+SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+RESULTS_PATH = os.path.join(os.getenv("CAFB_OUTPUT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      "..", "outputs")), "scale_benchmark.json")
+GENERATE_BATCH = 50_000
+TRAIN_SIZE = 200_000        # vectors IVF / PQ / SQ are trained on (and first added)
+METADATA_MAX = 1_000_000    # above this, synthetic chunk metadata is not written (BM25 build holds it all in RAM)
+SOURCES = ("blog_posts", "grant_proposals", "powerpoints", "collateral", "captions")
+
+
+# ----------------------------
+# Synthetic corpus: clustered unit vectors (like topics in real embeddings), generated batch by batch
+# ----------------------------
+class SyntheticCorpus:
+    def __init__(self, n: int, dim: int = EMBEDDING_DIM, clusters: int = 256, noise: float = 0.8, seed: int = 0):
+        self.n, self.dim, self.noise, self.seed = n, dim, noise, seed
+        self.centroids = np.random.default_rng(seed).standard_normal((clusters, dim), dtype="float32")
+
+    def _sample(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        matrix = self.centroids[rng.integers(len(self.centroids), size=count)]
+        matrix += self.noise * rng.standard_normal((count, self.dim), dtype="float32")
+        return normalize_rows(matrix)
+
+    def batches(self, batch: int = GENERATE_BATCH) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """(ids, vectors) batches; the same seed always yields the same corpus."""
+        for number, start in enumerate(range(0, self.n, batch)):
+            count = min(batch, self.n - start)
+            rng = np.random.default_rng([self.seed, 0, number])
+            yield np.arange(start, start + count, dtype="int64"), self._sample(rng, count)
+
+    def queries(self, count: int) -> np.ndarray:
+        return self._sample(np.random.default_rng([self.seed, 1]), count)
+
+    def ground_truth(self, queries: np.ndarray, k: int) -> np.ndarray:
+        """Exact top-k ids by inner product, computed one batch at a time (never the whole corpus in RAM)."""
+        heap = faiss.ResultHeap(len(queries), k, keep_max=True)
+        for ids, vectors in self.batches():
+            D, I = faiss.knn(queries, vectors, k, metric=faiss.METRIC_INNER_PRODUCT)
+            heap.add_result(D, ids[I])
+        heap.finalize()
+        return heap.I
+
+
+def synthetic_chunks(ids: np.ndarray, rng: np.random.Generator, vocabulary: List[str]) -> List[Dict]:
+    words = rng.zipf(1.3, size=(len(ids), 12)) % len(vocabulary)
+    years = rng.integers(2013, 2026, size=len(ids))
+    return [{"faiss_id": int(i), "text": " ".join(vocabulary[w] for w in row), "source": SOURCES[i % len(SOURCES)],
+             "title": f"Synthetic document {i // 8}", "doc_id": f"synthetic_{i // 8}", "chunk_id": int(i % 8),
+             "date": f"{year}-01-01"} for i, row, year in zip(ids, words, years)]
+
+
+def write_synthetic_store(corpus: SyntheticCorpus, path: str) -> float:
+    """Chunk metadata for every vector, written the way write_store does. Returns seconds taken."""
+    start = time.perf_counter()
+    vocabulary = [f"term{i}" for i in range(20_000)]
+    rng = np.random.default_rng([corpus.seed, 2])
+    store = MetadataStore(path)
+    for ids, _ in corpus.batches():
+        store.append(synthetic_chunks(ids, rng, vocabulary))
+    store.save_lexical_index()
+    store.close()
+    return time.perf_counter() - start
+
+
+# ----------------------------
+# One index kind at one size
+# ----------------------------
+def estimated_bytes_per_vector(kind: str, dim: int = EMBEDDING_DIM) -> int:
+    # Vector storage plus the 8-byte id in the IndexIDMap2
+    rerank = {"none": 0, "fp16": 2 * dim, "sq8": dim, "flat": 4 * dim}.get(PQ_RERANK, dim)
+    return 8 + {"flat": 4 * dim, "fp16": 2 * dim, "sq8": dim, "ivf_flat": 4 * dim + 8,
+                "ivf_pq": PQ_M + 8 + rerank, "hnsw": 4 * dim + 8 * HNSW_M}[kind]
+
+
+def build_scaled(corpus: SyntheticCorpus, kind: str, train_size: int = TRAIN_SIZE) -> faiss.Index:
+    """build_index on the first `train_size` vectors (trains IVF / PQ / SQ), then add_vectors for the rest,
+    with nlist sized for the full corpus rather than the training sample."""
+    index, train = None, []
+    for ids, vectors in corpus.batches():
+        if index is not None:
+            add_vectors(index, vectors, ids)
+            continue
+        train.append((ids, vectors))
+        if sum(len(i) for i, _ in train) >= min(train_size, corpus.n):
+            sample_ids = np.concatenate([i for i, _ in train])
+            sample = np.concatenate([v for _, v in train])
+            nlist = min(pick_nlist(corpus.n), max(1, len(sample) // 39))
+            index = build_index(sample, kind=kind, ids=sample_ids, nlist=nlist)
+            train = []
+    return index
+
+
+def bench_config(corpus: SyntheticCorpus, kind: str, workdir: str, store_path: Optional[str],
+                 queries: np.ndarray, ground_truth: np.ndarray, k: int, batch_size: int, repeat: int,
+                 mmap: bool) -> Dict:
+    index_path = os.path.join(workdir, f"{kind}.index")
+    start = time.perf_counter()
+    index = build_scaled(corpus, kind)
+    build_s = time.perf_counter() - start
+    faiss.write_index(index, index_path)
+    del index
+    gc.collect()
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    index = read_index(index_path, mmap=mmap)
+    set_default_search_params(index)
+    load_s = time.perf_counter() - start
+
+    # Single-query latency (one index.search per query), then batched (batch_size queries per call)
+    found = np.concatenate([index.search(queries[i:i + 1], k)[1] for i in range(len(queries))])
+    single = []
+    for _ in range(repeat):
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            index.search(queries[i:i + 1], k)
+            single.append(time.perf_counter() - start)
+    batched = []
+    for _ in range(repeat):
+        for i in range(0, len(queries), batch_size):
+            start = time.perf_counter()
+            index.search(queries[i:i + batch_size], k)
+            batched.append((time.perf_counter() - start) / len(queries[i:i + batch_size]))
+
+    row = {
+        "n": corpus.n,
+        "kind": kind,
+        "describe": describe_index(index),
+        "build_s": round(build_s, 3),
+        "disk_mb": round(os.path.getsize(index_path) / 2 ** 20, 1),
+        "load_s": round(load_s, 3),
+        "rss_mb": round(rss_mb() - rss_before, 1),
+        "recall_at_k": round(recall_at_k(ground_truth, found, k), 4),
+        "single": latency_summary(single),
+        "batched": {**latency_summary(batched), "batch_size": batch_size},
+    }
+
+    # End to end through retrieve_top_k: search plus the chunk lookups in the metadata store
+    if store_path:
+        start = time.perf_counter()
+        metadata = open_metadata(store_path)
+        metadata.lexical_index()
+        row["metadata_load_s"] = round(time.perf_counter() - start, 3)
+        retrieve_top_k(index, metadata, queries[0], k=k)
+        end_to_end = []
+        for _ in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                retrieve_top_k(index, metadata, query, k=k)
+                end_to_end.append(time.perf_counter() - start)
+        row["retrieve_top_k"] = latency_summary(end_to_end)
+        row["rss_mb"] = round(rss_mb() - rss_before, 1)
+        metadata.close()
+    del index
+    os.remove(index_path)
+    gc.collect()
+    return row
+
+
+def write_report(report: Dict, path: str):
+    # Temp file + rename, so an interrupted write never leaves a truncated report behind
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def run_scale(sizes: List[int] = SIZES, kinds: List[str] = INDEX_KINDS, n_queries: int = 200, k: int = 10,
+              batch_size: int = 64, repeat: int = 3, max_gb: float = 8.0, metadata_max: int = METADATA_MAX,
+              mmap: bool = True, workdir: Optional[str] = None, seed: int = 0, out: Optional[str] = None,
+              slo_ms: Optional[float] = None) -> Dict:
+    """Benchmark every (size, kind). With `out`, the report is rewritten after each configuration,
+    so a long sweep that dies part-way still leaves the finished rows on disk."""
+    rows, skipped = [], []
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "dim": EMBEDDING_DIM,
+        "queries": n_queries,
+        "k": k,
+        "mmap": mmap,
+        "slo_ms": slo_ms,
+        "results": rows,
+        "skipped": skipped,
+    }
+    for n in sizes:
+        corpus = SyntheticCorpus(n, seed=seed)
+        queries = corpus.queries(n_queries)
+        print(f"📐 {n:,} vectors: computing exact top-{k} for {n_queries} queries")
+        ground_truth = corpus.ground_truth(queries, k)
+
+        size_dir = tempfile.mkdtemp(prefix=f"cafb_scale_{n}_", dir=workdir)
+        try:
+            store_path = None
+            if n <= metadata_max:
+                store_path = os.path.join(size_dir, "faiss_metadata.sqlite")
+                print(f"🗂️ {n:,} vectors: writing synthetic metadata store")
+                store_s = write_synthetic_store(corpus, store_path)
+                print(f"   {store_s:.1f}s, {os.path.getsize(store_path) / 2 ** 20:.0f} MB")
+            for kind in kinds:
+                needed_gb = n * estimated_bytes_per_vector(kind) / 2 ** 30
+                if needed_gb > max_gb:
+                    print(f"⏭️ {n:,} / {kind}: needs ~{needed_gb:.1f} GB > --max-gb {max_gb}, skipped")
+                    skipped.append({"n": n, "kind": kind, "estimated_gb": round(needed_gb, 1)})
+                    continue
+                print(f"⏱️ {n:,} / {kind}")
+                rows.append(bench_config(corpus, kind, size_dir, store_path, queries, ground_truth,
+                                         k, batch_size, repeat, mmap))
+                if out:
+                    write_report(report, out)
+        finally:
+            shutil.rmtree(size_dir, ignore_errors=True)
+
+    if out:
+        write_report(report, out)
+    return report
+
+
+# ----------------------------
+# Report: one row per (size, kind), the scaling curve for capacity planning
+# ----------------------------
+def print_report(report: Dict, slo_ms: Optional[float] = None):
+    print(f"\n{'vectors':>10} {'kind':<9} {'build s':>9} {'disk MB':>9} {'load s':>7} {'RSS MB':>8} "
+          f"{'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'batch ms/q':>11} {'e2e p95':>8}"
+          + ("  SLO" if slo_ms else ""))
+    for r in report["results"]:
+        e2e = r.get("retrieve_top_k", {}).get("p95_ms")
+        line = (f"{r['n']:>10,} {r['kind']:<9} {r['build_s']:>9.2f} {r['disk_mb']:>9.1f} {r['load_s']:>7.3f} "
+                f"{r['rss_mb']:>8.1f} {r['recall_at_k']:>7.4f} {r['single']['p50_ms']:>8.3f} "
+                f"{r['single']['p95_ms']:>8.3f} {r['single']['p99_ms']:>8.3f} {r['batched']['mean_ms']:>11.3f} "
+                f"{e2e if e2e is not None else '-':>8}")
+        if slo_ms:
+            line += "  ✅" if (e2e if e2e is not None else r["single"]["p95_ms"]) <= slo_ms else "  ❌"
+        print(line)
+    for s in report["skipped"]:
+        print(f"{s['n']:>10,} {s['kind']:<9} skipped (~{s['estimated_gb']} GB)")
+
+
+# ----------------------------
+# Main
+# ----------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling curve of each index kind on synthetic 1536-d corpora.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--kinds", nargs="+", default=list(INDEX_KINDS), choices=INDEX_KINDS)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-gb", type=float, default=8.0, help="Skip configurations whose index would exceed this")
+    parser.add_argument("--metadata-max", type=int, default=METADATA_MAX,
+                        help="Largest size that also gets a synthetic metadata store (end-to-end latency)")
+    parser.add_argument("--no-mmap", action="store_true", help="Load indexes into RAM instead of memory-mapping")
+    parser.add_argument("--workdir", help="Where indexes are written (default: system temp dir)")
+    parser.add_argument("--slo-ms", type=float, help="Mark which configurations meet this p95 latency")
+    parser.add_argument("--out", default=RESULTS_PATH, help="Rewritten after every configuration")
+    args = parser.parse_args()
+
+    report = run_scale(args.sizes, args.kinds, args.queries, args.k, args.batch_size, args.repeat,
+                       args.max_gb, args.metadata_max, not args.no_mmap, args.workdir, out=args.out, slo_ms=args.slo_ms)
+    print_report(report, args.slo_ms)
+    print(f"\n📊 Results written to {args.out}")
@@ -3,36 +3,83 @@ import os
 import json
 import hashlib
 from pathlib import Path
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator
+
+HASH_WORKERS = int(os.getenv("CAFB_HASH_WORKERS", str(min(32, (os.cpu_count() or 1) * 2))))
+READ_SIZE = 1 << 20
+
 
 def calculate_file_hash(file_path: str) -> str:
     """Compute SHA-1 hash of a file."""
     h = hashlib.sha1()
     with open(file_path, "rb") as f:
-        while chunk := f.read(8192):
+        while chunk := f.read(READ_SIZE):
             h.update(chunk)
     return h.hexdigest()
 
+
+def _walk_files(folder: str) -> Iterator[os.DirEntry]:
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
+def _stat_record(entry: os.DirEntry) -> Dict:
+    st = entry.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino}
+
+
+def _stat_unchanged(previous, current: Dict) -> bool:
+    # Records written before stat tracking are plain hash strings and always get rehashed
+    return isinstance(previous, dict) and all(previous.get(k) == current[k] for k in ("size", "mtime_ns", "ino"))
+
+
 def scan_data_folder(folder_path: str, hash_record_path: str = "data/file_hashes.json") -> Dict:
-    """Compare file hashes to previous run. Return new/updated files and new hash record."""
-    folder = Path(folder_path)
+    """Compare files to the previous run. Return new/updated files, deleted files and new hash record.
+
+    Only files whose size, mtime or inode changed are rehashed, in parallel; a file that was
+    touched but whose content hash is unchanged is not reported as updated.
+    """
     previous_hashes = {}
     if os.path.exists(hash_record_path):
         with open(hash_record_path, "r") as f:
             previous_hashes = json.load(f)
+    record_file = os.path.abspath(hash_record_path)
 
-    updated_files = []
     new_hashes = {}
+    to_hash = []
+    for entry in _walk_files(str(Path(folder_path))):
+        if os.path.abspath(entry.path) == record_file:
+            continue
+        path_str = entry.path
+        current = _stat_record(entry)
+        previous = previous_hashes.get(path_str)
+        if _stat_unchanged(previous, current):
+            new_hashes[path_str] = previous
+        else:
+            new_hashes[path_str] = current
+            to_hash.append(path_str)
+
+    updated_files = []
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            for path_str, new_hash in zip(to_hash, pool.map(calculate_file_hash, to_hash)):
+                new_hashes[path_str]["hash"] = new_hash
+                previous = previous_hashes.get(path_str)
+                old_hash = previous.get("hash") if isinstance(previous, dict) else previous
+                if old_hash != new_hash:
+                    updated_files.append(path_str)
 
-    for file_path in folder.glob("**/*"):
-        if file_path.is_file():
-            path_str = str(file_path)
-            new_hash = calculate_file_hash(path_str)
-            new_hashes[path_str] = new_hash
-            if path_str not in previous_hashes or previous_hashes[path_str] != new_hash:
-                updated_files.append(path_str)
+    deleted_files = [p for p in previous_hashes if p not in new_hashes]
 
     return {
         "updated_files": updated_files,
+        "deleted_files": deleted_files,
         "new_hash_record": new_hashes
     }
@@ -0,0 +1,154 @@
+# snapshots.py
+# Versioned index snapshots published through an atomically replaced manifest
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_FILE = "index_manifest.json"
+SNAPSHOT_DIR = "snapshots"
+KEEP_SNAPSHOTS = int(os.getenv("CAFB_KEEP_SNAPSHOTS", "3"))
+WRITER_LOCK_FILE = ".writer.lock"
+READER_LEASE_FILE = ".readers"  # inside each snapshot folder; shared-locked by the processes serving it
+
+# Flat file names used before snapshots existed; still read when there is no manifest
+LEGACY_FILES = {
+    "text": ("faiss_index.index", "faiss_metadata.sqlite"),
+    "images": ("faiss_index_images.index", "faiss_metadata_images.sqlite"),
+}
+
+# manifest layout:
+# {"version": "...", "published_at": 1712345678.9,
+#  "indexes": {"text": {"index": "snapshots/<v>/faiss_index.index", "metadata": "snapshots/<v>/faiss_metadata.sqlite"},
+#              "images": {...}}}
+
+
+def read_manifest(output_dir: str) -> Dict:
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def read_index_version(output_dir: str) -> str:
+    return read_manifest(output_dir).get("version", "")
+
+
+def current_paths(output_dir: str, name: str, manifest: Optional[Dict] = None) -> Tuple[str, str]:
+    """(index path, metadata path) published for `name` in `manifest` (default: the current one)."""
+    manifest = read_manifest(output_dir) if manifest is None else manifest
+    entry = manifest.get("indexes", {}).get(name)
+    if entry:
+        return os.path.join(output_dir, entry["index"]), os.path.join(output_dir, entry["metadata"])
+    index_file, metadata_file = LEGACY_FILES[name]
+    return os.path.join(output_dir, index_file), os.path.join(output_dir, metadata_file)
+
+
+def index_names(manifest: Dict) -> List[str]:
+    """Every index published in `manifest` (the legacy pair when there is no manifest)."""
+    return list(manifest.get("indexes") or LEGACY_FILES)
+
+
+def acquire_lock(path: str, wait: bool = True, shared: bool = False):
+    """Advisory lock on `path` (exclusive unless `shared`), held until the returned file is closed or
+    the process exits. Returns None instead of blocking when `wait` is False and the lock is taken."""
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if wait else fcntl.LOCK_NB))
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def writer_lock(output_dir: str):
+    """Serialize processes that change the published indexes (update_pipeline.py runs), so two
+    runs never race on the same snapshot, file hashes or chunk-id map."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, WRITER_LOCK_FILE)
+    lock = acquire_lock(path, wait=False)
+    if lock is None:
+        print("⏳ Another index update is running; waiting for it to finish.")
+        lock = acquire_lock(path)
+    return lock
+
+
+def _snapshot_version(relative_path: str) -> Optional[str]:
+    parts = relative_path.split(os.sep)
+    return parts[1] if len(parts) > 2 and parts[0] == SNAPSHOT_DIR else None
+
+
+class ReaderLease:
+    """Shared locks on the snapshot folders a reader has loaded, so _prune_snapshots leaves them
+    alone. Released by close(), or when the lease is garbage collected (no request holds it)."""
+
+    def __init__(self, output_dir: str, manifest: Dict):
+        versions = {_snapshot_version(entry[key]) for entry in manifest.get("indexes", {}).values()
+                    for key in ("index", "metadata")} - {None}
+        self._locks = []
+        for version in sorted(versions):
+            self._locks.append(acquire_lock(os.path.join(output_dir, SNAPSHOT_DIR, version, READER_LEASE_FILE),
+                                            shared=True))
+
+    def close(self):
+        for lock in self._locks:
+            lock.close()
+        self._locks = []
+
+    __del__ = close
+
+
+def begin_snapshot(output_dir: str) -> Tuple[str, str]:
+    """Create an empty snapshot folder. Returns (version, folder)."""
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    folder = os.path.join(output_dir, SNAPSHOT_DIR, version)
+    os.makedirs(folder, exist_ok=True)
+    return version, folder
+
+
+def publish_snapshot(output_dir: str, version: str, entries: Dict[str, Tuple[str, str]]):
+    """Point the manifest at the new files for each name in `entries` ({name: (index_path, metadata_path)}).
+
+    Names not in `entries` keep their previous files. Readers see either the old or the new
+    manifest, never a partial one, because it is written to a temp file and renamed.
+    """
+    manifest = read_manifest(output_dir)
+    indexes = manifest.get("indexes", {})
+    for name, (index_path, metadata_path) in entries.items():
+        indexes[name] = {"index": os.path.relpath(index_path, output_dir),
+                         "metadata": os.path.relpath(metadata_path, output_dir)}
+    manifest = {"version": version, "published_at": time.time(), "indexes": indexes}
+
+    tmp_path = os.path.join(output_dir, f"{MANIFEST_FILE}.{version}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(output_dir, MANIFEST_FILE))
+    print(f"📣 Published index snapshot {version}.")
+    _prune_snapshots(output_dir, manifest)
+
+
+def _prune_snapshots(output_dir: str, manifest: Dict, keep: int = KEEP_SNAPSHOTS):
+    # Keep the newest few (rollback), anything the manifest still references, and anything a
+    # reader that hasn't reloaded yet still holds a lease on (its SQLite files open lazily per thread)
+    root = os.path.join(output_dir, SNAPSHOT_DIR)
+    referenced = {_snapshot_version(entry[key]) for entry in manifest["indexes"].values()
+                  for key in ("index", "metadata")}
+    versions = sorted(os.listdir(root)) if os.path.isdir(root) else []
+    for version in versions[:-keep] if keep else versions:
+        if version in referenced:
+            continue
+        folder = os.path.join(root, version)
+        lock = acquire_lock(os.path.join(folder, READER_LEASE_FILE), wait=False)
+        if lock is None:
+            continue
+        try:
+            shutil.rmtree(folder, ignore_errors=True)
+        finally:
+            lock.close()
@@ -2,63 +2,167 @@ import os
 import json
 from pathlib import Path
 from embedder import embed_chunks, save_index, EMBEDDING_DIM
-from chunk_utils import chunk_file  # You must have a `chunk_file()` method for single file chunking
+from embedding_engine import usable_embeddings, load_retry_queue, write_retry_queue
+from chunk_utils import chunk_file, target_index, doc_file
 from scan_util import scan_data_folder  # From the hashing code earlier
+from index_factory import build_index, assign_ids, is_id_mapped, remove_ids, add_vectors
+from metadata_store import MetadataStore
+from snapshots import current_paths, begin_snapshot, publish_snapshot, writer_lock
+import shutil
 import faiss
 import numpy as np
-import uuid
 
 # ---- Configs ----
 DATA_FOLDER = "data"
 OUTPUT_FOLDER = "outputs"
-METADATA_PATH = f"{OUTPUT_FOLDER}/faiss_metadata.json"
-INDEX_PATH = f"{OUTPUT_FOLDER}/faiss_index.index"
+WRITER_LOCK = writer_lock(OUTPUT_FOLDER)  # one update at a time; held until this process exits
+INDEX_PATH, METADATA_PATH = current_paths(OUTPUT_FOLDER, "text")  # currently published text index
+FILE_IDS_PATH = f"{OUTPUT_FOLDER}/file_chunk_ids.json"  # {source file: [faiss ids it produced]}
 HASH_RECORD_PATH = f"{DATA_FOLDER}/file_hashes.json"
+RETRY_QUEUE_PATH = f"{OUTPUT_FOLDER}/embedding_retry_text.jsonl"  # chunks whose embedding failed last time
 
-# ---- Step 1: Scan for new/changed files ----
+# ---- Step 1: Scan for new/changed/deleted files ----
 scan_results = scan_data_folder(DATA_FOLDER, HASH_RECORD_PATH)
 new_files = scan_results["updated_files"]
+deleted_files = scan_results["deleted_files"]
 new_hash_record = scan_results["new_hash_record"]
 
-if not new_files:
-    print("✅ No new or changed files detected. FAISS index is up to date.")
+retry_chunks = load_retry_queue(RETRY_QUEUE_PATH)
+
+if os.path.exists(FILE_IDS_PATH):
+    with open(FILE_IDS_PATH, "r") as f:
+        file_ids = json.load(f)
+else:
+    # First incremental run over an existing index: attribute its chunks to their files by doc_id,
+    # so chunks the current chunker no longer produces are still removed when their file changes
+    file_ids = {}
+    if os.path.exists(METADATA_PATH):
+        store = MetadataStore(METADATA_PATH, readonly=True)
+        unattributed = 0
+        for chunk in store.iter_chunks():
+            file_path = doc_file(chunk, DATA_FOLDER)
+            if file_path is None or chunk.get("faiss_id") is None:
+                unattributed += 1
+                continue
+            file_ids.setdefault(file_path, []).append(chunk["faiss_id"])
+        store.close()
+        print(f"🗺️ Attributed existing chunks to {len(file_ids)} files ({unattributed} unattributed).")
+
+# Image description files belong to the images index (image_embedder.py), not this text index.
+# Chunks an earlier run put here from them are removed as if the file had been deleted.
+new_files = [f for f in new_files if target_index(f) == "text"]
+deleted_files = [f for f in deleted_files if target_index(f) == "text"]
+deleted_files += [f for f in file_ids if target_index(f) != "text" and f not in deleted_files]
+
+if not new_files and not deleted_files and not retry_chunks:
+    # Still persist refreshed stat info so touched-but-unchanged files aren't rehashed next run
+    with open(HASH_RECORD_PATH, "w") as f:
+        json.dump(new_hash_record, f, indent=2)
+    if file_ids and not os.path.exists(FILE_IDS_PATH):  # keep the attribution worked out above
+        with open(FILE_IDS_PATH, "w") as f:
+            json.dump(file_ids, f)
+    print("✅ No new, changed or deleted files detected. FAISS index is up to date.")
     exit()
 
-print(f"🔍 Detected {len(new_files)} new/updated files.")
+print(f"🔍 Detected {len(new_files)} new/updated files and {len(deleted_files)} deleted files.")
 
 # ---- Step 2: Chunk new files ----
 all_new_chunks = []
+new_file_ids = {}
 for file_path in new_files:
-    chunks = chunk_file(file_path)  # You must define this in chunker.py
+    chunks = chunk_file(file_path)
+    new_file_ids[file_path] = assign_ids(chunks).tolist()
     all_new_chunks.extend(chunks)
 print(f"🧩 Created {len(all_new_chunks)} new text chunks.")
 
-# ---- Step 3: Embed new chunks ----
-new_embeddings = embed_chunks(all_new_chunks)
-embedding_matrix = np.array(new_embeddings).astype("float32")
+# Queued chunks are retried unless their file changed or went away (re-chunking supersedes them)
+superseded = {i for file_path in new_files + deleted_files for i in file_ids.get(file_path, [])}
+superseded.update(i for ids in new_file_ids.values() for i in ids)
+retry_chunks = [c for c in retry_chunks if c["faiss_id"] not in superseded]
+if retry_chunks:
+    print(f"🔁 Retrying {len(retry_chunks)} chunks whose embedding failed previously.")
 
-# ---- Step 4: Append to FAISS Index ----
-if os.path.exists(INDEX_PATH):
-    index = faiss.read_index(INDEX_PATH)
-else:
-    index = faiss.IndexFlatL2(EMBEDDING_DIM)
-index.add(embedding_matrix)
-faiss.write_index(index, INDEX_PATH)
-print(f"📦 FAISS index updated with {len(new_embeddings)} new vectors.")
+# ---- Step 3: Embed new chunks; only clean primary-model vectors are indexed ----
+embedding_matrix, embedded_chunks, failed_chunks = usable_embeddings(all_new_chunks, embed_chunks(all_new_chunks))
+if retry_chunks:
+    # Retries skip the embedding cache so the provider is really asked again
+    retry_matrix, retried, still_failed = usable_embeddings(retry_chunks, embed_chunks(retry_chunks, use_cache=False))
+    embedding_matrix = np.vstack([embedding_matrix, retry_matrix]) if len(embedded_chunks) else retry_matrix
+    embedded_chunks.extend(retried)
+    failed_chunks.extend(still_failed)
+new_ids = np.array([c["faiss_id"] for c in embedded_chunks], dtype="int64")
+
+if not all_new_chunks and not embedded_chunks and not superseded:
+    # Only queued retries, and none succeeded: a new snapshot would be identical to the current one
+    write_retry_queue(RETRY_QUEUE_PATH, failed_chunks)
+    for file_path in new_files + deleted_files:
+        file_ids.pop(file_path, None)
+    file_ids.update(new_file_ids)
+    with open(FILE_IDS_PATH, "w") as f:
+        json.dump(file_ids, f)
+    with open(HASH_RECORD_PATH, "w") as f:
+        json.dump(new_hash_record, f, indent=2)
+    print("✅ No retried chunk could be embedded; the published index is unchanged.")
+    exit()
+all_new_chunks.extend(retry_chunks)
+
+# ---- Step 4: Work out which existing vectors are stale ----
+# Everything a changed/deleted file produced last time, plus any id being re-written now
+stale_ids = {c["faiss_id"] for c in all_new_chunks}
+for file_path in new_files + deleted_files:
+    stale_ids.update(file_ids.pop(file_path, []))
 
-# ---- Step 5: Append to Metadata ----
+# ---- Step 5: Drop stale chunks from a copy of the metadata store (only the affected rows are touched) ----
+# Changes go into a new snapshot so API servers keep serving the old one until it is published
+version, snapshot_dir = begin_snapshot(OUTPUT_FOLDER)
+new_index_path = os.path.join(snapshot_dir, "faiss_index.index")
+new_metadata_path = os.path.join(snapshot_dir, "faiss_metadata.sqlite")
 if os.path.exists(METADATA_PATH):
-    with open(METADATA_PATH, "r") as f:
-        existing_metadata = json.load(f)
+    shutil.copyfile(METADATA_PATH, new_metadata_path)
+store = MetadataStore(new_metadata_path)
+removed = store.delete(stale_ids)
+print(f"📝 Metadata: removed {removed} stale chunks.")
+
+# ---- Step 6: Remove stale vectors, then add new ones ----
+index = faiss.read_index(INDEX_PATH) if os.path.exists(INDEX_PATH) else None
+if index is not None and is_id_mapped(index):
+    before = index.ntotal
+    index = remove_ids(index, stale_ids)
+    print(f"🗑️ Removed {before - index.ntotal} stale vectors.")
+    if len(new_ids):
+        add_vectors(index, embedding_matrix, new_ids)  # normalized when the index is inner-product
 else:
-    existing_metadata = []
+    kept_metadata = list(store.iter_chunks())
+    if kept_metadata:
+        # Positional index from an older build (or a missing index file): re-index everything once.
+        # Cached embeddings are reused, so only chunks that were never embedded cost a provider call.
+        print("⚠️ Existing FAISS index is missing or not ID-mapped. Rebuilding it with stable chunk ids.")
+        assign_ids(kept_metadata)
+        kept_matrix, kept_embedded, kept_failed = usable_embeddings(kept_metadata, embed_chunks(kept_metadata))
+        embedding_matrix = np.vstack([kept_matrix, embedding_matrix])
+        new_ids = np.concatenate([np.array([c["faiss_id"] for c in kept_embedded], dtype="int64"), new_ids])
+        failed_chunks.extend(kept_failed)
+    index = build_index(embedding_matrix, ids=new_ids)
+faiss.write_index(index, new_index_path)
+print(f"📦 FAISS index updated with {len(embedded_chunks)} new vectors ({index.ntotal} total).")
+
+# ---- Step 7: Append new chunks to the metadata store ----
+# Chunks without a usable vector are stored too, so lexical search can still find them
+store.append(all_new_chunks)
+print(f"📝 Metadata: added {len(all_new_chunks)} chunks ({len(store)} total).")
+store.save_lexical_index()  # BM25 arrays the API workers memory-map
+store.close()
+
+# Atomically switch readers (and the /generate response cache) to the new snapshot
+publish_snapshot(OUTPUT_FOLDER, version, {"text": (new_index_path, new_metadata_path)})
+
+# ---- Step 8: Save updated file hash record, file → id map and the retry queue ----
+write_retry_queue(RETRY_QUEUE_PATH, failed_chunks)
 
-updated_metadata = existing_metadata + all_new_chunks
-with open(METADATA_PATH, "w") as f:
-    json.dump(updated_metadata, f, indent=2)
-print(f"📝 Metadata updated with {len(all_new_chunks)} new chunks.")
+file_ids.update(new_file_ids)
+with open(FILE_IDS_PATH, "w") as f:
+    json.dump(file_ids, f)
 
-# ---- Step 6: Save updated file hash record ----
 with open(HASH_RECORD_PATH, "w") as f:
     json.dump(new_hash_record, f, indent=2)
 
@@ -1,11 +1,11 @@
 import streamlit as st
 import requests
-from fpdf import FPDF
-from docx import Document
-from pptx import Presentation
-from pptx.util import Inches
-from io import BytesIO
+import json
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "code"))
+from exporters import EXPORT_FORMATS, content_hash
 
 # --- Streamlit Setup ---
 st.set_page_config(page_title="CAFBrain Generator", layout="centered")
@@ -26,65 +26,25 @@ if "text_area_version" not in st.session_state:
     st.session_state.text_area_version = 0
 if "show_uploader" not in st.session_state:
     st.session_state.show_uploader = False
+if "ingested_files" not in st.session_state:
+    st.session_state.ingested_files = set()  # (name, size) of uploads already queued for ingestion
+if "ingest_jobs" not in st.session_state:
+    st.session_state.ingest_jobs = []
+
+if "prepared_exports" not in st.session_state:
+    st.session_state.prepared_exports = set()  # (content hash, format) the user asked to download
 
 # --- Export Helpers ---
-def generate_pdf(text: str) -> BytesIO:
-    # Clean the text to replace Unicode “smart” characters with ASCII equivalents.
-    def clean_text(t: str) -> str:
-        replacements = {
-            "\u2018": "'",  # Left single quotation mark
-            "\u2019": "'",  # Right single quotation mark
-            "\u201c": '"',  # Left double quotation mark
-            "\u201d": '"',  # Right double quotation mark
-            "\u2013": "-",  # En dash
-            "\u2014": "-",  # Em dash
-        }
-        for old, new in replacements.items():
-            t = t.replace(old, new)
-        return t
-
-    text = clean_text(text)
-    
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.set_font("Arial", size=12)
-    for line in text.split("\n"):
-        pdf.multi_cell(0, 10, line)
-    # Use errors='ignore' or 'replace' to handle any remaining problematic characters
-    pdf_bytes = pdf.output(dest='S').encode('latin-1', errors='ignore')
-    return BytesIO(pdf_bytes)
-
-def generate_txt(text: str) -> BytesIO:
-    return BytesIO(text.encode('utf-8'))
-
-def generate_docx(text: str) -> BytesIO:
-    doc = Document()
-    for line in text.split("\n"):
-        doc.add_paragraph(line)
-    buffer = BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
-    return buffer
-
-def generate_ppt(text: str) -> BytesIO:
-    prs = Presentation()
-    blocks = text.strip().split("\n\n")
-    for i, block in enumerate(blocks):
-        lines = [line.strip() for line in block.split("\n") if line.strip()]
-        if not lines:
-            continue
-        slide = prs.slides.add_slide(prs.slide_layouts[1])
-        # Use title from line 1 or generate default if no colon is found
-        title = lines[0] if ":" in lines[0] else f"Slide {i+1}"
-        slide.shapes.title.text = title.replace("Slide Title:", "").strip()
-        # Use remaining lines as slide content
-        bullets = "\n".join(line.strip("-• ") for line in lines[1:] or lines)
-        slide.placeholders[1].text = bullets
-    buffer = BytesIO()
-    prs.save(buffer)
-    buffer.seek(0)
-    return buffer
+# Files are rendered by the backend (/export) only when a download is requested, and memoized by
+# content hash and format: edits, undo/redo and other reruns don't re-render anything.
+# Formats and hashing come from code/exporters.py, so the app and the backend can't drift apart.
+@st.cache_data(max_entries=32, show_spinner=False)
+def fetch_export(digest: str, file_format: str, _text: str) -> bytes:
+    # `_text` is left out of Streamlit's cache key; `digest` already identifies it
+    response = requests.post("http://localhost:8000/export", json={"text": _text, "format": file_format},
+                             timeout=(5, 120))
+    response.raise_for_status()
+    return response.content
 
 # --- Input Section ---
 prompt = st.text_area("📌 Enter your prompt", placeholder="e.g., Create a Canva post about SNAP access")
@@ -108,61 +68,115 @@ if st.button("➕ Add Document"):
     st.session_state.show_uploader = True
 
 if st.session_state.show_uploader:
-    uploaded_files = st.file_uploader("Upload your documents", accept_multiple_files=True)
+    # The pipeline chunks the corpus's JSONL exports (blog_posts.jsonl, collateral.jsonl, ...)
+    uploaded_files = st.file_uploader("Upload your documents", accept_multiple_files=True, type=["jsonl"])
     if uploaded_files:
-        for file in uploaded_files:
+        # Streamlit reruns this script on every interaction, so only queue files not queued yet
+        new_files = [f for f in uploaded_files if (f.name, f.size) not in st.session_state.ingested_files]
+        saved_paths = []
+        for file in new_files:
             st.write("Uploaded file:", file.name)
             save_path = f"/Users/sharvari/Downloads/CAFB_Challenge/data/uploads/{file.name}"
             with open(save_path, "wb") as f:
                 f.write(file.getbuffer())
+            saved_paths.append(save_path)
             st.success(f"✅ Saved {file.name} to {save_path}")
-        
-        # Run the update pipeline only if files were uploaded
-        with st.spinner("Processing new documents..."):
-            result = os.system("/Users/sharvari/Downloads/CAFB_Challenge/code/update_pipeline.py")
-            if result == 0:
-                st.success("✅ Documents processed successfully.")
-            else:
-                st.warning("⚠️ Document processing may have failed. Check console for errors.")
+
+        # The ingestion worker (code/ingest_queue.py) merges queued uploads into one pipeline run
+        if saved_paths:
+            try:
+                response = requests.post("http://localhost:8000/ingest", json={"files": saved_paths}, timeout=10)
+                if response.status_code == 400:  # rejected (e.g. a file the pipeline can't chunk); don't resend it
+                    st.warning(f"⚠️ {response.json()['detail']}")
+                else:
+                    response.raise_for_status()
+                    st.session_state.ingest_jobs.append(response.json()["id"])
+                st.session_state.ingested_files.update((f.name, f.size) for f in new_files)
+            except requests.exceptions.RequestException as e:
+                st.warning(f"⚠️ Could not queue documents for processing: {e}")
     else:
         st.info("No files uploaded yet.")
 
+    # Processing runs in the background; the page stays usable and this shows its progress
+    if st.session_state.ingest_jobs:
+        st.button("🔄 Refresh status")
+        for job_id in st.session_state.ingest_jobs:
+            try:
+                job = requests.get(f"http://localhost:8000/ingest/jobs/{job_id}", timeout=5).json()
+            except requests.exceptions.RequestException:
+                st.caption(f"Job {job_id}: status unavailable.")
+                continue
+            names = ", ".join(os.path.basename(p) for p in job["files"])
+            if job["status"] == "done":
+                st.success(f"✅ Processed: {names}")
+            elif job["status"] == "failed":
+                st.warning(f"⚠️ Processing failed for {names}: {job['error']}")
+            elif job["status"] == "running":
+                st.info(f"⏳ Processing {names}... {job['progress']}")
+            else:
+                st.info(f"🕒 Queued: {names}")
+
 # --- Download formats (before submission)
 selected_formats = st.multiselect(
     "💾 Choose file formats to download",
-    ["PDF", "DOCX", "TXT", "PPTX"],
+    list(EXPORT_FORMATS),
     default=["PDF"]
 )
 
 # --- Generation Trigger ---
 submit = st.button("🚀 Generate Content")
 
+def stream_events(response):
+    """Yield (event, data) pairs from a text/event-stream response."""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:  # a blank line ends the event
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
+
 if submit and prompt:
-    with st.spinner("Generating content, please wait..."):
-        api_url = "http://localhost:8000/generate"
-        payload = {
-            "query": prompt,
-            "top_k": 5,
-            "format": content_type,
-            "tone": tone
-        }
-        try:
-            response = requests.post(api_url, json=payload)
-            if response.status_code == 200:
-                data = response.json()
-                generated_text = data["answer"]
-                sources = data["sources"]
+    api_url = "http://localhost:8000/generate/stream"
+    payload = {
+        "query": prompt,
+        "top_k": 5,
+        "format": content_type,
+        "tone": tone
+    }
+    live_output = st.empty()
+    try:
+        with st.spinner("Retrieving sources..."):
+            response = requests.post(api_url, json=payload, stream=True, timeout=(5, 120))
+        if response.status_code == 200:
+            generated_text = ""
+            sources = []
+            # Render tokens as they arrive instead of waiting for the full completion
+            for event, data in stream_events(response):
+                if event == "sources":
+                    sources = data
+                elif event == "delta":
+                    generated_text += data["text"]
+                    live_output.markdown(generated_text + "▌")
+                elif event == "error":
+                    st.error(f"❌ {data['detail']}")
+                    break
+            live_output.empty()
+            if generated_text:
                 # Store generated content and sources
-                st.session_state.edited_output = generated_text
-                st.session_state.edit_history = [generated_text]
+                st.session_state.edited_output = generated_text.strip()
+                st.session_state.edit_history = [generated_text.strip()]
                 st.session_state.redo_stack = []
                 st.session_state.saved_output = ""
                 st.session_state.sources = sources
                 st.session_state.text_area_version += 1  # update version when new content arrives
-            else:
-                st.error(f"❌ Backend Error {response.status_code}: {response.text}")
-        except Exception as e:
-            st.error(f"⚠️ Request failed: {e}")
+        else:
+            st.error(f"❌ Backend Error {response.status_code}: {response.text}")
+    except Exception as e:
+        st.error(f"⚠️ Request failed: {e}")
 
 # --- Editing and Display Section ---
 if st.session_state.edited_output:
@@ -218,37 +232,32 @@ if st.session_state.edited_output:
 
     # --- Download Section ---
     st.subheader("📤 Download Output")
+    digest = content_hash(output_to_download)
     for file_format in selected_formats:
-        file_data = None
-        file_name = "cafbrain_output"
-        mime_type = "application/octet-stream"
-        if file_format == "PDF":
-            file_data = generate_pdf(output_to_download)
-            file_name += ".pdf"
-            mime_type = "application/pdf"
-        elif file_format == "DOCX":
-            file_data = generate_docx(output_to_download)
-            file_name += ".docx"
-            mime_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        elif file_format == "TXT":
-            file_data = generate_txt(output_to_download)
-            file_name += ".txt"
-            mime_type = "text/plain"
-        elif file_format == "PPTX":
-            file_data = generate_ppt(output_to_download)
-            file_name += ".pptx"
-            mime_type = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
-        if file_data:
-            st.download_button(
-                f"⬇️ Download {file_format}",
-                data=file_data,
-                file_name=file_name,
-                mime=mime_type
-            )
+        export_format = EXPORT_FORMATS[file_format]
+        if (digest, file_format) not in st.session_state.prepared_exports:
+            if not st.button(f"📦 Prepare {file_format}", key=f"prepare_{file_format}"):
+                continue
+            st.session_state.prepared_exports.add((digest, file_format))
+        try:
+            with st.spinner(f"Rendering {file_format}..."):
+                file_data = fetch_export(digest, file_format, output_to_download)
+        except requests.exceptions.RequestException as e:
+            st.session_state.prepared_exports.discard((digest, file_format))
+            st.error(f"⚠️ Could not export {file_format}: {e}")
+            continue
+        st.download_button(
+            f"⬇️ Download {file_format}",
+            data=file_data,
+            file_name="cafbrain_output" + export_format.extension,
+            mime=export_format.mime_type
+        )
     
     # --- Sources Section ---
     if st.session_state.sources:
         st.subheader("📚 Sources Used")
         for s in st.session_state.sources:
             st.markdown(f"**{s['title']}**  \n*{s['source']}*  \nScore: {s['score']:.2f}")
+            if s.get("url"):
+                st.markdown(f"[▶️ Watch this moment]({s['url']})")
             st.caption(s["text"][:400] + "...")